@@ -0,0 +1,390 @@
+# (c) 2022 Nikolaus Howe
+"""
+Times (and records the peak memory of) policy evaluation, the ordering searches, and the graph
+construction over growing numbers of policies and states and different discounts, on the two-state
+MDP and cleaning robot from experiments/ and on larger synthetic MDPs.
+
+Every measurement is appended to a JSON lines file along with the git revision it was taken at, so
+runs from different versions can be compared with --compare:
+
+    python benchmarks.py --scale small --output bench.jsonl
+    python benchmarks.py --scale small --output new.jsonl --compare bench.jsonl
+"""
+import argparse
+import dataclasses
+import functools
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+from typing import Any, Callable, Iterator, Optional
+
+from environment import MDPWithoutRewardEnv
+from experiments import cleaning_robot_experiments, two_state_mdp_experiments
+from gameability import (check_gameable, check_ungameable, count_discordant_pairs, get_ungameability_adjacency,
+                         get_ungameable_pairs, remove_equivalent_orderings)
+from graph_analysis import summarize_graph
+from orderings import generate_weak_orderings, make_rank_matrix
+from permutations import calculate_achievable_permutations
+from policy import TabularPolicy, make_cleaning_policy, make_two_state_policy
+from policy_ordering import run_full_ordering_search
+from simplification import check_simplification, get_simplification_adjacency, get_simplification_pairs
+
+SCALES = {
+    # Number of states of the synthetic MDPs, number of policies for the searches and the graphs, discounts,
+    # and number of policies whose values are compared under two rewards
+    "small": {"num_states": [10, 100], "num_policies": [2, 3], "num_graph_policies": [3, 4], "discounts": [0., 0.5],
+              "num_policy_values": [1000, 10000]},
+    "medium": {"num_states": [10, 100, 1000], "num_policies": [2, 3, 4], "num_graph_policies": [3, 4, 5],
+               "discounts": [0., 0.5, 0.9], "num_policy_values": [1000, 10000, 100000]},
+    "large": {"num_states": [100, 1000, 10000], "num_policies": [3, 4, 5], "num_graph_policies": [4, 5, 6],
+              "discounts": [0., 0.5, 0.9, 0.99], "num_policy_values": [10000, 100000, 1000000]},
+}
+SYNTHETIC_NUM_ACTIONS = 2
+SYNTHETIC_NUM_EVAL_POLICIES = 16
+# The recursive and closed form evaluations work with dense (num_states, num_states) matrices per policy, so past
+# this many states they're left to occupancy and action_table evaluation
+DENSE_EVALUATION_MAX_STATES = 1000
+SEED = 0
+# Modules that worker processes import for the order relations and the checks, which shouldn't load the plotting
+# layer (or scipy), and how long importing all of them in a fresh interpreter may take
+CORE_MODULES = ("policy", "environment", "orderings", "bitsets", "gameability", "simplification", "estimation",
+                "policy_space")
+PLOTTING_MODULES = ("matplotlib", "networkx", "scipy")
+IMPORT_TIME_BUDGET = 0.5  # seconds
+
+
+@dataclasses.dataclass
+class Benchmark(object):
+    """
+    One thing to measure. setup is not timed, and returns the argument that run is timed on.
+    If it has a budget, the results say whether its fastest run went over it.
+    """
+    name: str
+    params: dict[str, Any]
+    setup: Callable[[], Any]
+    run: Callable[[Any], Any]
+    budget_seconds: Optional[float] = None
+
+
+def _table_dynamics(next_states: tuple[tuple[int]], state, action):
+    return next_states[state][action]
+
+
+def _tabular_reward(rewards: np.ndarray, state, action):
+    return rewards[state, action]
+
+
+def make_tabular_reward_fun(num_actions: int, decision_vars: np.ndarray) -> Callable:
+    return functools.partial(_tabular_reward, np.asarray(decision_vars).reshape(-1, num_actions))
+
+
+def make_synthetic_env(num_states: int, discount: float, num_actions: int = SYNTHETIC_NUM_ACTIONS,
+                       seed: int = SEED, **kwargs) -> MDPWithoutRewardEnv:
+    """
+    A deterministic MDP whose next states are drawn uniformly at random
+    """
+    rng = np.random.default_rng(seed)
+    next_states = tuple(tuple(int(s) for s in row) for row in rng.integers(num_states, size=(num_states, num_actions)))
+    return MDPWithoutRewardEnv(dynamics=functools.partial(_table_dynamics, next_states),
+                               discount=discount,
+                               num_states=num_states,
+                               num_actions=num_actions,
+                               **kwargs)
+
+
+def make_synthetic_policies(num_states: int, num_policies: int, num_actions: int = SYNTHETIC_NUM_ACTIONS,
+                            seed: int = SEED) -> list[TabularPolicy]:
+    rng = np.random.default_rng(seed + 1)
+    policies = []
+    for i in range(num_policies):
+        policies.append(TabularPolicy((i,), rng.integers(num_actions, size=num_states)))
+    return policies
+
+
+def make_two_state_setup(discount: float, num_policies: int, **kwargs):
+    env = MDPWithoutRewardEnv(dynamics=two_state_mdp_experiments.dynamics, discount=discount, **kwargs)
+    policies = [make_two_state_policy(p) for p in itertools.product((0, 1), repeat=2)][:num_policies]
+    return env, policies, two_state_mdp_experiments.make_reward_fun_from_dec_vars, two_state_mdp_experiments.REWARD_SIZE
+
+
+def make_cleaning_setup(num_policies: int, **kwargs):
+    env = MDPWithoutRewardEnv(dynamics=cleaning_robot_experiments.cleaning_dynamics, discount=0, num_states=1,
+                              num_actions=8, require_nonnegative_reward=True, **kwargs)
+    # Start from the policies used in the experiment, then add the others
+    policy_tuples = [(0, 0, 1), (1, 1, 0), (1, 1, 1), (0, 1, 0), (1, 0, 0), (0, 1, 1), (1, 0, 1), (0, 0, 0)]
+    policies = [make_cleaning_policy(p) for p in policy_tuples[:num_policies]]
+    return env, policies, cleaning_robot_experiments.make_reward_fun, cleaning_robot_experiments.REWARD_SIZE
+
+
+def make_synthetic_setup(num_states: int, discount: float, num_policies: int, **kwargs):
+    env = make_synthetic_env(num_states, discount, **kwargs)
+    policies = make_synthetic_policies(num_states, num_policies)
+    make_reward_fun = functools.partial(make_tabular_reward_fun, SYNTHETIC_NUM_ACTIONS)
+    return env, policies, make_reward_fun, num_states * SYNTHETIC_NUM_ACTIONS
+
+
+def make_realized_orderings(num_policies: int) -> list[tuple[tuple, tuple[int]]]:
+    # Every weak ordering of num_policies policies, which is the most the searches can return
+    return list(generate_weak_orderings([(i,) for i in range(num_policies)]))
+
+
+def _evaluate_policies(setup):
+    env, policies, reward_fun = setup
+    return env.get_all_average_policy_values(policies, reward_fun)
+
+
+def _count_pairs(check: Callable, orderings: list) -> int:
+    return sum(check(first, second) for first, second in itertools.permutations(orderings, 2))
+
+
+def _with_duplicates(orderings: list) -> set:
+    # Every equivalent way of writing each ordering, which is what remove_equivalent_orderings had to clean up
+    duplicated = set()
+    for ordering, relation in orderings:
+        blocks = [[ordering[0]]]
+        for policy, r in zip(ordering[1:], relation):
+            blocks[-1].append(policy) if r == 0 else blocks.append([policy])
+        for block_orders in itertools.product(*(itertools.permutations(block) for block in blocks)):
+            duplicated.add((tuple(p for block in block_orders for p in block), relation))
+    return duplicated
+
+
+def make_correlated_values(num_values: int, seed: int = SEED) -> tuple[np.ndarray, np.ndarray]:
+    # Two rewards that agree on almost all pairs of policies, with some ties, so the check has to look far
+    rng = np.random.default_rng(seed)
+    values = rng.integers(num_values // 2, size=num_values).astype(float)
+    return values, values + rng.random(num_values) * 2
+
+
+def measure_import_time(modules: tuple[str] = CORE_MODULES) -> dict:
+    """
+    Import the modules in a fresh interpreter, and return how long that took in seconds along with which of
+    PLOTTING_MODULES got loaded along the way
+    """
+    code = ("import json, sys, time\n"
+            "start = time.perf_counter()\n"
+            f"import {', '.join(modules)}\n"
+            "seconds = time.perf_counter() - start\n"
+            f"loaded = [module for module in {PLOTTING_MODULES!r} if module in sys.modules]\n"
+            "print(json.dumps({'seconds': seconds, 'loaded': loaded}))")
+    output = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output)
+
+
+def make_benchmarks(scale: str, solvers: tuple[str] = ("slsqp", "lp")) -> Iterator[Benchmark]:
+    config = SCALES[scale]
+    rng = np.random.default_rng(SEED)
+
+    # Startup cost of a worker process (the timing includes starting the interpreter)
+    yield Benchmark("import_core_modules", {"modules": list(CORE_MODULES)}, lambda: CORE_MODULES, measure_import_time,
+                    budget_seconds=IMPORT_TIME_BUDGET)
+
+    # Policy evaluation
+    for num_states, discount, mode in itertools.product(config["num_states"], config["discounts"],
+                                                        ("recursive", "closed_form", "occupancy", "action_table")):
+        if mode in ("recursive", "closed_form") and num_states > DENSE_EVALUATION_MAX_STATES:
+            continue
+
+        def setup(num_states=num_states, discount=discount, mode=mode):
+            env, policies, make_reward_fun, reward_size = make_synthetic_setup(
+                num_states, discount, SYNTHETIC_NUM_EVAL_POLICIES,
+                policy_evaluation="occupancy" if mode == "action_table" else mode)
+            if mode == "action_table":
+                policies = np.array([[policy(state) for state in range(num_states)] for policy in policies])
+            return env, policies, make_reward_fun(rng.standard_normal(reward_size))
+
+        yield Benchmark("get_all_average_policy_values",
+                        {"mdp": "synthetic", "num_states": num_states, "discount": discount,
+                         "num_policies": SYNTHETIC_NUM_EVAL_POLICIES, "policy_evaluation": mode},
+                        setup, _evaluate_policies)
+
+    # Searches
+    searches = {"calculate_achievable_permutations": calculate_achievable_permutations,
+                "run_full_ordering_search": run_full_ordering_search}
+    setups = []
+    for num_policies, discount in itertools.product(config["num_policies"], config["discounts"]):
+        setups.append(({"mdp": "two_state", "discount": discount, "num_policies": num_policies},
+                       functools.partial(make_two_state_setup, discount, num_policies)))
+    for num_policies in config["num_policies"]:
+        setups.append(({"mdp": "cleaning_robot", "discount": 0, "num_policies": num_policies},
+                       functools.partial(make_cleaning_setup, num_policies)))
+    for num_states, num_policies in itertools.product(config["num_states"][:2], config["num_policies"]):
+        setups.append(({"mdp": "synthetic", "num_states": num_states, "discount": 0.5, "num_policies": num_policies},
+                       functools.partial(make_synthetic_setup, num_states, 0.5, num_policies)))
+
+    for (name, search), (params, make_setup), solver in itertools.product(searches.items(), setups, solvers):
+        # The cleaning robot's actions are tuples, which only the default evaluation handles
+        mode = "recursive" if params["mdp"] == "cleaning_robot" else "occupancy"
+        params = {**params, "policy_evaluation": mode}
+
+        def setup(make_setup=make_setup, mode=mode):
+            return make_setup(policy_evaluation=mode)
+
+        def run(setup, name=name, search=search, solver=solver):
+            env, policies, make_reward_fun, reward_size = setup
+            if name == "calculate_achievable_permutations":
+                return search(policies, make_reward_fun, env, reward_size, solver=solver)
+            return search(policies, make_reward_fun, reward_size, env, solver=solver)
+
+        yield Benchmark(name, {**params, "solver": solver}, setup, run)
+
+    # Comparing the policy values under two rewards
+    for num_values in config["num_policy_values"]:
+        for name, fun in (("check_gameable", check_gameable), ("count_discordant_pairs", count_discordant_pairs)):
+            yield Benchmark(name, {"num_policies": num_values},
+                            functools.partial(make_correlated_values, num_values), lambda values, fun=fun: fun(*values))
+
+    # Graph construction
+    for num_policies in config["num_graph_policies"]:
+        orderings = make_realized_orderings(num_policies)
+        params = {"num_policies": num_policies, "num_orderings": len(orderings)}
+        yield Benchmark("remove_equivalent_orderings", params,
+                        functools.partial(_with_duplicates, orderings), remove_equivalent_orderings)
+        yield Benchmark("check_ungameable", params,
+                        functools.partial(list, orderings), functools.partial(_count_pairs, check_ungameable))
+        for encoding in ("dense", "bitset"):
+            yield Benchmark("get_ungameable_pairs", {**params, "encoding": encoding},
+                            functools.partial(list, orderings),
+                            functools.partial(get_ungameable_pairs, encoding=encoding))
+        yield Benchmark("check_simplification", params,
+                        functools.partial(list, orderings), functools.partial(_count_pairs, check_simplification))
+        for encoding, transitive_reduction in itertools.product(("dense", "bitset"), (False, True)):
+            yield Benchmark("get_simplification_pairs",
+                            {**params, "encoding": encoding, "transitive_reduction": transitive_reduction},
+                            functools.partial(list, orderings),
+                            functools.partial(get_simplification_pairs, transitive_reduction=transitive_reduction,
+                                              encoding=encoding))
+        rank_matrix, _ = make_rank_matrix(orderings)
+        yield Benchmark("summarize_graph", {**params, "graph": "ungameability"},
+                        functools.partial(get_ungameability_adjacency, rank_matrix),
+                        functools.partial(summarize_graph, directed=False))
+        yield Benchmark("summarize_graph", {**params, "graph": "simplification"},
+                        functools.partial(get_simplification_adjacency, rank_matrix),
+                        functools.partial(summarize_graph, directed=True))
+
+
+def measure(benchmark: Benchmark, repeats: int) -> dict:
+    """
+    Time the benchmark repeats times, then run it once more under tracemalloc for the peak memory
+    (separately, since tracing slows everything down)
+    """
+    seconds = []
+    for _ in range(repeats):
+        argument = benchmark.setup()
+        start = time.perf_counter()
+        benchmark.run(argument)
+        seconds.append(time.perf_counter() - start)
+
+    argument = benchmark.setup()
+    tracemalloc.start()
+    try:
+        benchmark.run(argument)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    record = {
+        "benchmark": benchmark.name,
+        "params": benchmark.params,
+        "repeats": repeats,
+        "min_seconds": min(seconds),
+        "median_seconds": float(np.median(seconds)),
+        "peak_memory_bytes": peak_memory,
+    }
+    if benchmark.budget_seconds is not None:
+        record["budget_seconds"] = benchmark.budget_seconds
+        record["over_budget"] = min(seconds) > benchmark.budget_seconds
+    return record
+
+
+def get_run_info() -> dict:
+    try:
+        revision = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                  check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        "git_revision": revision,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "timestamp": time.time(),
+    }
+
+
+def get_benchmark_key(record: dict) -> str:
+    return record["benchmark"] + " " + json.dumps(record["params"], sort_keys=True)
+
+
+def load_results(path: str) -> dict[str, dict]:
+    # If a benchmark shows up several times, the last measurement wins
+    with open(path) as f:
+        return {get_benchmark_key(record): record for record in map(json.loads, f) if "benchmark" in record}
+
+
+def compare_results(baseline: dict[str, dict], current: dict[str, dict]) -> list[tuple[str, float, float, float]]:
+    """
+    Returns (benchmark, baseline seconds, current seconds, speedup) for the benchmarks in both
+    """
+    comparison = []
+    for key in sorted(baseline.keys() & current.keys()):
+        before, after = baseline[key]["min_seconds"], current[key]["min_seconds"]
+        comparison.append((key, before, after, before / after if after > 0 else float("inf")))
+    return comparison
+
+
+def run_benchmarks(scale: str = "small",
+                   output: Optional[str] = None,
+                   repeats: int = 3,
+                   name_filter: Optional[str] = None,
+                   solvers: tuple[str] = ("slsqp", "lp")) -> list[dict]:
+    run_info = get_run_info()
+    results = []
+    out = open(output, "a") if output is not None else None
+    try:
+        for benchmark in make_benchmarks(scale, solvers):
+            if name_filter is not None and name_filter not in benchmark.name:
+                continue
+            record = {**measure(benchmark, repeats), "scale": scale, **run_info}
+            results.append(record)
+            print(f"{get_benchmark_key(record)}: {record['min_seconds']:.4f}s, "
+                  f"peak {record['peak_memory_bytes'] / 2 ** 20:.1f} MiB"
+                  + (f", OVER THE {record['budget_seconds']}s BUDGET" if record.get("over_budget") else ""),
+                  file=sys.stderr)
+            if out is not None:
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+    finally:
+        if out is not None:
+            out.close()
+    return results
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", choices=SCALES.keys(), default="small")
+    parser.add_argument("--output", help="JSON lines file to append the results to")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--filter", dest="name_filter", help="only run benchmarks whose name contains this")
+    parser.add_argument("--solvers", nargs="+", default=["slsqp", "lp"])
+    parser.add_argument("--compare", help="earlier results to compare against")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.scale, args.output, args.repeats, args.name_filter, tuple(args.solvers))
+
+    if args.compare is not None:
+        current = {get_benchmark_key(record): record for record in results}
+        for key, before, after, speedup in compare_results(load_results(args.compare), current):
+            print(f"{speedup:7.2f}x  {before:9.4f}s -> {after:9.4f}s  {key}")
+
+
+if __name__ == "__main__":
+    main()
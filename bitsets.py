@@ -0,0 +1,163 @@
+# (c) 2022 Nikolaus Howe
+import dataclasses
+import numpy as np
+
+from typing import Any, Iterator, Optional, Sequence
+
+from orderings import make_rank_matrix
+
+RELATION_ENCODINGS = ("dense", "bitset")
+BITSET_CHUNK_BYTES = 2 ** 26  # roughly how much memory the pairwise comparisons may use at once
+ENCODING_CHUNK_SIZE = 65536  # how many orderings to encode at once
+BYTE_POPCOUNTS = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+
+@dataclasses.dataclass
+class PairBitsets(object):
+    """
+    Weak orderings of num_policies policies as two packed bitsets over the pairs of policies i < j:
+    whether policy i is ranked strictly below policy j, and whether they are tied. Each is an array of
+    shape (num_orderings, num_words) of uint64, and bits past the last pair are always zero.
+    """
+    less: np.ndarray
+    equal: np.ndarray
+    num_policies: int
+
+    def __len__(self):
+        return len(self.less)
+
+    @property
+    def num_pairs(self) -> int:
+        return self.num_policies * (self.num_policies - 1) // 2
+
+    @property
+    def nbytes(self) -> int:
+        return self.less.nbytes + self.equal.nbytes
+
+    @property
+    def greater(self) -> np.ndarray:
+        return ~(self.less | self.equal) & get_pair_mask(self.num_pairs)
+
+    @classmethod
+    def from_rank_matrix(cls, rank_matrix: np.ndarray, chunk_size: int = ENCODING_CHUNK_SIZE) -> "PairBitsets":
+        num_orderings, num_policies = rank_matrix.shape
+        first, second = np.triu_indices(num_policies, k=1)
+        num_words = get_num_words(len(first))
+        less = np.zeros((num_orderings, num_words), dtype=np.uint64)
+        equal = np.zeros((num_orderings, num_words), dtype=np.uint64)
+        for start in range(0, num_orderings, chunk_size):
+            ranks = rank_matrix[start:start + chunk_size]
+            less[start:start + len(ranks)] = pack_bits(ranks[:, first] < ranks[:, second], num_words)
+            equal[start:start + len(ranks)] = pack_bits(ranks[:, first] == ranks[:, second], num_words)
+        return cls(less, equal, num_policies)
+
+    @classmethod
+    def from_orderings(cls, orderings_and_relations: Sequence[tuple[tuple, tuple[int]]],
+                       policies: Optional[Sequence[Any]] = None) -> "PairBitsets":
+        rank_matrix, _ = make_rank_matrix(orderings_and_relations, policies)
+        return cls.from_rank_matrix(rank_matrix)
+
+
+def get_num_words(num_bits: int) -> int:
+    return max(1, -(-num_bits // 64))
+
+
+def pack_bits(bits: np.ndarray, num_words: int) -> np.ndarray:
+    """
+    Pack a boolean array of shape (num_rows, num_bits) into uint64 words of shape (num_rows, num_words)
+    """
+    packed = np.zeros((len(bits), num_words * 8), dtype=np.uint8)
+    bytes_used = -(-bits.shape[1] // 8)
+    packed[:, :bytes_used] = np.packbits(bits, axis=1, bitorder="little")
+    return packed.view(np.uint64)
+
+
+def get_pair_mask(num_pairs: int) -> np.ndarray:
+    return pack_bits(np.ones((1, num_pairs), dtype=bool), get_num_words(num_pairs))[0]
+
+
+def popcount(words: np.ndarray) -> np.ndarray:
+    """
+    Number of set bits, summed over the last axis
+    """
+    if not hasattr(np, "bitwise_count"):  # only in numpy >= 2.0
+        return _popcount_from_bytes(words)
+    return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+
+
+def _popcount_from_bytes(words: np.ndarray) -> np.ndarray:
+    # Look up the set bits of every byte of the words instead, which turns the last axis into one of bytes
+    return BYTE_POPCOUNTS[np.ascontiguousarray(words).view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def _get_chunk_size(bitsets: PairBitsets) -> int:
+    # Each row of a chunk needs a few words of scratch space for every ordering
+    row_bytes = 3 * max(1, len(bitsets)) * bitsets.less.itemsize
+    return max(1, BITSET_CHUNK_BYTES // row_bytes)
+
+
+def _any_shared_bits(pairs_of_bitsets: list[tuple[np.ndarray, np.ndarray]], rows: slice) -> np.ndarray:
+    """
+    For each ordering i in rows and each ordering j, whether first[i] & second[j] is nonzero for any of
+    the (first, second) pairs of bitsets. Goes one word at a time, so that the scratch space is 2D.
+    """
+    accumulated = None
+    scratch = None
+    for first, second in pairs_of_bitsets:
+        for word in range(first.shape[1]):
+            if accumulated is None:
+                accumulated = np.bitwise_and(first[rows, word, None], second[None, :, word])
+                scratch = np.empty_like(accumulated)
+            else:
+                np.bitwise_and(first[rows, word, None], second[None, :, word], out=scratch)
+                np.bitwise_or(accumulated, scratch, out=accumulated)
+    return accumulated != 0
+
+
+def iter_bitset_ungameability_chunks(bitsets: PairBitsets,
+                                     chunk_size: Optional[int] = None) -> Iterator[tuple[int, np.ndarray]]:
+    """
+    The same blocks as gameability.iter_ungameability_chunks, from bitsets: two orderings are ungameable
+    when no pair is strictly less in one and strictly greater in the other
+    """
+    chunk_size = chunk_size or _get_chunk_size(bitsets)
+    less, greater = bitsets.less, bitsets.greater
+    for start in range(0, len(bitsets), chunk_size):
+        block = ~_any_shared_bits([(less, greater), (greater, less)], slice(start, start + chunk_size))
+        diagonal = np.arange(len(block))
+        block[diagonal, start + diagonal] = False
+        yield start, block
+
+
+def iter_bitset_simplification_chunks(bitsets: PairBitsets,
+                                      chunk_size: Optional[int] = None) -> Iterator[tuple[int, np.ndarray]]:
+    """
+    The same blocks as simplification.iter_simplification_chunks, from bitsets: ordering j is a simplification
+    of ordering i when no strict pair of i is reversed in j, every tie of i is kept in j, and some strict
+    pair of i is tied in j
+    """
+    chunk_size = chunk_size or _get_chunk_size(bitsets)
+    less, equal, greater = bitsets.less, bitsets.equal, bitsets.greater
+    strict = less | greater
+    for start in range(0, len(bitsets), chunk_size):
+        rows = slice(start, start + chunk_size)
+        broken = _any_shared_bits([(less, greater), (greater, less), (equal, strict)], rows)
+        merged = _any_shared_bits([(strict, equal)], rows)
+        yield start, ~broken & merged
+
+
+def iter_edges(chunks: Iterator[tuple[int, np.ndarray]]) -> Iterator[np.ndarray]:
+    """
+    Turn blocks of a relation into arrays of (row, column) edges, one array per block
+    """
+    for start, block in chunks:
+        yield np.argwhere(block) + [start, 0]
+
+
+def count_strict_disagreements(bitsets: PairBitsets, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """
+    For each pair of orderings (first[k], second[k]), the number of pairs of policies which one of them
+    ranks strictly one way and the other strictly the other way
+    """
+    less, greater = bitsets.less, bitsets.greater
+    return popcount((less[first] & greater[second]) | (greater[first] & less[second]))
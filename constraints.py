@@ -1,27 +1,67 @@
 # (c) 2022 Nikolaus Howe
 import numpy as np
 
-from typing import Callable
+from typing import Any, Callable, Optional
 
 from environment import MDPWithoutRewardEnv
+from instrumentation import get_instrumentation
 from policy import Policy
 
+EPSILON = 1.  # how much better a policy has to be to count as strictly better
+
+
+def declare_reward_features(features: Callable[[int, Any], np.ndarray]) -> Callable:
+    """
+    Decorate a make_reward_fun that is linear in its decision variables with the features it is linear in, so that
+    make_reward_fun(decision_vars)(state, action) == features(state, action) @ decision_vars. The solvers then
+    take each policy's feature expectations from the features, only spot checking that they match (see
+    check_reward_features) rather than checking linearity, and give SLSQP exact constraint values and Jacobians.
+    """
+    def decorator(make_reward_fun):
+        make_reward_fun.reward_features = features
+        return make_reward_fun
+
+    return decorator
+
+
+def declare_reward_jacobian(jacobian: Callable[[np.ndarray], Callable[[int, Any], np.ndarray]]) -> Callable:
+    """
+    Decorate a (possibly nonlinear) make_reward_fun with its Jacobian: jacobian(decision_vars)(state, action) is
+    the gradient of make_reward_fun(decision_vars)(state, action) with respect to the decision variables.
+    SLSQP then gets exact constraint Jacobians rather than finite differencing the constraints.
+    """
+    def decorator(make_reward_fun):
+        make_reward_fun.reward_jacobian = jacobian
+        return make_reward_fun
+
+    return decorator
+
+
+def get_reward_features(make_reward_fun: Callable) -> Optional[Callable]:
+    return getattr(make_reward_fun, "reward_features", None)
+
+
+def has_reward_gradients(make_reward_fun: Callable) -> bool:
+    return get_reward_features(make_reward_fun) is not None or hasattr(make_reward_fun, "reward_jacobian")
+
 
 def ineq_constraints(reward_components,
                      policy_permutation: tuple[Policy],
                      make_reward_fun: Callable,
                      env: MDPWithoutRewardEnv,
                      adjacent_policy_relations: list[int],  # 0: equality, 1: inequality, 2: unspecified
+                     policies_above: tuple[Policy] = (),  # policies strictly better than the whole permutation
                      ):
-    epsilon = 1.
+    epsilon = EPSILON
+    get_instrumentation().count("constraint_evaluations")
 
     # Make the reward function using the functional passed in
     reward_fun = make_reward_fun(reward_components)
 
     # Get the values of the four different policies (in the order they *should* be)
-    policy_values = []
-    for policy_fun in policy_permutation:
-        policy_values.append(env.get_average_policy_value(policy_fun=policy_fun, reward_fun=reward_fun))
+    all_values = env.get_all_average_policy_values(policy_permutation=tuple(policy_permutation) + tuple(policies_above),
+                                                   reward_fun=reward_fun)
+    policy_values = all_values[:len(policy_permutation)]
 
     # Get the differences between adjacent policy performances
     ineqs = []
@@ -29,6 +69,10 @@ def ineq_constraints(reward_components,
         if i > 0 and adjacent_policy_relations[i - 1] == 1:  # only add in the inequalities
             ineqs.append(policy_values[i] - policy_values[i - 1] - epsilon)
 
+    # The policies above have to beat the best policy in the permutation
+    for value in all_values[len(policy_permutation):]:
+        ineqs.append(value - policy_values[-1] - epsilon)
+
     # If we require positive rewards, enforce that here
     if env.require_nonnegative_reward:
         for reward_component in reward_components:
@@ -40,10 +84,28 @@ def ineq_constraints(reward_components,
 def make_ineq_constraints(policy_permutation: tuple[Policy],
                           make_reward_fun: Callable,
                           env: MDPWithoutRewardEnv,
-                          adjacent_policy_relations: list[int]):
+                          adjacent_policy_relations: list[int],
+                          policies_above: tuple[Policy] = (),
+                          feature_values: Optional[dict] = None):
+    """
+    The inequality constraints as a function of the decision variables. Given the feature values of the policies
+    (see get_policy_feature_values), they are computed exactly from those, in one matrix product.
+    """
+    if feature_values is not None:
+        A_ub, b_ub, _, _ = _make_feature_constraint_matrices(feature_values, policy_permutation,
+                                                             adjacent_policy_relations, policies_above)
+
+        def linear_ineq_constraints(decision_vars):
+            get_instrumentation().count("constraint_evaluations")
+            ineqs = b_ub - A_ub @ decision_vars
+            return np.concatenate([ineqs, decision_vars]) if env.require_nonnegative_reward else ineqs
+
+        return linear_ineq_constraints
+
     def curried_ineq_constraints(decision_vars):
         return ineq_constraints(decision_vars, policy_permutation, make_reward_fun, env,
-                                adjacent_policy_relations=adjacent_policy_relations)
+                                adjacent_policy_relations=adjacent_policy_relations,
+                                policies_above=policies_above)
 
     return curried_ineq_constraints
 
@@ -56,6 +118,7 @@ def eq_constraints(decision_vars: np.ndarray,
     """
     Make an equality constraint setting the values of the two policies equal
     """
+    get_instrumentation().count("constraint_evaluations")
     reward_fun = make_reward_fun(decision_vars)
 
     # Add equality constraints between the explicitly equated policy pairs
@@ -66,13 +129,13 @@ def eq_constraints(decision_vars: np.ndarray,
     #     eq_constraints.append(value2 - value1)
 
     # Add equality constraints between adjacent policies in the ordering if requested
+    if 0 not in adjacent_policy_relations:
+        return np.array(eq_constraints)
+    policy_values = env.get_all_average_policy_values(policy_permutation=policy_permutation, reward_fun=reward_fun)
     for i, e in enumerate(adjacent_policy_relations):
         if e == 0:  # 0: equality, 1: inequality, 2: unspecified
-            left_policy, right_policy = policy_permutation[i], policy_permutation[i + 1]
-            # print("equating policies", left_policy, right_policy)
-            left_value = env.get_average_policy_value(policy_fun=left_policy, reward_fun=reward_fun)
-            right_value = env.get_average_policy_value(policy_fun=right_policy, reward_fun=reward_fun)
-            eq_constraints.append(right_value - left_value)
+            # print("equating policies", policy_permutation[i], policy_permutation[i + 1])
+            eq_constraints.append(policy_values[i + 1] - policy_values[i])
 
     return np.array(eq_constraints)
 
@@ -80,7 +143,21 @@ def eq_constraints(decision_vars: np.ndarray,
 def make_eq_constraints(env: MDPWithoutRewardEnv,
                         policy_permutation: tuple[Policy],
                         make_reward_fun: Callable,
-                        adjacent_policy_relations: list[int]):
+                        adjacent_policy_relations: list[int],
+                        feature_values: Optional[dict] = None):
+    """
+    The equality constraints as a function of the decision variables, see make_ineq_constraints
+    """
+    if feature_values is not None:
+        _, _, A_eq, b_eq = _make_feature_constraint_matrices(feature_values, policy_permutation,
+                                                             adjacent_policy_relations)
+
+        def linear_eq_constraints(decision_vars):
+            get_instrumentation().count("constraint_evaluations")
+            return A_eq @ decision_vars - b_eq
+
+        return linear_eq_constraints
+
     def curried_eq_constraints(decision_vars):
         return eq_constraints(decision_vars=decision_vars,
                               policy_permutation=policy_permutation,
@@ -89,3 +166,198 @@ def make_eq_constraints(env: MDPWithoutRewardEnv,
                               adjacent_policy_relations=adjacent_policy_relations)
 
     return curried_eq_constraints
+
+
+def make_ineq_constraint_jacobian(policy_permutation: tuple[Policy],
+                                  make_reward_fun: Callable,
+                                  env: MDPWithoutRewardEnv,
+                                  adjacent_policy_relations: list[int],
+                                  policies_above: tuple[Policy] = (),
+                                  feature_values: Optional[dict] = None):
+    """
+    The Jacobian of make_ineq_constraints' function, of shape (num_constraints, reward_size), for a make_reward_fun
+    that declares its features or Jacobian (see declare_reward_features and declare_reward_jacobian). With
+    feature_values it is constant, and computed only once.
+    """
+    def get_jacobian(value_jacobians):
+        A_ub, _, _, _ = make_linear_constraint_matrices(value_jacobians[:len(policy_permutation)],
+                                                        adjacent_policy_relations,
+                                                        value_jacobians[len(policy_permutation):])
+        if env.require_nonnegative_reward:
+            return np.concatenate([-A_ub, np.eye(value_jacobians.shape[1])])
+        return -A_ub
+
+    policies = tuple(policy_permutation) + tuple(policies_above)
+    if feature_values is not None:
+        jacobian = get_jacobian(np.array([feature_values[policy] for policy in policies]))
+        return lambda decision_vars: jacobian
+
+    def ineq_constraint_jacobian(decision_vars):
+        return get_jacobian(get_policy_value_jacobian(policies, make_reward_fun, env, decision_vars))
+
+    return ineq_constraint_jacobian
+
+
+def make_eq_constraint_jacobian(env: MDPWithoutRewardEnv,
+                                policy_permutation: tuple[Policy],
+                                make_reward_fun: Callable,
+                                adjacent_policy_relations: list[int],
+                                feature_values: Optional[dict] = None):
+    """
+    The Jacobian of make_eq_constraints' function, see make_ineq_constraint_jacobian
+    """
+    def get_jacobian(value_jacobians):
+        return make_linear_constraint_matrices(value_jacobians, adjacent_policy_relations)[2]
+
+    if feature_values is not None:
+        jacobian = get_jacobian(np.array([feature_values[policy] for policy in policy_permutation]))
+        return lambda decision_vars: jacobian
+
+    def eq_constraint_jacobian(decision_vars):
+        return get_jacobian(get_policy_value_jacobian(tuple(policy_permutation), make_reward_fun, env, decision_vars))
+
+    return eq_constraint_jacobian
+
+
+def _as_policy_tuple(policies):
+    # Action tables stay arrays, so that the env evaluates them all at once
+    return policies if isinstance(policies, np.ndarray) else tuple(policies)
+
+
+def get_policy_feature_values(policies: list[Policy],
+                              make_reward_fun: Callable,
+                              reward_size: int,
+                              env: MDPWithoutRewardEnv) -> np.ndarray:
+    """
+    Get the average value of every policy under every unit decision variable vector, as an array of
+    shape (num_policies, reward_size). If make_reward_fun is linear in its decision variables, then the
+    policy values under decision_vars are exactly feature_values @ decision_vars.
+    The policies can also be an action table (see policy_space), whose occupancies are then computed only once.
+    """
+    features = get_reward_features(make_reward_fun)
+    if features is not None:
+        return get_policy_gradient_values(policies, features, reward_size, env)
+
+    if isinstance(policies, np.ndarray):
+        unit_rewards = np.stack([env.get_tabular_reward(make_reward_fun(unit_vector))
+                                 for unit_vector in np.eye(reward_size)])
+        return env.get_action_table_occupancy(policies) @ unit_rewards.T
+
+    feature_values = np.empty((len(policies), reward_size))
+    for k, unit_vector in enumerate(np.eye(reward_size)):
+        feature_values[:, k] = env.get_all_average_policy_values(policy_permutation=tuple(policies),
+                                                                 reward_fun=make_reward_fun(unit_vector))
+    return feature_values
+
+
+def get_policy_gradient_values(policies: list[Policy],
+                               gradient_fun: Callable[[int, Any], np.ndarray],
+                               reward_size: int,
+                               env: MDPWithoutRewardEnv) -> np.ndarray:
+    """
+    The average value of every policy under each component of a vector-valued reward gradient_fun(state, action),
+    such as declared reward features, as an array of shape (num_policies, reward_size). Since policy values are
+    linear in the reward, this is the Jacobian of the policy values wherever gradient_fun is the reward's gradient.
+    """
+    if isinstance(policies, np.ndarray):
+        gradient_table = np.array([gradient_fun(state, action)
+                                   for state in range(env.num_states)
+                                   for action in range(env.num_actions)], dtype=float).reshape(-1, reward_size)
+        return env.get_action_table_occupancy(policies) @ gradient_table
+
+    gradient_values = np.empty((len(policies), reward_size))
+    for k in range(reward_size):
+        gradient_values[:, k] = env.get_all_average_policy_values(
+            policy_permutation=tuple(policies),
+            reward_fun=lambda state, action: gradient_fun(state, action)[k])
+    return gradient_values
+
+
+def get_policy_value_jacobian(policies: tuple[Policy],
+                              make_reward_fun: Callable,
+                              env: MDPWithoutRewardEnv,
+                              decision_vars: np.ndarray) -> np.ndarray:
+    """
+    The Jacobian of the policy values with respect to the decision variables, of shape (num_policies, reward_size),
+    for a make_reward_fun that declares its features or Jacobian
+    """
+    gradient_fun = get_reward_features(make_reward_fun)
+    if gradient_fun is None:
+        gradient_fun = make_reward_fun.reward_jacobian(decision_vars)
+    return get_policy_gradient_values(policies, gradient_fun, len(decision_vars), env)
+
+
+def check_linear_reward_parameterization(policies: list[Policy],
+                                         make_reward_fun: Callable,
+                                         reward_size: int,
+                                         env: MDPWithoutRewardEnv,
+                                         feature_values: np.ndarray,
+                                         num_checks: int = 3,
+                                         seed: int = 0) -> bool:
+    """
+    Check at a few random decision variables that the policy values are given by feature_values.
+    """
+    rng = np.random.default_rng(seed)
+    for _ in range(num_checks):
+        decision_vars = rng.normal(size=reward_size)
+        values = env.get_all_average_policy_values(policy_permutation=_as_policy_tuple(policies),
+                                                   reward_fun=make_reward_fun(decision_vars))
+        if not np.allclose(values, feature_values @ decision_vars):
+            return False
+    return True
+
+
+def check_reward_features(policies: list[Policy],
+                          make_reward_fun: Callable,
+                          reward_size: int,
+                          env: MDPWithoutRewardEnv,
+                          num_checks: int = 10,
+                          seed: int = 0) -> bool:
+    """
+    Check at a random decision variable vector, and at the actions a few random policies take in a few random
+    states, that make_reward_fun agrees with its declared features, ie. that make_reward_fun(decision_vars)(state,
+    action) is their dot product. The policies can also be an action table (see policy_space).
+    """
+    features = get_reward_features(make_reward_fun)
+    rng = np.random.default_rng(seed)
+    decision_vars = rng.normal(size=reward_size)
+    reward_fun = make_reward_fun(decision_vars)
+    for _ in range(num_checks if len(policies) else 0):
+        state, k = int(rng.integers(env.num_states)), int(rng.integers(len(policies)))
+        action = int(policies[k, state]) if isinstance(policies, np.ndarray) else policies[k](state)
+        if not np.isclose(reward_fun(state, action), np.asarray(features(state, action), dtype=float) @ decision_vars):
+            return False
+    return True
+
+
+def _make_feature_constraint_matrices(feature_values: dict,
+                                      policy_permutation: tuple[Policy],
+                                      adjacent_policy_relations: list[int],
+                                      policies_above: tuple[Policy] = ()):
+    return make_linear_constraint_matrices(np.array([feature_values[policy] for policy in policy_permutation]),
+                                           adjacent_policy_relations,
+                                           np.array([feature_values[policy] for policy in policies_above]))
+
+
+def make_linear_constraint_matrices(permutation_feature_values: np.ndarray,
+                                    adjacent_policy_relations: list[int],  # 0: equality, 1: inequality, 2: unspecified
+                                    above_feature_values: Optional[np.ndarray] = None):
+    """
+    Build the constraints of ineq_constraints and eq_constraints as matrices, for use with scipy's linprog.
+    The feature values are those of the policies in the permutation, in order (and of the policies_above).
+    Returns (A_ub, b_ub, A_eq, b_eq) such that A_ub @ x <= b_ub and A_eq @ x == b_eq.
+    """
+    relations = np.asarray(adjacent_policy_relations, dtype=int).reshape(-1)
+    differences = permutation_feature_values[1:] - permutation_feature_values[:-1]
+    strict_differences = differences[relations == 1]
+    if above_feature_values is not None and len(above_feature_values):
+        strict_differences = np.concatenate([strict_differences,
+                                             above_feature_values - permutation_feature_values[-1]])
+
+    # The inequalities are value[i] - value[i - 1] >= epsilon, so negate them to get <= form
+    A_ub = -strict_differences
+    b_ub = np.full(len(A_ub), -EPSILON)
+    A_eq = differences[relations == 0]
+    b_eq = np.zeros(len(A_eq))
+
+    return A_ub, b_ub, A_eq, b_eq
@@ -1,28 +1,273 @@
 # (c) 2022 Nikolaus Howe
+import collections
 import dataclasses
+import mmap
 import numpy as np
 
-from typing import Callable
+from typing import Callable, Optional
 
-from policy import Policy
+from instrumentation import get_instrumentation
+from policy import Policy, TabularPolicy
 
 POLICY_EVAL_HORIZON = 200  # how far in the future to calculate discounted rewards
+POLICY_EVALUATION_MODES = ("recursive", "closed_form", "occupancy")
+OCCUPANCY_CACHE_SIZE = 4096  # how many policies' occupancy vectors to keep around
+TRANSITION_CHUNK_BYTES = 2 ** 26  # roughly how much memory gathered stochastic transition matrices may use at once
+BELLMAN_TOLERANCE = 1e-10  # Bellman sweeps over sparse transitions stop once they change the values by less than this
+
+
+def solve_discounted_values(transition_matrix: np.ndarray, rewards: np.ndarray, discount: float,
+                            horizon: int = POLICY_EVAL_HORIZON, tolerance: float = BELLMAN_TOLERANCE) -> np.ndarray:
+    """
+    Solve for the discounted (horizon-truncated) values of a fixed policy, given its state transition
+    matrix P and the reward it gets in each state (rewards can also have one column per reward function).
+
+    For discount < 1 we solve (I - discount * P) V = (I - (discount * P)^horizon) R directly, which
+    gives the same numbers as the recursive evaluation up to floating point error. For discount >= 1
+    the system is singular, so we fall back to horizon Bellman backups. A scipy.sparse P is never made
+    dense, see sweep_discounted_values.
+    """
+    if not isinstance(transition_matrix, np.ndarray):
+        return sweep_discounted_values(transition_matrix, rewards, discount, horizon, tolerance)
+
+    discounted_transitions = discount * transition_matrix
+    if discount < 1:
+        truncated = np.linalg.matrix_power(discounted_transitions, horizon) @ rewards
+        return np.linalg.solve(np.eye(transition_matrix.shape[0]) - discounted_transitions, rewards - truncated)
+
+    values = np.zeros_like(rewards, dtype=float)
+    for _ in range(horizon):
+        values = rewards + discounted_transitions @ values
+    return values
+
+
+def sweep_discounted_values(transition_matrix, rewards: np.ndarray, discount: float,
+                            horizon: int = POLICY_EVAL_HORIZON, tolerance: float = BELLMAN_TOLERANCE) -> np.ndarray:
+    """
+    solve_discounted_values by Bellman sweeps V <- R + discount * P V, which only take sparse matrix-vector
+    products, so they scale to transition matrices far too large to be dense. Each sweep adds the next term
+    of the horizon-truncated sum, and they stop early once a sweep changes the values by at most tolerance.
+    """
+    rewards = np.asarray(rewards, dtype=float)
+    values = rewards.copy()
+    term = rewards
+    for _ in range(horizon - 1):
+        term = discount * (transition_matrix @ term)
+        values += term
+        if np.abs(term).max(initial=0) <= tolerance:
+            break
+    return values
+
+
+@dataclasses.dataclass(frozen=True)
+class MappedArray(object):
+    """
+    Where an array that is memory-mapped from a file lives in it, to pickle the array as a reference to the file
+    """
+    filename: str
+    offset: int
+    dtype: str
+    shape: tuple[int, ...]
+    order: str
+
+    @classmethod
+    def from_array(cls, array: np.ndarray) -> Optional["MappedArray"]:
+        # Find the memmap that owns the mapping (slices of a memmap keep its offset, so it can't be trusted)
+        root = array
+        while isinstance(root.base, np.ndarray):
+            root = root.base
+        if not isinstance(root, np.memmap) or not isinstance(root.base, mmap.mmap) or root.filename is None:
+            return None
+        if array.flags.c_contiguous:
+            order = "C"
+        elif array.flags.f_contiguous:
+            order = "F"
+        else:
+            return None
+        start = array.__array_interface__["data"][0] - root.__array_interface__["data"][0]
+        return cls(root.filename, root.offset + start, array.dtype.str, array.shape, order)
+
+    def open(self) -> np.memmap:
+        return np.memmap(self.filename, dtype=self.dtype, mode="r", offset=self.offset, shape=self.shape,
+                         order=self.order)
+
+
+def _pickle_transitions(transitions):
+    # Memory-mapped transitions (or the arrays of sparse ones) are pickled as references to their file, so that
+    # sending the env to worker processes doesn't copy them
+    if transitions is None:
+        return None
+    if is_sparse_matrix(transitions):
+        arrays = [MappedArray.from_array(array) or array
+                  for array in (transitions.data, transitions.indices, transitions.indptr)]
+        return "csr", arrays, transitions.shape
+    return "dense", MappedArray.from_array(transitions) or transitions
+
+
+def _unpickle_transitions(state):
+    if state is None:
+        return None
+    if state[0] == "csr":
+        import scipy.sparse
+
+        _, arrays, shape = state
+        arrays = [array.open() if isinstance(array, MappedArray) else array for array in arrays]
+        return scipy.sparse.csr_matrix(tuple(arrays), shape=shape, copy=False)
+    return state[1].open() if isinstance(state[1], MappedArray) else state[1]
+
+
+def is_sparse_matrix(matrix) -> bool:
+    # Anything that isn't an array is taken to be from scipy.sparse, which is only imported when it is used
+    return matrix is not None and not isinstance(matrix, np.ndarray)
 
 
 @dataclasses.dataclass
 class MDPWithoutRewardEnv(object):
     """
     Used to store some simple MDP elements
+
+    The dynamics are either a function dynamics(state=..., action=...) giving the next state, or an array of
+    transitions (eg. memory-mapped from a file, see mdp_files.load_mdp): a (num_states, num_actions) table of
+    next states, or a stochastic (num_states, num_actions, num_states) array of next state probabilities, which
+    can't be evaluated recursively. Large stochastic MDPs can instead give a scipy.sparse (CSR) matrix of shape
+    (num_states * num_actions, num_states), whose row state * num_actions + action holds the next state
+    probabilities; policies are then evaluated by Bellman sweeps to within bellman_tolerance, without dense
+    matrices. In either case num_states and num_actions come from the shape of the transitions. Average values
+    are over the initial_distribution of start states, uniform by default.
     """
-    dynamics: Callable
+    dynamics: Optional[Callable]
     discount: float
     num_states: int = 2
     num_actions: int = 2
     require_nonnegative_reward: bool = False
+    policy_evaluation: str = "recursive"  # "recursive", "closed_form" or "occupancy"
+    occupancy_cache_size: int = OCCUPANCY_CACHE_SIZE
+    bellman_tolerance: float = BELLMAN_TOLERANCE
+    transitions: Optional[np.ndarray] = dataclasses.field(default=None, repr=False, compare=False)
+    initial_distribution: Optional[np.ndarray] = dataclasses.field(default=None, repr=False, compare=False)
+    _next_state_table: Optional[np.ndarray] = dataclasses.field(default=None, init=False, repr=False, compare=False)
+    _occupancy_cache: collections.OrderedDict = dataclasses.field(default_factory=collections.OrderedDict,
+                                                                 init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self.policy_evaluation not in POLICY_EVALUATION_MODES:
+            raise ValueError(f"Unknown policy evaluation mode {self.policy_evaluation}, "
+                             f"expected one of {POLICY_EVALUATION_MODES}")
+        if self.dynamics is None and self.transitions is None:
+            raise ValueError("The env needs either dynamics or transitions")
+
+        if is_sparse_matrix(self.transitions):
+            self.transitions = self.transitions.tocsr()
+            num_rows, self.num_states = self.transitions.shape
+            if self.num_states == 0 or num_rows % self.num_states != 0:
+                raise ValueError(f"Sparse transitions have to be of shape (num_states * num_actions, num_states), "
+                                 f"not {self.transitions.shape}")
+            if self.policy_evaluation == "recursive":
+                raise ValueError("Stochastic transitions need closed_form or occupancy policy evaluation")
+            self.num_actions = num_rows // self.num_states
+        elif self.transitions is not None:
+            if self.transitions.ndim == 2:
+                if not np.issubdtype(self.transitions.dtype, np.integer):
+                    raise ValueError(f"A next state table has to be of integers, not {self.transitions.dtype}")
+                self._next_state_table = self.transitions
+            elif self.transitions.ndim != 3 or self.transitions.shape[2] != self.transitions.shape[0]:
+                raise ValueError(f"Transitions have to be of shape (num_states, num_actions) or "
+                                 f"(num_states, num_actions, num_states), not {self.transitions.shape}")
+            elif self.policy_evaluation == "recursive":
+                raise ValueError("Stochastic transitions need closed_form or occupancy policy evaluation")
+            self.num_states, self.num_actions = self.transitions.shape[:2]
+
+        if self.initial_distribution is not None:
+            self.initial_distribution = np.asarray(self.initial_distribution, dtype=float)
+            if self.initial_distribution.shape != (self.num_states,):
+                raise ValueError(f"The initial distribution has to be of shape ({self.num_states},)")
+            if (self.initial_distribution < 0).any() or not np.isclose(self.initial_distribution.sum(), 1):
+                raise ValueError("The initial distribution has to be nonnegative and sum to 1")
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["transitions"] = _pickle_transitions(self.transitions)
+        if self.transitions is not None:
+            state["_next_state_table"] = None  # it is the transitions, and is set again when unpickling
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.transitions = _unpickle_transitions(state["transitions"])
+        if self.transitions is not None and not self.is_stochastic:
+            self._next_state_table = self.transitions
+
+    @property
+    def is_stochastic(self) -> bool:
+        return self.transitions is not None and (self.is_sparse or self.transitions.ndim == 3)
+
+    @property
+    def is_sparse(self) -> bool:
+        return is_sparse_matrix(self.transitions)
+
+    def get_initial_distribution(self) -> np.ndarray:
+        if self.initial_distribution is None:
+            return np.full(self.num_states, 1 / self.num_states)
+        return self.initial_distribution
 
     # def get_discounted_state_action_occupancy(self, state: int, ):
     #     occupancy_matrix = np.zeros((self.num_states, self.num_actions))
 
+    def get_next_state_table(self) -> np.ndarray:
+        """
+        Tabulate the dynamics into a (num_states, num_actions) array of next states.
+        This is only done once per environment.
+        """
+        if self.is_stochastic:
+            raise ValueError("There is no table of next states with stochastic transitions")
+        if self._next_state_table is None:
+            table = np.empty((self.num_states, self.num_actions), dtype=np.int64)
+            for state in range(self.num_states):
+                for action in range(self.num_actions):
+                    table[state, action] = self.dynamics(state=state, action=action)
+            self._next_state_table = table
+        return self._next_state_table
+
+    def get_next_state(self, state: int, action) -> int:
+        # Integer actions go through the table, anything else (eg. the cleaning robot's tuples) through the dynamics
+        if self.is_stochastic:
+            raise ValueError("There is no single next state with stochastic transitions")
+        if isinstance(action, (int, np.integer)) and 0 <= action < self.num_actions:
+            return int(self.get_next_state_table()[state, action])
+        if self.dynamics is None:
+            raise ValueError(f"Action {action} is not in the transition table, and there are no dynamics to call")
+        return int(self.dynamics(state=state, action=action))
+
+    def get_policy_actions(self, policy_fun: Policy):
+        # A tabular policy hands over its whole array of actions, rather than being called state by state
+        if isinstance(policy_fun, TabularPolicy) and policy_fun.actions.shape == (self.num_states,):
+            return policy_fun.actions
+        return [policy_fun(state) for state in range(self.num_states)]
+
+    def get_policy_transition_matrix(self, policy_fun: Policy) -> np.ndarray:
+        actions = self.get_policy_actions(policy_fun)
+        if self.is_sparse:
+            return self.transitions[np.arange(self.num_states) * self.num_actions + np.asarray(actions)]
+        if self.is_stochastic:
+            return np.asarray(self.transitions[np.arange(self.num_states), np.asarray(actions)], dtype=float)
+
+        transition_matrix = np.zeros((self.num_states, self.num_states))
+        for state, action in enumerate(actions):
+            transition_matrix[state, self.get_next_state(state, action)] = 1.
+        return transition_matrix
+
+    def get_policy_reward_vector(self, policy_fun: Policy, reward_fun: Callable) -> np.ndarray:
+        return np.array([reward_fun(state, policy_fun(state)) for state in range(self.num_states)], dtype=float)
+
+    def get_closed_form_policy_values(self, policy_fun: Policy, reward_fun: Callable) -> np.ndarray:
+        """
+        Get the value of the policy from every state, without recursing through the dynamics
+        """
+        return solve_discounted_values(transition_matrix=self.get_policy_transition_matrix(policy_fun),
+                                       rewards=self.get_policy_reward_vector(policy_fun, reward_fun),
+                                       discount=self.discount,
+                                       tolerance=self.bellman_tolerance)
+
     def get_policy_value_with_counter(self, state: int, policy_fun: Policy, reward_fun: Callable, counter):
         if counter > 0:
             action = policy_fun(state)
@@ -31,14 +276,137 @@ class MDPWithoutRewardEnv(object):
             # print("reward_fun", reward_fun(state, action))
             return reward_fun(state, action) \
                    + self.discount * self.get_policy_value_with_counter(policy_fun=policy_fun,
-                                                                        state=self.dynamics(state=state, action=action),
+                                                                        state=self.get_next_state(state, action),
                                                                         reward_fun=reward_fun,
                                                                         counter=counter - 1)
         else:
             return 0
 
+    def get_discounted_occupancy(self, policy_fun: Policy) -> np.ndarray:
+        """
+        Get the discounted state-action occupancy of the policy (averaged over start states), flattened
+        to a (num_states * num_actions) vector, so that the policy's average value under a tabular
+        reward is a dot product. The vectors are cached per policy, least recently used first out.
+        """
+        if policy_fun in self._occupancy_cache:
+            self._occupancy_cache.move_to_end(policy_fun)
+            return self._occupancy_cache[policy_fun]
+
+        actions = self.get_policy_actions(policy_fun)
+        for action in actions:
+            if not isinstance(action, (int, np.integer)) or not 0 <= action < self.num_actions:
+                raise ValueError(f"Occupancy measures need integer actions in [0, {self.num_actions}), "
+                                 f"but {policy_fun} takes action {action}")
+
+        # The discounted state visitation is the transposed system, started from the initial distribution
+        state_occupancy = solve_discounted_values(transition_matrix=self.get_policy_transition_matrix(policy_fun).T,
+                                                  rewards=self.get_initial_distribution(),
+                                                  discount=self.discount,
+                                                  tolerance=self.bellman_tolerance)
+        occupancy = np.zeros(self.num_states * self.num_actions)
+        occupancy[np.arange(self.num_states) * self.num_actions + np.array(actions)] = state_occupancy
+
+        self._occupancy_cache[policy_fun] = occupancy
+        if len(self._occupancy_cache) > self.occupancy_cache_size:
+            self._occupancy_cache.popitem(last=False)
+        return occupancy
+
+    def get_action_table_occupancy(self, action_table: np.ndarray) -> np.ndarray:
+        """
+        get_discounted_occupancy for a whole table of deterministic policies at once, given as an integer array
+        of shape (num_policies, num_states) with the action each policy takes in each state. Since the next
+        state is fixed, the state distributions are pushed forward for the whole horizon with one bincount
+        per step, rather than solving a linear system per policy. Returns (num_policies, num_states * num_actions).
+        """
+        action_table = np.asarray(action_table)
+        if action_table.size > 0 and (action_table.min() < 0 or action_table.max() >= self.num_actions):
+            raise ValueError(f"Occupancy measures need integer actions in [0, {self.num_actions})")
+        num_policies = len(action_table)
+        get_instrumentation().count("occupancy_computations", num_policies)
+        if self.is_sparse:
+            state_occupancy = self._get_sparse_state_occupancy(action_table)
+        elif self.is_stochastic:
+            state_occupancy = self._get_stochastic_state_occupancy(action_table)
+        else:
+            state_occupancy = self._get_deterministic_state_occupancy(action_table)
+
+        occupancy = np.zeros((num_policies, self.num_states * self.num_actions))
+        columns = np.arange(self.num_states) * self.num_actions + action_table
+        np.put_along_axis(occupancy, columns, state_occupancy, axis=1)
+        return occupancy
+
+    def _get_deterministic_state_occupancy(self, action_table: np.ndarray) -> np.ndarray:
+        num_policies = len(action_table)
+        # Next states of all the policies, offset so that every policy has its own block of states
+        next_states = self.get_next_state_table()[np.arange(self.num_states), action_table]
+        next_states = (next_states + np.arange(num_policies)[:, None] * self.num_states).reshape(-1)
+
+        distribution = np.tile(self.get_initial_distribution(), num_policies)
+        state_occupancy = np.zeros(num_policies * self.num_states)
+        weight = 1.
+        for _ in range(POLICY_EVAL_HORIZON):
+            state_occupancy += weight * distribution
+            weight *= self.discount
+            if weight == 0:
+                break
+            distribution = np.bincount(next_states, weights=distribution, minlength=len(distribution))
+        return state_occupancy.reshape(num_policies, self.num_states)
+
+    def _get_sparse_state_occupancy(self, action_table: np.ndarray) -> np.ndarray:
+        # One policy at a time, since each sweep is a sparse product with that policy's own transitions
+        state_occupancy = np.zeros((len(action_table), self.num_states))
+        for i, actions in enumerate(action_table):
+            transition_matrix = self.transitions[np.arange(self.num_states) * self.num_actions + actions]
+            state_occupancy[i] = sweep_discounted_values(transition_matrix.T, self.get_initial_distribution(),
+                                                         self.discount, tolerance=self.bellman_tolerance)
+        return state_occupancy
+
+    def _get_stochastic_state_occupancy(self, action_table: np.ndarray) -> np.ndarray:
+        # Gather each policy's (num_states, num_states) transition matrix from the (possibly memory-mapped)
+        # transitions, a chunk of policies at a time, and push the state distributions forward through them
+        state_occupancy = np.zeros((len(action_table), self.num_states))
+        chunk_size = max(1, TRANSITION_CHUNK_BYTES // (8 * self.num_states ** 2))
+        for start in range(0, len(action_table), chunk_size):
+            actions = action_table[start:start + chunk_size]
+            transition_matrices = np.asarray(self.transitions[np.arange(self.num_states), actions], dtype=float)
+            distribution = np.tile(self.get_initial_distribution(), (len(actions), 1))
+            weight = 1.
+            for _ in range(POLICY_EVAL_HORIZON):
+                state_occupancy[start:start + len(actions)] += weight * distribution
+                weight *= self.discount
+                if weight == 0:
+                    break
+                distribution = np.einsum("ps,pst->pt", distribution, transition_matrices)
+        return state_occupancy
+
+    def get_occupancy_matrix(self, policies) -> np.ndarray:
+        # Policies can also be given as an action table, see get_action_table_occupancy
+        if isinstance(policies, np.ndarray):
+            return self.get_action_table_occupancy(policies)
+        return np.stack([self.get_discounted_occupancy(policy_fun) for policy_fun in policies])
+
+    def get_tabular_reward(self, reward_fun: Callable[[int, int], float]) -> np.ndarray:
+        return np.array([reward_fun(state, action)
+                         for state in range(self.num_states)
+                         for action in range(self.num_actions)], dtype=float)
+
+    def get_all_average_policy_values_from_rewards(self, policies: tuple[Policy],
+                                                   reward_vectors: np.ndarray) -> np.ndarray:
+        """
+        Evaluate all the policies under a flattened tabular reward of shape (num_states * num_actions),
+        or under a whole batch of them of shape (batch_size, num_states * num_actions), in one
+        matrix product. Returns an array of shape (num_policies) or (batch_size, num_policies).
+        """
+        reward_vectors = np.asarray(reward_vectors, dtype=float)
+        num_rewards = len(reward_vectors) if reward_vectors.ndim > 1 else 1
+        get_instrumentation().count("policy_evaluations", len(policies) * num_rewards)
+        return reward_vectors @ self.get_occupancy_matrix(policies).T
+
     def get_policy_value(self, policy_fun, state, reward_fun):
-        if self.discount == 0:  # single step case
+        get_instrumentation().count("policy_evaluations")
+        if self.policy_evaluation in ("closed_form", "occupancy"):
+            return self.get_closed_form_policy_values(policy_fun, reward_fun)[state]
+        elif self.discount == 0:  # single step case
             return reward_fun(state, policy_fun(state))
         else:
             return self.get_policy_value_with_counter(state=state,
@@ -47,16 +415,31 @@ class MDPWithoutRewardEnv(object):
                                                       counter=POLICY_EVAL_HORIZON)
 
     def get_average_policy_value(self, policy_fun, reward_fun):
-        total = 0
-        for i in range(self.num_states):
-            total += self.get_policy_value_with_counter(policy_fun=policy_fun,
-                                                        state=i,
-                                                        reward_fun=reward_fun,
-                                                        counter=POLICY_EVAL_HORIZON)
-        return total / self.num_states
+        get_instrumentation().count("policy_evaluations")
+        if self.policy_evaluation == "closed_form":
+            values = self.get_closed_form_policy_values(policy_fun, reward_fun)
+            return values.mean() if self.initial_distribution is None else values @ self.initial_distribution
+        elif self.policy_evaluation == "occupancy":
+            return self.get_discounted_occupancy(policy_fun) @ self.get_tabular_reward(reward_fun)
+
+        values = [self.get_policy_value_with_counter(policy_fun=policy_fun,
+                                                     state=i,
+                                                     reward_fun=reward_fun,
+                                                     counter=POLICY_EVAL_HORIZON) for i in range(self.num_states)]
+        if self.initial_distribution is not None:
+            return np.dot(values, self.initial_distribution)
+        return sum(values) / self.num_states
 
     def get_all_average_policy_values(self, policy_permutation: tuple[Policy],
                                       reward_fun: Callable[[int, int], float]):
+        # A table of deterministic policies (see policy_space) is evaluated all at once, whatever the mode
+        if isinstance(policy_permutation, np.ndarray):
+            return self.get_all_average_policy_values_from_rewards(policy_permutation,
+                                                                   self.get_tabular_reward(reward_fun))
+        if self.policy_evaluation == "occupancy":
+            return list(self.get_all_average_policy_values_from_rewards(policy_permutation,
+                                                                        self.get_tabular_reward(reward_fun)))
+
         res = []
         for policy_fun in policy_permutation:
             res.append(self.get_average_policy_value(policy_fun, reward_fun))
@@ -0,0 +1,164 @@
+# (c) 2022 Nikolaus Howe
+import contextlib
+import dataclasses
+import functools
+import numpy as np
+import statistics
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional
+
+from environment import MDPWithoutRewardEnv
+from gameability import check_gameable_batch
+from instrumentation import ProgressTracker, get_instrumentation
+from parallel import CHUNKS_PER_WORKER, parallel_map
+from policy import Policy
+from sampling import sample_reward_vectors
+import constraints
+
+ESTIMATION_BATCH_SIZE = 10_000  # how many true rewards each batch draws and checks at once
+CONFIDENCE_LEVEL = 0.95
+
+
+def wilson_interval(num_successes: int, num_samples: int, confidence_level: float = CONFIDENCE_LEVEL):
+    """
+    Wilson score interval for a binomial proportion, which (unlike the normal approximation) behaves
+    well when the proportion is close to 0 or 1
+    """
+    if num_samples == 0:
+        return 0., 1.
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence_level / 2)
+    proportion = num_successes / num_samples
+    denominator = 1 + z ** 2 / num_samples
+    centre = (proportion + z ** 2 / (2 * num_samples)) / denominator
+    spread = z * np.sqrt(proportion * (1 - proportion) / num_samples + z ** 2 / (4 * num_samples ** 2))
+    half_width = spread / denominator
+    return max(0., float(centre - half_width)), min(1., float(centre + half_width))
+
+
+@dataclasses.dataclass
+class GameabilityEstimate(object):
+    """
+    Running estimate of the probability that a proxy reward is gameable with respect to a random true reward
+    """
+    num_gameable: int = 0
+    num_samples: int = 0
+    confidence_level: float = CONFIDENCE_LEVEL
+
+    @property
+    def probability(self) -> float:
+        return self.num_gameable / self.num_samples if self.num_samples > 0 else float("nan")
+
+    @property
+    def interval(self) -> tuple[float, float]:
+        return wilson_interval(self.num_gameable, self.num_samples, self.confidence_level)
+
+    @property
+    def half_width(self) -> float:
+        low, high = self.interval
+        return (high - low) / 2
+
+    def update(self, num_gameable: int, num_samples: int) -> None:
+        self.num_gameable += int(num_gameable)
+        self.num_samples += int(num_samples)
+
+
+def _count_gameable(policies: list[Policy],
+                    proxy_reward: np.ndarray,
+                    feature_values: np.ndarray,
+                    sample_true_rewards: Callable[[np.random.Generator, int], np.ndarray],
+                    batch: tuple[np.random.SeedSequence, int]) -> int:
+    seed_sequence, batch_size = batch
+    true_rewards = sample_true_rewards(np.random.default_rng(seed_sequence), batch_size)
+    result = check_gameable_batch(policies, proxy_reward, true_rewards, make_reward_fun=None,
+                                  reward_size=len(proxy_reward), env=None, feature_values=feature_values)
+    return int(result.gameable.sum())
+
+
+_worker_count_gameable = None  # set in each worker process of a parallel estimate, see _set_worker_count_gameable
+
+
+def _set_worker_count_gameable(count_gameable: Callable[[tuple[np.random.SeedSequence, int]], int]) -> None:
+    global _worker_count_gameable
+    _worker_count_gameable = count_gameable
+
+
+def _count_gameable_in_worker(batch: tuple[np.random.SeedSequence, int]) -> int:
+    return _worker_count_gameable(batch)
+
+
+def estimate_gameability_probability(policies: list[Policy],
+                                     proxy_reward: np.ndarray,
+                                     make_reward_fun: Callable,
+                                     reward_size: int,
+                                     env: MDPWithoutRewardEnv,
+                                     sample_true_rewards: Optional[Callable[[np.random.Generator, int],
+                                                                            np.ndarray]] = None,
+                                     max_samples: int = 1_000_000,
+                                     target_half_width: Optional[float] = None,
+                                     confidence_level: float = CONFIDENCE_LEVEL,
+                                     batch_size: int = ESTIMATION_BATCH_SIZE,
+                                     seed: Optional[int] = 0,
+                                     workers: Optional[int] = None) -> GameabilityEstimate:
+    """
+    Estimate how likely the proxy reward is to be gameable (in the sense of gameability.check_gameable) with
+    respect to a true reward drawn by sample_true_rewards(rng, num_samples), which returns decision variables
+    of shape (num_samples, reward_size). By default these are standard normal, or their absolute values if the
+    env requires nonnegative rewards. make_reward_fun has to be linear in its decision variables.
+
+    True rewards are drawn in batches of batch_size, and the estimate stops as soon as the half width of its
+    confidence interval is at most target_half_width, or after max_samples. Each batch has its own seed
+    spawned from seed, so the result only depends on the seed and the batch size, not on the number of workers.
+    With workers > 1 the batches are spread across a process pool, so sample_true_rewards needs to be picklable.
+    The pool is started once for the whole estimate, and is sent the policies and feature values only once.
+    """
+    feature_values = constraints.get_policy_feature_values(policies=policies,
+                                                           make_reward_fun=make_reward_fun,
+                                                           reward_size=reward_size,
+                                                           env=env)
+    if not constraints.check_linear_reward_parameterization(policies=policies,
+                                                            make_reward_fun=make_reward_fun,
+                                                            reward_size=reward_size,
+                                                            env=env,
+                                                            feature_values=feature_values):
+        raise ValueError("Gameability estimation needs make_reward_fun to be linear in its decision variables")
+
+    if sample_true_rewards is None:
+        sample_true_rewards = functools.partial(sample_reward_vectors, reward_size=reward_size,
+                                                require_nonnegative_reward=env.require_nonnegative_reward)
+    count_gameable = functools.partial(_count_gameable, policies, np.asarray(proxy_reward, dtype=float),
+                                       feature_values, sample_true_rewards)
+
+    # When parallel, a round of batches is run at once, but whether to stop is still decided after each batch
+    # in order (ignoring any later batches of the round), so that the result doesn't depend on the workers
+    batches_per_round = 1 if workers is None or workers <= 1 else workers * CHUNKS_PER_WORKER
+    seed_sequence = np.random.SeedSequence(seed)
+    estimate = GameabilityEstimate(confidence_level=confidence_level)
+    progress = ProgressTracker("estimate_gameability_probability", max_samples)
+    instrumentation = get_instrumentation()
+
+    executor = None
+    if batches_per_round > 1:
+        executor = ProcessPoolExecutor(workers, initializer=_set_worker_count_gameable, initargs=(count_gameable,))
+        count_gameable = _count_gameable_in_worker
+
+    done = False
+    with contextlib.nullcontext() if executor is None else executor:
+        while not done and estimate.num_samples < max_samples:
+            batches = []
+            num_planned = estimate.num_samples
+            while len(batches) < batches_per_round and num_planned < max_samples:
+                batches.append((seed_sequence.spawn(1)[0], min(batch_size, max_samples - num_planned)))
+                num_planned += batches[-1][1]
+
+            for (_, num_samples), num_gameable in zip(batches, parallel_map(count_gameable, batches, workers=workers,
+                                                                           chunksize=1, executor=executor)):
+                estimate.update(num_gameable, num_samples)
+                progress(estimate.num_samples)
+                instrumentation.emit("gameability_estimate", num_samples=estimate.num_samples,
+                                     probability=estimate.probability, interval=estimate.interval)
+                if target_half_width is not None and estimate.half_width <= target_half_width:
+                    done = True
+                    break
+
+    return estimate
@@ -1,10 +1,13 @@
 # (c) 2022 Nikolaus Howe
+import numpy as np
+
+from constraints import declare_reward_features
 from environment import MDPWithoutRewardEnv
-from gameability import remove_equivalent_orderings, check_ungameable, make_ungameability_graph
+from gameability import get_ungameable_pairs, make_ungameability_graph
 from permutations import calculate_achievable_permutations
 from policy import make_cleaning_policy
 from policy_ordering import run_full_ordering_search
-from simplification import check_simplification, make_simplification_graph
+from simplification import get_simplification_pairs, make_simplification_graph
 
 REWARD_SIZE = 3  # three rooms, so three reward components
 SEARCH_STEPS = 2000
@@ -20,7 +23,13 @@ def cleaning_dynamics(state, action):
     return 0
 
 
-# Make a reward function from decision variables
+# Make a reward function from decision variables, which is linear in the rooms each action cleans
+def room_features(state, action):
+    del state
+    return np.asarray(action, dtype=float)
+
+
+@declare_reward_features(room_features)
 def make_reward_fun(rewards):
     def reward_fun(state, action):
         del state
@@ -64,32 +73,16 @@ def run_cleaning_robot_experiment():
                                                                    reward_size=REWARD_SIZE,
                                                                    env=cleaning_env)
 
-    # Remove equivalent orderings
-    orderings_and_relations = remove_equivalent_orderings(set(successful_orderings_with_relations))
+    # The search only returns one of each group of equivalent orderings, so there is nothing to remove
+    orderings_and_relations = set(successful_orderings_with_relations)
 
     # Get ungameable pairs
-    ungameable_pairs = set()
-    for i, ordering_and_relation1 in enumerate(orderings_and_relations):
-        for j, ordering_and_relation2 in enumerate(orderings_and_relations):
-            if i == j:
-                continue
-
-            if check_ungameable(ordering_and_relation1, ordering_and_relation2):
-                ungameable_pairs.add((ordering_and_relation1, ordering_and_relation2))
-
-    make_ungameability_graph(list(ungameable_pairs))
+    ungameable_pairs = get_ungameable_pairs(list(orderings_and_relations))
+    make_ungameability_graph(ungameable_pairs)
 
     # Get simplification pairs
-    simplification_pairs = set()
-    for i, ordering_and_relation1 in enumerate(orderings_and_relations):
-        for j, ordering_and_relation2 in enumerate(orderings_and_relations):
-            if i == j:
-                continue
-
-            if check_simplification(ordering_and_relation1, ordering_and_relation2):
-                simplification_pairs.add((ordering_and_relation1, ordering_and_relation2))
-
-    make_simplification_graph(list(simplification_pairs))
+    simplification_pairs = get_simplification_pairs(list(orderings_and_relations))
+    make_simplification_graph(simplification_pairs)
 
 
 if __name__ == '__main__':
@@ -13,13 +13,16 @@ translate = {
 
 
 def check_gameable(first, second):
-    for i, el in enumerate(first):
-        for j, el2 in enumerate(first):
-            if i == j:
-                continue
-            if (el < el2 and second[i] > second[j]) or (el > el2 and second[i] < second[j]):
-                # print(f"{first} and {second} are gameable due to {translate[i]} and {translate[j]}")
-                return True
+    # Sort by the first values (then the second), and go through the groups tied under the first: the pair is
+    # gameable if some policy has a lower second value than a policy strictly below it under the first
+    order = sorted(range(len(first)), key=lambda i: (first[i], second[i]))
+    highest_below = None
+    for _, group in itertools.groupby(order, key=lambda i: first[i]):
+        group = list(group)
+        if highest_below is not None and second[group[0]] < highest_below:
+            return True
+        highest = second[group[-1]]
+        highest_below = highest if highest_below is None else max(highest_below, highest)
     return False
 
 
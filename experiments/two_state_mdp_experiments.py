@@ -1,13 +1,17 @@
 # (c) 2022 Nikolaus Howe
+import numpy as np
+
+from constraints import declare_reward_features
 from environment import MDPWithoutRewardEnv
-from gameability import make_ungameability_graph, check_ungameable, remove_equivalent_orderings
+from gameability import get_ungameable_pairs, make_ungameability_graph
 from permutations import calculate_achievable_permutations
 from policy import Policy, make_two_state_policy
 from policy_ordering import run_adjacent_relation_search, run_full_ordering_search
-from simplification import check_simplification, make_simplification_graph
+from simplification import get_simplification_pairs, make_simplification_graph
 
 REWARD_SIZE = 4  # four (s, a) pairs, different reward for each
 REWARD_SHAPE = (2, 2)
+STATE_REWARD_SIZE = 2  # or only a different reward for each state
 SEARCH_STEPS = 1000
 
 
@@ -21,7 +25,17 @@ def dynamics(state, action):
     return action
 
 
-# Reward is deterministic and depends on state and action
+# Reward is deterministic and depends on state and action, so it is linear in one-hot state-action features
+def state_action_features(state, action):
+    return np.eye(REWARD_SIZE)[np.ravel_multi_index((state, action), REWARD_SHAPE)]
+
+
+def state_features(state, action):
+    del action
+    return np.eye(STATE_REWARD_SIZE)[state]
+
+
+@declare_reward_features(state_action_features)
 def make_reward_fun_from_dec_vars(reward_components):
     # Reward values are first in the decision variable array
     rewards = reward_components.reshape(REWARD_SHAPE)
@@ -32,6 +46,15 @@ def make_reward_fun_from_dec_vars(reward_components):
     return reward_fun
 
 
+@declare_reward_features(state_features)
+def make_state_reward_fun_from_dec_vars(reward_components):
+    def reward_fun(state, action):
+        del action
+        return reward_components[state]
+
+    return reward_fun
+
+
 def fancy_print(perm, relation, reward):
     toprint = []
     for i, p in enumerate(perm):
@@ -88,32 +111,17 @@ def run_two_state_mdp_experiment():
                                                                    reward_size=REWARD_SIZE,
                                                                    env=env)
 
-    # Remove equivalent orderings
-    orderings_and_relations = remove_equivalent_orderings(set(successful_orderings_with_relations))
+    # The search only returns one of each group of equivalent orderings, so there is nothing to remove
+    orderings_and_relations = set(successful_orderings_with_relations)
 
     # Make ungameability graph
-    ungameable_pairs = set()
-    for i, ordering_and_relation1 in enumerate(orderings_and_relations):
-        for j, ordering_and_relation2 in enumerate(orderings_and_relations):
-            if i == j:
-                continue
-
-            if check_ungameable(ordering_and_relation1, ordering_and_relation2):
-                ungameable_pairs.add((ordering_and_relation1, ordering_and_relation2))
-
-    make_ungameability_graph(list(ungameable_pairs))
+    ungameable_pairs = get_ungameable_pairs(list(orderings_and_relations))
+    make_ungameability_graph(ungameable_pairs)
 
     # Make simplification graph
-    simplification_pairs = set()
-    for i, ordering_and_relation1 in enumerate(orderings_and_relations):
-        for j, ordering_and_relation2 in enumerate(orderings_and_relations):
-            if i == j:
-                continue
-
-            if check_simplification(ordering_and_relation1, ordering_and_relation2):
-                simplification_pairs.add((ordering_and_relation1, ordering_and_relation2))
-
-    make_simplification_graph(list(simplification_pairs))
+    # (pass transitive_reduction=True to only draw the simplifications that don't go through another ordering)
+    simplification_pairs = get_simplification_pairs(list(orderings_and_relations))
+    make_simplification_graph(simplification_pairs)
 
 
 if __name__ == "__main__":
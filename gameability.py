@@ -1,14 +1,19 @@
 # 2022 (c) Nikolaus Howe
-import matplotlib
-import matplotlib.pyplot as plt
-import networkx as nx
+import dataclasses
+import numpy as np
 
-from typing import Any, Callable
+from typing import Any, Callable, Iterator, Optional, Sequence
 
+from bitsets import RELATION_ENCODINGS, PairBitsets, iter_bitset_ungameability_chunks, iter_edges
 from environment import MDPWithoutRewardEnv
-from policy import Policy
+import constraints
+from orderings import get_policy_ranks, get_preference_indicators, make_rank_matrix
+from policy import POLICY_TYPES, Policy
 from utils import fancy_str_permutation
 
+UNGAMEABILITY_CHUNK_SIZE = 1024  # how many orderings to compare against all the others at once
+TRUE_REWARD_CHUNK_SIZE = 4096  # how many true rewards to compare a proxy against at once
+
 
 def get_set_representation(ordering, relation):
     list_of_sets = [{ordering[0]}]
@@ -23,15 +28,147 @@ def get_set_representation(ordering, relation):
 
 
 def check_gameable(policy_values_1, policy_values_2):
-    for i, val in enumerate(policy_values_1):
-        for j, val2 in enumerate(policy_values_1):
-            if i == j:
-                continue
-            if (val < val2 and policy_values_2[i] > policy_values_2[j]) \
-                    or (val > val2 and policy_values_2[i] < policy_values_2[j]):
-                # print(f"{first} and {second} are gameable due to {translate[i]} and {translate[j]}")
-                return True
-    return False
+    """
+    Whether there are two policies which the first values rank strictly one way and the second values rank
+    strictly the other way. Policies that are tied under either values are never counted against each other.
+
+    Sorts the policies by their first values (and their second values within ties), so that it only needs to
+    check whether any group of tied policies has a second value below the largest second value seen before it.
+    This takes O(n log n) rather than comparing all pairs.
+    """
+    values_1 = np.asarray(policy_values_1)
+    values_2 = np.asarray(policy_values_2)
+    if len(values_1) < 2:
+        return False
+
+    order = np.lexsort((values_2, values_1))
+    sorted_1, sorted_2 = values_1[order], values_2[order]
+    group_starts = np.flatnonzero(np.concatenate([[True], sorted_1[1:] != sorted_1[:-1]]))
+    if len(group_starts) < 2:
+        return False
+
+    group_minimums = np.minimum.reduceat(sorted_2, group_starts)
+    maximums_so_far = np.maximum.accumulate(sorted_2)
+    return bool((group_minimums[1:] < maximums_so_far[group_starts[1:] - 1]).any())
+
+
+def count_inversions(sequence: np.ndarray) -> int:
+    """
+    The number of pairs i < j with sequence[i] > sequence[j], for a sequence of integers in [0, len(sequence)),
+    by a bottom-up merge sort that merges all the runs of each length at once
+    """
+    num_items = len(sequence)
+    size = 1 << max(0, (num_items - 1).bit_length())
+    merged = np.full(size, num_items, dtype=np.int64)  # the padding is larger than everything, so never inverted
+    merged[:num_items] = sequence
+
+    num_inversions = 0
+    width = 1
+    while width < size:
+        runs = merged.reshape(-1, 2, width)
+        # Shift each pair of runs into its own range, so one searchsorted finds the position within every left run
+        shifts = np.arange(len(runs))[:, None] * (num_items + 1)
+        positions = np.searchsorted((runs[:, 0] + shifts).reshape(-1), (runs[:, 1] + shifts).reshape(-1), side="right")
+        num_not_above = positions - np.repeat(np.arange(len(runs)) * width, width)
+        num_inversions += int((width - num_not_above).sum())
+        merged = np.sort(runs.reshape(-1, 2 * width), axis=1).reshape(-1)
+        width *= 2
+    return num_inversions
+
+
+def count_discordant_pairs(policy_values_1, policy_values_2) -> int:
+    """
+    The number of pairs of policies that check_gameable would count as gameable (unordered, and strictly
+    ordered both times), in O(n log n), like the discordant pair count of Kendall's tau
+    """
+    values_1 = np.asarray(policy_values_1)
+    values_2 = np.asarray(policy_values_2)
+    order = np.lexsort((values_2, values_1))
+    # Policies tied under the first values are sorted by the second, so they never count as inverted
+    _, ranks_2 = np.unique(values_2, return_inverse=True)
+    return count_inversions(ranks_2.reshape(-1)[order])
+
+
+@dataclasses.dataclass
+class GameabilityResult(object):
+    """
+    For each proxy and true reward, whether the pair is gameable, and if so a witness pair of policies
+    (i, j) whose proxy values have i strictly below j but whose true values have i strictly above j.
+    witnesses is (-1, -1) for the ungameable pairs. gameable has shape (num_proxies, num_true) and
+    witnesses (num_proxies, num_true, 2), or without the first axis when a single proxy was given.
+    """
+    gameable: np.ndarray
+    witnesses: np.ndarray
+
+
+def _find_gameable_chunk(proxy_values: np.ndarray, true_values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    check_gameable for one proxy against every row of true values, with a witness pair for each
+    """
+    order = np.argsort(proxy_values, kind="stable")
+    sorted_proxy = proxy_values[order]
+    sorted_true = true_values[:, order]
+    num_true, num_policies = sorted_true.shape
+
+    # Where the group of policies tied under the proxy that each position is in starts
+    new_group = np.concatenate([[True], sorted_proxy[1:] != sorted_proxy[:-1]])
+    group_starts = np.maximum.accumulate(np.where(new_group, np.arange(num_policies), 0))
+
+    # Largest true value (and where it is) among the policies the proxy ranks strictly lower
+    maximums_so_far = np.maximum.accumulate(sorted_true, axis=1)
+    where_maximums = np.maximum.accumulate(np.where(sorted_true == maximums_so_far, np.arange(num_policies), 0), axis=1)
+    before_group = np.maximum(group_starts - 1, 0)
+    maximums_before = np.where(group_starts > 0, maximums_so_far[:, before_group], -np.inf)
+
+    reversed_below = sorted_true < maximums_before
+    gameable = reversed_below.any(axis=1)
+    better = reversed_below.argmax(axis=1)
+    worse = where_maximums[np.arange(num_true), before_group[better]]
+    witnesses = np.where(gameable[:, None], np.stack([order[worse], order[better]], axis=1), -1)
+    return gameable, witnesses
+
+
+def check_gameable_batch(policies: list[Policy],
+                         proxy_rewards: np.ndarray,
+                         true_rewards: np.ndarray,
+                         make_reward_fun: Callable,
+                         reward_size: int,
+                         env: MDPWithoutRewardEnv,
+                         feature_values: Optional[np.ndarray] = None,
+                         chunk_size: int = TRUE_REWARD_CHUNK_SIZE) -> GameabilityResult:
+    """
+    Check every proxy reward against every true reward, given as decision variables of shape (reward_size)
+    or (num_rewards, reward_size). make_reward_fun has to be linear in its decision variables, so that all
+    the policies are evaluated under a whole chunk of true rewards with one matrix product. Policies tied
+    under either reward never make it gameable, as in check_gameable.
+    """
+    if feature_values is None:
+        feature_values = constraints.get_policy_feature_values(policies=policies,
+                                                               make_reward_fun=make_reward_fun,
+                                                               reward_size=reward_size,
+                                                               env=env)
+        if not constraints.check_linear_reward_parameterization(policies=policies,
+                                                                make_reward_fun=make_reward_fun,
+                                                                reward_size=reward_size,
+                                                                env=env,
+                                                                feature_values=feature_values):
+            raise ValueError("Batched gameability checks need make_reward_fun to be linear in its decision variables")
+
+    single_proxy = np.ndim(proxy_rewards) == 1
+    proxy_values = np.atleast_2d(proxy_rewards) @ feature_values.T
+    true_rewards = np.atleast_2d(true_rewards)
+
+    gameable = np.zeros((len(proxy_values), len(true_rewards)), dtype=bool)
+    witnesses = np.full((len(proxy_values), len(true_rewards), 2), -1, dtype=np.int64)
+    for start in range(0, len(true_rewards), chunk_size):
+        true_values = true_rewards[start:start + chunk_size] @ feature_values.T
+        for k, values in enumerate(proxy_values):
+            gameable[k, start:start + len(true_values)], witnesses[k, start:start + len(true_values)] = \
+                _find_gameable_chunk(values, true_values)
+
+    if single_proxy:
+        return GameabilityResult(gameable[0], witnesses[0])
+    return GameabilityResult(gameable, witnesses)
 
 
 def get_policy_values(policies: list[Policy], reward_fun: Callable, env: MDPWithoutRewardEnv):
@@ -52,81 +189,63 @@ def get_ungameable_policies_and_values(policies: list[Policy], reward_fun: Calla
     return gameable_policies
 
 
-def make_ungameability_graph(ungameable_policy_pairs: list[tuple[Any, Any]]):
-    edges = set()
-    nodes = set()
+def make_ungameability_graph(ungameable_policy_pairs: list[tuple[Any, Any]], plot: bool = True,
+                             title: str = "Ungameability Graph",
+                             summary_path: Optional[str] = "Ungameability Graph Summary.json", **plot_options):
+    """
+    Build the ungameability graph as a sparse adjacency matrix over integer ids of the orderings, numbered in the
+    order they first appear in the pairs, and write its summary (see graph_analysis.summarize_graph) to
+    summary_path. If plot, also draw it to {title}.pdf (or another file_format), see graphs.plot_graph for the
+    plot_options (renderer, file_format, layout and export_formats). Returns the adjacency matrix and the summary.
+    """
+    # The graph analysis and plotting layers are only imported here, so that importing this module for the order
+    # relations alone doesn't load scipy.sparse, matplotlib and networkx
+    from graph_analysis import get_edges, make_adjacency_matrix, summarize_graph, write_graph_summary
+    from graphs import plot_graph
+
+    node_ids = {}
+    edges = np.zeros((len(ungameable_policy_pairs), 2), dtype=np.int64)
     print("The ungameable pairs are:")
-    for first, second in ungameable_policy_pairs:
-        edges.add((first, second))
-        nodes.add(first)
-        nodes.add(second)
+    for k, (first, second) in enumerate(ungameable_policy_pairs):
+        edges[k] = node_ids.setdefault(first, len(node_ids)), node_ids.setdefault(second, len(node_ids))
         print(f"{first} and {second}")
 
-    nodes = list(nodes)
+    nodes = list(node_ids)
+    adjacency = make_adjacency_matrix(edges, len(nodes), symmetric=True)
 
-    labels = {}
+    labels = []
     for node in nodes:
-        if type(node[0][0]) == Policy:
-            labels[node] = fancy_str_permutation(*node)
+        if isinstance(node[0][0], POLICY_TYPES):
+            labels.append(fancy_str_permutation(*node))
         else:
-            labels[node] = node
-
-    plot_graph(nodes, edges, labels, title="Ungameability Graph")
-
-
-def plot_graph(nodes, edges, labels, title="Graph"):
-    matplotlib.use("pgf")
-    matplotlib.rcParams.update({
-        "pgf.texsystem": "pdflatex",
-        'font.family': 'serif',
-        'text.usetex': True,
-        'pgf.rcfonts': False,
-    })
+            labels.append(str(node))
 
-    G = nx.Graph()
-    G.add_edges_from(edges)
+    summary = summarize_graph(adjacency, directed=False)
+    if summary_path is not None:
+        write_graph_summary(summary, summary_path, labels)
+    if plot:
+        plot_graph(list(range(len(nodes))), [tuple(edge) for edge in get_edges(adjacency, upper=True)],
+                   dict(enumerate(labels)), title=title, directed=False, **plot_options)
+    return adjacency, summary
 
-    options = {"edgecolors": "tab:blue", "node_size": 1000, "alpha": 1}
 
-    pos = nx.spring_layout(G, seed=3113794651)  # positions for all nodes
-
-    nx.draw_networkx_nodes(G, pos, nodelist=nodes, node_color="tab:blue", **options)
-    nx.draw_networkx_edges(
-        G,
-        pos,
-        edgelist=edges,
-        width=1,
-        alpha=1,
-        edge_color="tab:blue",
-        node_size=1000,
-    )
-    nx.draw_networkx_labels(G, pos, labels, font_size=4, font_color="black", font_weight="bold")
-
-    plt.tight_layout()
-    plt.axis("off")
-
-    plt.savefig(f'{title}.pdf')
-    plt.close()
+def get_canonical_key(ordering: tuple[Policy], relation: tuple[int]):
+    # Two orderings and relations are equivalent exactly when they have the same set representation
+    return tuple(frozenset(set_of_policies) for set_of_policies in get_set_representation(ordering, relation))
 
 
 def remove_equivalent_orderings(orderings_and_relations: set[tuple[tuple[Policy], tuple[int]]]):
-    orderings_and_relations = set(orderings_and_relations)
+    """
+    Keep only the smallest ordering from each group of equivalent orderings and relations.
+    Note that the orderings from orderings.generate_weak_orderings are already free of equivalent ones.
+    """
+    smallest = {}
+    for ordering, relation in set(orderings_and_relations):
+        key = get_canonical_key(ordering, relation)
+        if key not in smallest or ordering < smallest[key][0]:
+            smallest[key] = (ordering, relation)
 
-    to_remove = set()
-    for i, ordering_and_relation_1 in enumerate(orderings_and_relations):
-        for j, ordering_and_relation_2 in enumerate(orderings_and_relations):
-            if i == j:
-                continue
-            else:
-                if check_equivalent(*ordering_and_relation_1, *ordering_and_relation_2):
-                    ordering1, relation1 = ordering_and_relation_1
-                    ordering2, relation2 = ordering_and_relation_2
-                    if ordering1 > ordering2:
-                        to_remove.add((ordering1, relation1))
-                    else:
-                        to_remove.add((ordering2, relation2))
-
-    return orderings_and_relations - to_remove  # set subtraction
+    return set(smallest.values())
 
 
 def get_policy_set_index(policy: Policy, list_of_sets: list[set[Policy]]):
@@ -137,24 +256,93 @@ def get_policy_set_index(policy: Policy, list_of_sets: list[set[Policy]]):
 
 
 def check_ungameable(ordering_and_relation_1, ordering_and_relation_2):
-    list_of_sets_1 = get_set_representation(*ordering_and_relation_1)
-    list_of_sets_2 = get_set_representation(*ordering_and_relation_2)
+    ranks_1 = get_policy_ranks(*ordering_and_relation_1)
+    ranks_2 = get_policy_ranks(*ordering_and_relation_2)
+    if not ranks_1.keys() <= ranks_2.keys():
+        missing = [policy for policy in ranks_1 if policy not in ranks_2]
+        raise ValueError(f"The second ordering doesn't rank {missing}, which the first ordering does")
 
     for i, policy1 in enumerate(ordering_and_relation_1[0]):
         for j, policy2 in enumerate(ordering_and_relation_1[0]):
             if i == j:
                 continue
 
-            idx_p1_list1 = get_policy_set_index(policy1, list_of_sets_1)
-            idx_p1_list2 = get_policy_set_index(policy1, list_of_sets_2)
-            idx_p2_list1 = get_policy_set_index(policy2, list_of_sets_1)
-            idx_p2_list2 = get_policy_set_index(policy2, list_of_sets_2)
-
-            if idx_p1_list1 < idx_p2_list1 and idx_p1_list2 > idx_p2_list2:
+            if ranks_1[policy1] < ranks_1[policy2] and ranks_2[policy1] > ranks_2[policy2]:
                 return False
     return True
 
 
+def iter_ungameability_chunks(rank_matrix: np.ndarray,
+                              chunk_size: int = UNGAMEABILITY_CHUNK_SIZE) -> Iterator[tuple[int, np.ndarray]]:
+    """
+    Yield (start, block) for consecutive chunks of rows of the ungameability relation between the orderings
+    in the rank matrix, where block[k, j] says whether orderings start + k and j are ungameable, i.e. there is
+    no pair of policies that one of them ranks strictly above and the other strictly below. As with the
+    experiments' double loops over check_ungameable, an ordering is not paired with itself.
+    """
+    above, below, _ = get_preference_indicators(rank_matrix)
+    for start in range(0, len(rank_matrix), chunk_size):
+        # Number of pairs of policies that the two orderings strictly disagree on
+        disagreements = above[start:start + chunk_size] @ below.T
+        block = disagreements == 0
+        rows = np.arange(len(block))
+        block[rows, start + rows] = False
+        yield start, block
+
+
+def get_ungameability_matrix(rank_matrix: np.ndarray, chunk_size: int = UNGAMEABILITY_CHUNK_SIZE) -> np.ndarray:
+    """
+    The full (num_orderings, num_orderings) boolean ungameability relation, see iter_ungameability_chunks
+    """
+    matrix = np.zeros((len(rank_matrix), len(rank_matrix)), dtype=bool)
+    for start, block in iter_ungameability_chunks(rank_matrix, chunk_size):
+        matrix[start:start + len(block)] = block
+    return matrix
+
+
+def get_ungameable_edges(rank_matrix: np.ndarray,
+                         chunk_size: int = UNGAMEABILITY_CHUNK_SIZE,
+                         encoding: str = "dense") -> np.ndarray:
+    """
+    The ungameable pairs as an array of (row, column) indices into the rank matrix, of shape (num_pairs, 2),
+    without ever building the full matrix. With encoding="bitset" the orderings are compared as packed
+    bitsets (see bitsets.PairBitsets), which takes far less memory, and chunk_size is chosen automatically.
+    """
+    if encoding not in RELATION_ENCODINGS:
+        raise ValueError(f"Unknown encoding {encoding}, expected one of {RELATION_ENCODINGS}")
+    if encoding == "bitset":
+        chunks = iter_bitset_ungameability_chunks(PairBitsets.from_rank_matrix(rank_matrix))
+    else:
+        chunks = iter_ungameability_chunks(rank_matrix, chunk_size)
+    edges = list(iter_edges(chunks))
+    return np.concatenate(edges) if edges else np.zeros((0, 2), dtype=int)
+
+
+def get_ungameable_pairs(orderings_and_relations: Sequence[tuple[tuple[Policy], tuple[int]]],
+                         chunk_size: int = UNGAMEABILITY_CHUNK_SIZE,
+                         encoding: str = "dense") -> list[tuple[Any, Any]]:
+    """
+    All ordered pairs of (permutation, relations) that check_ungameable accepts, in the format that
+    make_ungameability_graph takes. The orderings all have to be of the same policies.
+    """
+    orderings_and_relations = list(orderings_and_relations)
+    rank_matrix, _ = make_rank_matrix(orderings_and_relations)
+    return [(orderings_and_relations[i], orderings_and_relations[j])
+            for i, j in get_ungameable_edges(rank_matrix, chunk_size, encoding)]
+
+
+def get_ungameability_adjacency(rank_matrix: np.ndarray,
+                                chunk_size: int = UNGAMEABILITY_CHUNK_SIZE,
+                                encoding: str = "dense"):
+    """
+    The ungameability relation as a boolean scipy.sparse adjacency matrix over the rows of the rank matrix,
+    for graph_analysis.summarize_graph, without going through tuples of policies
+    """
+    from graph_analysis import make_adjacency_matrix
+
+    return make_adjacency_matrix(get_ungameable_edges(rank_matrix, chunk_size, encoding), len(rank_matrix))
+
+
 def check_equivalent(ordering1: tuple[Policy], relation1: tuple[int],
                      ordering2: tuple[Policy], relation2: tuple[int]):
     # Immediately discard if the relations are different
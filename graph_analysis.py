@@ -0,0 +1,170 @@
+# (c) 2022 Nikolaus Howe
+import json
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+
+from typing import Any, Optional
+
+MAX_CLIQUES = 100  # how many maximal cliques the greedy clique search finds at most
+
+
+def make_adjacency_matrix(edges: np.ndarray, num_nodes: int, symmetric: bool = False) -> scipy.sparse.csr_matrix:
+    """
+    Boolean sparse adjacency matrix of shape (num_nodes, num_nodes) from an array of (row, column) edges over
+    integer node ids, such as the ones from gameability.get_ungameable_edges or
+    simplification.get_simplification_edges. Repeated edges are merged, and with symmetric every edge
+    is added in both directions.
+    """
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    rows, columns = edges[:, 0], edges[:, 1]
+    if symmetric:
+        rows, columns = np.concatenate([rows, columns]), np.concatenate([columns, rows])
+    adjacency = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=bool), (rows, columns)),
+                                        shape=(num_nodes, num_nodes))
+    adjacency.sum_duplicates()
+    adjacency.sort_indices()
+    return adjacency
+
+
+def get_edges(adjacency: scipy.sparse.csr_matrix, upper: bool = False) -> np.ndarray:
+    """
+    The edges of the adjacency matrix as an array of (row, column), only those with row < column if upper
+    """
+    adjacency = scipy.sparse.triu(adjacency, k=1, format="csr") if upper else adjacency.tocsr()
+    rows = np.repeat(np.arange(adjacency.shape[0]), np.diff(adjacency.indptr))
+    return np.stack([rows, adjacency.indices], axis=1)
+
+
+def get_connected_components(adjacency: scipy.sparse.csr_matrix) -> tuple[int, np.ndarray]:
+    """
+    The number of (weakly) connected components and the component of each node
+    """
+    return scipy.sparse.csgraph.connected_components(adjacency, directed=True, connection="weak")
+
+
+def get_degree_statistics(degrees: np.ndarray) -> dict[str, float]:
+    if len(degrees) == 0:
+        return {"min": 0, "max": 0, "mean": 0., "median": 0.}
+    return {"min": int(degrees.min()), "max": int(degrees.max()),
+            "mean": float(degrees.mean()), "median": float(np.median(degrees))}
+
+
+def find_maximal_cliques(adjacency: scipy.sparse.csr_matrix, max_cliques: int = MAX_CLIQUES) -> list[np.ndarray]:
+    """
+    Greedily find up to max_cliques maximal cliques of an undirected graph, such as sets of orderings which are
+    all pairwise ungameable. Each clique is grown from the node of highest degree that isn't in a clique yet,
+    by repeatedly adding the candidate with the most neighbours among the remaining candidates. The cliques
+    are maximal (nothing can be added to them) but not necessarily maximum, since finding those is NP-hard.
+    """
+    adjacency = adjacency.tocsr()
+    degrees = np.diff(adjacency.indptr)
+    covered = np.zeros(adjacency.shape[0], dtype=bool)
+    cliques = []
+    for seed in np.argsort(-degrees, kind="stable"):
+        if len(cliques) >= max_cliques:
+            break
+        if covered[seed]:
+            continue
+        clique = [seed]
+        candidates = adjacency.indices[adjacency.indptr[seed]:adjacency.indptr[seed + 1]]
+        candidates = candidates[candidates != seed]
+        while len(candidates) > 0:
+            within = np.asarray(adjacency[candidates][:, candidates].sum(axis=1)).ravel()
+            chosen = candidates[np.argmax(within)]
+            clique.append(chosen)
+            neighbours = adjacency.indices[adjacency.indptr[chosen]:adjacency.indptr[chosen + 1]]
+            candidates = np.intersect1d(candidates, neighbours, assume_unique=True)
+            candidates = candidates[candidates != chosen]
+        clique = np.sort(np.array(clique, dtype=np.int64))
+        covered[clique] = True
+        cliques.append(clique)
+    return cliques
+
+
+def get_chain_depths(adjacency: scipy.sparse.csr_matrix) -> np.ndarray:
+    """
+    For each node of a directed acyclic graph, the number of edges in the longest path that ends there,
+    by peeling off the nodes without remaining predecessors one layer at a time
+    """
+    adjacency = adjacency.tocsr()
+    num_nodes = adjacency.shape[0]
+    in_degrees = np.bincount(adjacency.indices, minlength=num_nodes)
+    depths = np.full(num_nodes, -1, dtype=np.int64)
+    frontier = np.flatnonzero(in_degrees == 0)
+    depth = 0
+    while len(frontier) > 0:
+        depths[frontier] = depth
+        successors = adjacency[frontier].indices
+        in_degrees -= np.bincount(successors, minlength=num_nodes)
+        frontier = np.unique(successors[in_degrees[successors] == 0])
+        depth += 1
+    if (depths < 0).any():
+        raise ValueError("The graph has a cycle, so it has no longest chain")
+    return depths
+
+
+def find_longest_chain(adjacency: scipy.sparse.csr_matrix, depths: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    A longest path through a directed acyclic graph, such as a longest sequence of successive simplifications
+    """
+    if adjacency.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+    depths = get_chain_depths(adjacency) if depths is None else depths
+    predecessors = adjacency.T.tocsr()
+    chain = [int(np.argmax(depths))]
+    while depths[chain[-1]] > 0:
+        candidates = predecessors.indices[predecessors.indptr[chain[-1]]:predecessors.indptr[chain[-1] + 1]]
+        chain.append(int(candidates[np.argmax(depths[candidates] == depths[chain[-1]] - 1)]))
+    return np.array(chain[::-1], dtype=np.int64)
+
+
+def summarize_graph(adjacency: scipy.sparse.csr_matrix, directed: bool,
+                    max_cliques: int = MAX_CLIQUES) -> dict[str, Any]:
+    """
+    Summary statistics of an ungameability graph (undirected, with every edge stored in both directions) or a
+    simplification graph (directed and acyclic), as a dictionary that can be written to JSON. Cliques are only
+    looked for in undirected graphs, and chains only in directed ones.
+    """
+    adjacency = adjacency.tocsr()
+    num_nodes = adjacency.shape[0]
+    num_components, components = get_connected_components(adjacency)
+    component_sizes = np.bincount(components, minlength=num_components)
+    out_degrees = np.diff(adjacency.indptr)
+    in_degrees = np.bincount(adjacency.indices, minlength=num_nodes)
+
+    summary = {
+        "num_nodes": num_nodes,
+        "num_edges": int(adjacency.nnz if directed else adjacency.nnz // 2),
+        "directed": directed,
+        "num_components": int(num_components),
+        "largest_component_size": int(component_sizes.max()) if num_nodes > 0 else 0,
+        "num_isolated_nodes": int(((out_degrees == 0) & (in_degrees == 0)).sum()),
+    }
+    if directed:
+        depths = get_chain_depths(adjacency)
+        summary["out_degrees"] = get_degree_statistics(out_degrees)
+        summary["in_degrees"] = get_degree_statistics(in_degrees)
+        summary["num_sources"] = int((in_degrees == 0).sum())
+        summary["num_sinks"] = int((out_degrees == 0).sum())
+        summary["longest_chain"] = find_longest_chain(adjacency, depths).tolist()
+    else:
+        cliques = find_maximal_cliques(adjacency, max_cliques)
+        summary["degrees"] = get_degree_statistics(out_degrees)
+        summary["largest_clique"] = max(cliques, key=len).tolist() if cliques else []
+        summary["clique_sizes"] = [len(clique) for clique in cliques]
+    return summary
+
+
+def write_graph_summary(summary: dict[str, Any], path: str, node_labels: Optional[list[str]] = None) -> None:
+    """
+    Write the summary to path as JSON, also naming the nodes of its largest clique or longest chain
+    if node_labels are given
+    """
+    summary = dict(summary)
+    if node_labels is not None:
+        for key in ("largest_clique", "longest_chain"):
+            if key in summary:
+                summary[f"{key}_labels"] = [node_labels[node] for node in summary[key]]
+    with open(path, "w") as f:
+        json.dump(summary, f, indent=2)
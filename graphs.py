@@ -0,0 +1,172 @@
+# (c) 2022 Nikolaus Howe
+import json
+import os
+import shutil
+
+import matplotlib
+import matplotlib.figure
+import networkx as nx
+import numpy as np
+
+from typing import Any, Hashable, Optional, Sequence
+
+GRAPH_RENDERERS = ("latex", "plain")
+GRAPH_LAYOUTS = ("spring", "spectral", "layered")
+EXPORT_FORMATS = ("graphml", "dot", "json")
+SPRING_LAYOUT_MAX_NODES = 500  # past this, the default layout switches to one that scales to large graphs
+LABEL_MAX_NODES = 500  # past this, labels are left out of drawings, since they would only be a blur
+ARROW_MAX_EDGES = 2000  # past this, edges are drawn as plain lines, since matplotlib draws each arrow separately
+LAYOUT_SEED = 3113794651
+
+
+def get_default_renderer() -> str:
+    return "latex" if shutil.which("pdflatex") is not None else "plain"
+
+
+def make_graph(nodes: Sequence[Hashable], edges: Sequence[tuple[Hashable, Hashable]], directed: bool = False):
+    graph = nx.DiGraph() if directed else nx.Graph()
+    graph.add_nodes_from(nodes)
+    graph.add_edges_from(edges)
+    return graph
+
+
+def get_layout(graph, layout: Optional[str] = None) -> dict[Hashable, Any]:
+    """
+    Node positions for drawing the graph. By default small graphs get a spring layout as before, while larger
+    ones get a layered layout (by topological generation) when directed and acyclic, or a spectral layout
+    (which uses a sparse eigensolver) otherwise.
+    """
+    if layout is None:
+        if len(graph) <= SPRING_LAYOUT_MAX_NODES:
+            layout = "spring"
+        elif graph.is_directed() and nx.is_directed_acyclic_graph(graph):
+            layout = "layered"
+        else:
+            layout = "spectral"
+    if layout not in GRAPH_LAYOUTS:
+        raise ValueError(f"Unknown layout {layout}, expected one of {GRAPH_LAYOUTS}")
+
+    if layout == "spring":
+        return nx.spring_layout(graph, seed=LAYOUT_SEED)
+    if layout == "spectral":
+        return _get_spectral_layout(graph)
+    layers = dict(enumerate(nx.topological_generations(graph)))
+    return nx.multipartite_layout(graph, subset_key=layers, align="horizontal")
+
+
+def _get_spectral_layout(graph) -> dict[Hashable, Any]:
+    # The spectral layout of a disconnected graph puts each component on a single point, so each component
+    # is laid out separately, in a square of side 1 on a grid
+    components = sorted((list(component) for component in nx.connected_components(graph.to_undirected(as_view=True))),
+                        key=len, reverse=True)
+    num_columns = int(np.ceil(np.sqrt(len(components))))
+    pos = {}
+    for i, component in enumerate(components):
+        subgraph = graph.subgraph(component)
+        if len(component) < 3:
+            component_pos = nx.circular_layout(subgraph, scale=0.4)
+        else:
+            component_pos = nx.spectral_layout(subgraph, scale=0.4)
+        offset = np.array([i % num_columns, -(i // num_columns)], dtype=float)
+        pos.update({node: position + offset for node, position in component_pos.items()})
+    return pos
+
+
+def _plain_label(label: Any) -> str:
+    # fancy_str_permutation wraps its labels in $...$ for LaTeX, which isn't needed to draw them as plain text
+    return str(label).strip("$")
+
+
+def export_graph(nodes: Sequence[Hashable],
+                 edges: Sequence[tuple[Hashable, Hashable]],
+                 labels: dict[Hashable, Any],
+                 path: str,
+                 directed: bool = False) -> None:
+    """
+    Write the graph to path, in the format given by its extension (.graphml, .dot or .json). Nodes are
+    numbered in the order given, and their labels are written as strings.
+    """
+    file_format = os.path.splitext(path)[1].lstrip(".").lower()
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {file_format}, expected one of {EXPORT_FORMATS}")
+
+    index = {node: i for i, node in enumerate(nodes)}
+    for node in (node for edge in edges for node in edge):
+        index.setdefault(node, len(index))
+    node_labels = [_plain_label(labels.get(node, node)) for node in index]
+    edge_indices = [(index[first], index[second]) for first, second in edges]
+
+    if file_format == "graphml":
+        graph = make_graph(range(len(index)), edge_indices, directed)
+        nx.set_node_attributes(graph, dict(enumerate(node_labels)), "label")
+        nx.write_graphml(graph, path)
+    elif file_format == "dot":
+        arrow = "->" if directed else "--"
+        with open(path, "w") as f:
+            f.write(f"{'digraph' if directed else 'graph'} {{\n")
+            for i, label in enumerate(node_labels):
+                f.write(f"  {i} [label={json.dumps(label)}];\n")
+            for first, second in edge_indices:
+                f.write(f"  {first} {arrow} {second};\n")
+            f.write("}\n")
+    else:
+        with open(path, "w") as f:
+            json.dump({"directed": directed,
+                       "nodes": [{"id": i, "label": label} for i, label in enumerate(node_labels)],
+                       "edges": edge_indices}, f)
+
+
+def plot_graph(nodes, edges, labels, title="Graph", directed: bool = False, renderer: Optional[str] = None,
+               file_format: str = "pdf", layout: Optional[str] = None, export_formats: Sequence[str] = ()):
+    """
+    Draw the graph to {title}.{file_format}, and also export it as {title}.{format} for each of export_formats.
+    renderer="latex" typesets the labels with pdflatex through the pgf backend, as in the paper, while
+    renderer="plain" draws them as plain text with the usual backends, which is much faster and doesn't need
+    TeX. By default LaTeX is used whenever pdflatex is available.
+    """
+    renderer = renderer or get_default_renderer()
+    if renderer not in GRAPH_RENDERERS:
+        raise ValueError(f"Unknown renderer {renderer}, expected one of {GRAPH_RENDERERS}")
+    for export_format in export_formats:
+        export_graph(nodes, edges, labels, f"{title}.{export_format}", directed)
+
+    G = make_graph(nodes, edges, directed)
+    pos = get_layout(G, layout)
+
+    if renderer == "latex":
+        rc_params = {
+            "pgf.texsystem": "pdflatex",
+            'font.family': 'serif',
+            'text.usetex': True,
+            'pgf.rcfonts': False,
+        }
+        save_options = {"backend": "pgf"}
+    else:
+        rc_params = {'text.usetex': False}
+        save_options = {}
+        labels = {node: _plain_label(label) for node, label in labels.items()}
+
+    # Shrink the nodes of large graphs so that they don't all run into each other
+    options = {"edgecolors": "tab:blue", "node_size": min(1000, 10 ** 5 / max(1, len(G))), "alpha": 1}
+    with matplotlib.rc_context(rc_params):
+        # A bare Figure doesn't touch pyplot's global backend, so other plots in the same process are unaffected
+        fig = matplotlib.figure.Figure()
+        ax = fig.add_subplot()
+        nx.draw_networkx_nodes(G, pos, ax=ax, nodelist=nodes, node_color="tab:blue", **options)
+        nx.draw_networkx_edges(
+            G,
+            pos,
+            ax=ax,
+            edgelist=edges,
+            arrows=directed and len(edges) <= ARROW_MAX_EDGES,
+            width=1,
+            alpha=1,
+            edge_color="tab:blue",
+            node_size=options["node_size"],
+        )
+        if len(G) <= LABEL_MAX_NODES:
+            nx.draw_networkx_labels(G, pos, labels, ax=ax, font_size=4, font_color="black", font_weight="bold")
+
+        ax.axis("off")
+        fig.tight_layout()
+        fig.savefig(f'{title}.{file_format}', **save_options)
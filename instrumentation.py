@@ -0,0 +1,159 @@
+# (c) 2022 Nikolaus Howe
+import collections
+import contextlib
+import json
+import sys
+import time
+
+from typing import Any, Callable, Optional, TextIO
+
+PROGRESS_INTERVAL = 1.  # minimum number of seconds between progress events
+
+
+class Instrumentation(object):
+    """
+    Counters (policy evaluations, constraint evaluations, solver calls, ...), per-phase wall time, and a
+    stream of structured events which is passed to each of the sinks as a dict. With no sinks attached,
+    which is the default, nothing is emitted and only the counters and timers are kept.
+    """
+
+    def __init__(self, sinks: Optional[list[Callable[[dict], None]]] = None):
+        self.sinks = list(sinks or [])
+        self.counters = collections.Counter()
+        self.timers = collections.defaultdict(float)
+
+    @property
+    def enabled(self) -> bool:
+        return len(self.sinks) > 0
+
+    def add_sink(self, sink: Callable[[dict], None]) -> None:
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink: Callable[[dict], None]) -> None:
+        self.sinks.remove(sink)
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counters[name] += amount
+
+    @contextlib.contextmanager
+    def timer(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[phase] += time.perf_counter() - start
+
+    def emit(self, event: str, **fields: Any) -> None:
+        if not self.sinks:
+            return
+        record = {"event": event, "time": time.time(), **fields}
+        for sink in self.sinks:
+            sink(record)
+
+    def snapshot(self) -> dict:
+        return {"counters": dict(self.counters), "timers": dict(self.timers)}
+
+    def merge(self, snapshot: dict) -> None:
+        # Used to fold in what worker processes counted
+        self.counters.update(snapshot["counters"])
+        for phase, seconds in snapshot["timers"].items():
+            self.timers[phase] += seconds
+
+    def reset(self) -> None:
+        self.counters.clear()
+        self.timers.clear()
+
+    def summary(self) -> dict:
+        summary = self.snapshot()
+        solver_calls = self.counters["solver_calls"]
+        if solver_calls:
+            summary["success_rate"] = self.counters["solver_successes"] / solver_calls
+            summary["mean_solve_seconds"] = self.timers["solve"] / solver_calls
+        return summary
+
+
+_instrumentation = Instrumentation()
+
+
+def get_instrumentation() -> Instrumentation:
+    return _instrumentation
+
+
+def set_instrumentation(instrumentation: Instrumentation) -> Instrumentation:
+    """
+    Replace the instrumentation used by everything, returning the previous one
+    """
+    global _instrumentation
+    previous = _instrumentation
+    _instrumentation = instrumentation
+    return previous
+
+
+class ProgressTracker(object):
+    """
+    Emits rate-limited "progress" events with throughput and an estimated time to completion
+    """
+
+    def __init__(self, phase: str, total: int, interval: float = PROGRESS_INTERVAL):
+        self.phase = phase
+        self.total = total
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last_emitted = None
+
+    def __call__(self, num_done: int, num_total: Optional[int] = None) -> None:
+        instrumentation = get_instrumentation()
+        if not instrumentation.enabled:
+            return
+        now = time.perf_counter()
+        total = self.total if num_total is None else num_total
+        if num_done < total and self.last_emitted is not None and now - self.last_emitted < self.interval:
+            return
+        self.last_emitted = now
+
+        elapsed = now - self.start
+        rate = num_done / elapsed if elapsed > 0 else 0.
+        eta = (total - num_done) / rate if rate > 0 else None
+        instrumentation.emit("progress", phase=self.phase, done=num_done, total=total,
+                             elapsed=elapsed, rate=rate, eta=eta)
+
+
+class JsonLinesSink(object):
+    """
+    Writes every event as one line of JSON, to a path (appending) or an open file
+    """
+
+    def __init__(self, destination):
+        self._owns_file = isinstance(destination, str)
+        self.file = open(destination, "a") if self._owns_file else destination
+
+    def __call__(self, record: dict) -> None:
+        self.file.write(json.dumps(record, default=str) + "\n")
+        self.file.flush()
+
+    def close(self) -> None:
+        if self._owns_file:
+            self.file.close()
+
+
+class ConsoleSink(object):
+    """
+    Prints events in a human readable form
+    """
+
+    def __init__(self, file: TextIO = sys.stdout):
+        self.file = file
+
+    def __call__(self, record: dict) -> None:
+        event = record["event"]
+        if event == "progress":
+            eta = "?" if record["eta"] is None else f"{record['eta']:.0f}s"
+            message = (f"[{record['phase']}] {record['done']} of {record['total']} "
+                       f"({record['rate']:.1f}/s, ETA {eta})")
+        elif event == "ordering_result":
+            outcome = f"success, using rewards {record['rewards']}" if record["success"] else "not realizable"
+            message = f"{record['ordering']}: {outcome}"
+        else:
+            fields = {key: value for key, value in record.items() if key not in ("event", "time")}
+            message = f"{event}: {json.dumps(fields, default=str)}"
+        print(message, file=self.file)
@@ -0,0 +1,162 @@
+# (c) 2022 Nikolaus Howe
+import os
+import struct
+import zipfile
+import numpy as np
+
+from typing import Optional
+
+from environment import MDPWithoutRewardEnv, is_sparse_matrix
+
+MDP_FILE_FORMATS = (".npy", ".npz")
+VALIDATION_CHUNK_BYTES = 2 ** 26  # roughly how much of the transitions is read into memory at once when validating
+PROBABILITY_TOLERANCE = 1e-6
+ZIP_LOCAL_HEADER_SIZE = 30
+ZIP_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+SPARSE_MEMBERS = ("data", "indices", "indptr", "shape")  # how scipy.sparse.save_npz lays out a CSR matrix
+
+
+def save_mdp(path: str,
+             transitions: np.ndarray,
+             initial_distribution: Optional[np.ndarray] = None,
+             discount: Optional[float] = None) -> None:
+    """
+    Write an MDP for load_mdp: a .npy file holds just the transitions, while a .npz archive can also hold the
+    initial distribution and discount. The archive is left uncompressed, so that the transitions in it can be
+    memory-mapped. Sparse transitions (see MDPWithoutRewardEnv) are stored as CSR arrays, the same way as
+    scipy.sparse.save_npz does, and so need a .npz archive.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in MDP_FILE_FORMATS:
+        raise ValueError(f"Unknown MDP file format {extension}, expected one of {MDP_FILE_FORMATS}")
+    sparse = is_sparse_matrix(transitions)
+    if extension == ".npy":
+        if sparse:
+            raise ValueError("Sparse transitions have to be saved to a .npz archive")
+        if initial_distribution is not None or discount is not None:
+            raise ValueError("A .npy file only holds the transitions, use .npz to also save the rest")
+        np.save(path, transitions)
+        return
+
+    if sparse:
+        transitions = transitions.tocsr()
+        arrays = {"data": transitions.data, "indices": transitions.indices, "indptr": transitions.indptr,
+                  "shape": np.array(transitions.shape), "format": np.array(b"csr")}
+    else:
+        arrays = {"transitions": transitions}
+    if initial_distribution is not None:
+        arrays["initial_distribution"] = initial_distribution
+    if discount is not None:
+        arrays["discount"] = discount
+    with open(path, "wb") as f:
+        np.savez(f, **arrays)
+
+
+def _memory_map_npz_member(path: str, name: str) -> Optional[np.memmap]:
+    # np.load doesn't memory-map the arrays in an .npz archive, but an uncompressed member is stored as a plain
+    # .npy file inside the zip, so it can be mapped directly from behind its local file header
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(f"{name}.npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+
+    with open(path, "rb") as f:
+        f.seek(info.header_offset)
+        local_header = f.read(ZIP_LOCAL_HEADER_SIZE)
+        if local_header[:4] != ZIP_LOCAL_HEADER_SIGNATURE:
+            return None
+        name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+        f.seek(info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if dtype.hasobject:
+        return None
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape, order="F" if fortran_order else "C")
+
+
+def _load_sparse_transitions(path: str, archive, mmap: bool):
+    import scipy.sparse
+
+    if "format" in archive.files and archive["format"].item() not in ("csr", b"csr"):
+        raise ValueError(f"{path} holds a {archive['format'].item()} matrix, only CSR transitions are supported")
+    arrays = {}
+    for name in SPARSE_MEMBERS[:3]:
+        arrays[name] = _memory_map_npz_member(path, name) if mmap else None
+        if arrays[name] is None:
+            arrays[name] = archive[name]
+    return scipy.sparse.csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]),
+                                   shape=tuple(archive["shape"]), copy=False)
+
+
+def check_transitions(transitions: np.ndarray) -> None:
+    """
+    Check that a next state table only has valid states in it, or that stochastic transitions hold probability
+    distributions over next states, reading a chunk of states at a time
+    """
+    if is_sparse_matrix(transitions):
+        row_sums = np.asarray(transitions.sum(axis=1)).ravel()
+        if (transitions.data < 0).any() or (np.abs(row_sums - 1) > PROBABILITY_TOLERANCE).any():
+            raise ValueError("The sparse transition probabilities aren't distributions for some state-action pairs")
+        return
+    num_states = transitions.shape[0]
+    row_bytes = max(1, transitions[:1].nbytes)
+    chunk_states = max(1, VALIDATION_CHUNK_BYTES // row_bytes)
+    for start in range(0, num_states, chunk_states):
+        chunk = np.asarray(transitions[start:start + chunk_states])
+        if transitions.ndim == 2:
+            if chunk.size and (chunk.min() < 0 or chunk.max() >= num_states):
+                raise ValueError(f"The next state table has states outside of [0, {num_states}) "
+                                 f"for some of states {start} to {start + len(chunk) - 1}")
+        elif chunk.size and ((chunk < 0).any() or (np.abs(chunk.sum(axis=2) - 1) > PROBABILITY_TOLERANCE).any()):
+            raise ValueError(f"The transition probabilities aren't distributions "
+                             f"for some of states {start} to {start + len(chunk) - 1}")
+
+
+def load_mdp(path: str,
+             discount: Optional[float] = None,
+             mmap: bool = True,
+             validate: bool = True,
+             **env_options) -> MDPWithoutRewardEnv:
+    """
+    Load an MDP saved by save_mdp (or any .npy/.npz file laid out the same way) into an MDPWithoutRewardEnv
+    backed by its transitions, see MDPWithoutRewardEnv for the forms they can take. With mmap the transitions
+    (or the arrays of sparse ones) are memory-mapped rather than read into memory, so that MDPs larger than
+    memory can be used. The discount argument takes precedence over one saved in the file, and env_options
+    (eg. policy_evaluation, which defaults to "occupancy" here) are passed on to the env.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in MDP_FILE_FORMATS:
+        raise ValueError(f"Unknown MDP file format {extension}, expected one of {MDP_FILE_FORMATS}")
+
+    initial_distribution = None
+    if extension == ".npy":
+        transitions = np.load(path, mmap_mode="r" if mmap else None)
+    else:
+        with np.load(path) as archive:
+            if all(name in archive.files for name in SPARSE_MEMBERS):
+                transitions = _load_sparse_transitions(path, archive, mmap)
+            elif "transitions" in archive.files:
+                transitions = _memory_map_npz_member(path, "transitions") if mmap else None
+                if transitions is None:
+                    transitions = archive["transitions"]
+            else:
+                raise ValueError(f"{path} has neither a transitions array nor sparse CSR transitions")
+            if "initial_distribution" in archive.files:
+                initial_distribution = archive["initial_distribution"]
+            if discount is None and "discount" in archive.files:
+                discount = float(archive["discount"])
+    if discount is None:
+        raise ValueError(f"{path} has no discount, so it has to be given")
+
+    if validate:
+        check_transitions(transitions)
+    env_options.setdefault("policy_evaluation", "occupancy")
+    return MDPWithoutRewardEnv(dynamics=None,
+                               discount=discount,
+                               transitions=transitions,
+                               initial_distribution=initial_distribution,
+                               **env_options)
@@ -0,0 +1,130 @@
+# (c) 2022 Nikolaus Howe
+import dataclasses
+import itertools
+import math
+import numpy as np
+
+from typing import Any, Iterator, Optional, Sequence
+
+
+def generate_ordered_set_partitions(items: Sequence[Any]) -> Iterator[list[tuple]]:
+    """
+    Yield every way of splitting the items into an ordered list of nonempty blocks, exactly once.
+    The items within each block are kept in the order they were given in.
+    """
+    if len(items) == 0:
+        yield []
+        return
+
+    for block_size in range(1, len(items) + 1):
+        for block in itertools.combinations(items, block_size):
+            rest = [item for item in items if item not in block]
+            for later_blocks in generate_ordered_set_partitions(rest):
+                yield [block] + later_blocks
+
+
+def weak_ordering_from_blocks(blocks: list[tuple]) -> tuple[tuple, tuple[int]]:
+    """
+    Turn a list of blocks of equally good policies (worst block first) into a (permutation, relations)
+    pair, where the relations are 0 between equal adjacent policies and 1 between strictly ordered ones.
+    """
+    permutation = []
+    relations = []
+    for block in blocks:
+        if permutation:
+            relations.append(1)
+        relations.extend([0] * (len(block) - 1))
+        permutation.extend(block)
+    return tuple(permutation), tuple(relations)
+
+
+def generate_weak_orderings(policies: Sequence[Any]) -> Iterator[tuple[tuple, tuple[int]]]:
+    """
+    Yield every weak ordering of the policies exactly once, in the same (permutation, relations) format as
+    the permutation and relation search. This gives count_weak_orderings(n) candidates rather than the
+    n! * 2^(n-1) permutation and relation pairs, most of which describe the same weak ordering.
+    """
+    # Partition the indices rather than the policies, so that we never need to compare policies
+    policies = list(policies)
+    for blocks in generate_ordered_set_partitions(range(len(policies))):
+        yield weak_ordering_from_blocks([tuple(policies[i] for i in block) for block in blocks])
+
+
+def count_weak_orderings(n: int) -> int:
+    """
+    The number of weak orderings of n items (the Fubini number)
+    """
+    counts = [1]
+    for m in range(1, n + 1):
+        counts.append(sum(math.comb(m, k) * counts[m - k] for k in range(1, m + 1)))
+    return counts[n]
+
+
+@dataclasses.dataclass(frozen=True)
+class WeakOrdering(object):
+    """
+    A weak ordering of a fixed list of policies, stored as the rank of each policy: ranks[i] is the
+    index of the block (worst first) that the i-th policy is in. Unlike (permutation, relations) pairs,
+    every weak ordering has exactly one representation.
+    """
+    ranks: tuple[int, ...]
+
+    @classmethod
+    def from_permutation(cls, policy_permutation: tuple, adjacent_relations: tuple[int],
+                         policy_indices: dict[Any, int]) -> "WeakOrdering":
+        if len(policy_permutation) != len(policy_indices) or set(policy_permutation) != policy_indices.keys():
+            raise ValueError(f"{policy_permutation} is not an ordering of {list(policy_indices)}")
+        ranks = [0] * len(policy_indices)
+        for policy, rank in get_policy_ranks(policy_permutation, adjacent_relations).items():
+            ranks[policy_indices[policy]] = rank
+        return cls(tuple(ranks))
+
+    def to_permutation(self, policies: Sequence[Any]) -> tuple[tuple, tuple[int]]:
+        blocks = [[] for _ in range(max(self.ranks, default=-1) + 1)]
+        for policy, rank in zip(policies, self.ranks):
+            blocks[rank].append(policy)
+        return weak_ordering_from_blocks([tuple(block) for block in blocks])
+
+
+def get_policy_ranks(policy_permutation: tuple, adjacent_relations: tuple[int]) -> dict[Any, int]:
+    """
+    The index of the block (worst first) that each policy of the permutation is in
+    """
+    ranks = {}
+    rank = 0
+    for i, policy in enumerate(policy_permutation):
+        if i > 0 and adjacent_relations[i - 1] == 1:
+            rank += 1
+        ranks[policy] = rank
+    return ranks
+
+
+def make_rank_matrix(orderings_and_relations: Sequence[tuple[tuple, tuple[int]]],
+                     policies: Optional[Sequence[Any]] = None) -> tuple[np.ndarray, list]:
+    """
+    Stack the rank vectors (see WeakOrdering) of (permutation, relations) pairs which all order the same
+    policies into an array of shape (num_orderings, num_policies). The policies default to the order they
+    appear in in the first permutation. Returns the rank matrix and the policies its columns correspond to.
+    """
+    if policies is None:
+        policies = list(orderings_and_relations[0][0]) if len(orderings_and_relations) > 0 else []
+    policy_indices = {policy: i for i, policy in enumerate(policies)}
+
+    rank_matrix = np.zeros((len(orderings_and_relations), len(policies)), dtype=np.int32)
+    for row, (policy_permutation, adjacent_relations) in enumerate(orderings_and_relations):
+        rank_matrix[row] = WeakOrdering.from_permutation(policy_permutation, adjacent_relations, policy_indices).ranks
+    return rank_matrix, list(policies)
+
+
+def get_preference_indicators(rank_matrix: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    For each ordering (row of the rank matrix) and each ordered pair of distinct policies (i, j), whether i is
+    ranked strictly above j, strictly below j, or tied with j. Each has shape (num_orderings, num_policies ** 2),
+    and is float32 so that comparing all orderings against each other is a matrix product.
+    """
+    num_orderings, num_policies = rank_matrix.shape
+    signs = np.sign(rank_matrix[:, :, None] - rank_matrix[:, None, :]).reshape(num_orderings, num_policies ** 2)
+    off_diagonal = ~np.eye(num_policies, dtype=bool).reshape(-1)
+    return ((signs > 0).astype(np.float32),
+            (signs < 0).astype(np.float32),
+            ((signs == 0) & off_diagonal).astype(np.float32))
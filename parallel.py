@@ -0,0 +1,74 @@
+# (c) 2022 Nikolaus Howe
+import contextlib
+import math
+
+from concurrent.futures import Executor, ProcessPoolExecutor, as_completed
+from typing import Any, Callable, Iterable, Optional
+
+from instrumentation import Instrumentation, get_instrumentation, set_instrumentation
+
+CHUNKS_PER_WORKER = 4  # more chunks than workers, so that slow chunks don't hold everyone up
+
+
+def _run_chunk(fun: Callable, chunk: list) -> tuple[list, dict]:
+    # Count what happens in the worker separately (and without sinks), and send the counts back with the results
+    instrumentation = Instrumentation()
+    previous = set_instrumentation(instrumentation)
+    try:
+        results = [fun(item) for item in chunk]
+    finally:
+        set_instrumentation(previous)
+    return results, instrumentation.snapshot()
+
+
+def parallel_map(fun: Callable,
+                 items: Iterable,
+                 workers: Optional[int] = None,
+                 chunksize: Optional[int] = None,
+                 progress: Optional[Callable[[int, int], None]] = None,
+                 callback: Optional[Callable[[int, Any], None]] = None,
+                 executor: Optional[Executor] = None) -> list:
+    """
+    Apply fun to every item and return the results in the order of the items.
+
+    With workers > 1 the items are split into chunks which are spread across a process pool,
+    so fun and the items need to be picklable. As results come in (after every item when serial,
+    after every chunk when parallel, in whatever order the chunks finish), callback(index, result)
+    is called for each of them and then progress(num_done, num_total). An executor can be given to reuse
+    one process pool across calls, rather than starting (and shutting down) a new one for each; the items
+    are then always sent to it, and workers only decides the chunk size.
+    """
+    items = list(items)
+    total = len(items)
+
+    if executor is None and (workers is None or workers <= 1 or total <= 1):
+        results = []
+        for item in items:
+            results.append(fun(item))
+            if callback is not None:
+                callback(len(results) - 1, results[-1])
+            if progress is not None:
+                progress(len(results), total)
+        return results
+
+    if chunksize is None:
+        chunksize = max(1, math.ceil(total / ((workers or 1) * CHUNKS_PER_WORKER)))
+    chunks = [items[i:i + chunksize] for i in range(0, total, chunksize)]
+
+    chunk_results = [None] * len(chunks)
+    num_done = 0
+    with contextlib.nullcontext(executor) if executor is not None else ProcessPoolExecutor(workers) as executor:
+        futures = {executor.submit(_run_chunk, fun, chunk): i for i, chunk in enumerate(chunks)}
+        for future in as_completed(futures):
+            i = futures[future]
+            chunk_results[i], snapshot = future.result()
+            get_instrumentation().merge(snapshot)
+            num_done += len(chunk_results[i])
+            if callback is not None:
+                for j, result in enumerate(chunk_results[i]):
+                    callback(i * chunksize + j, result)
+            if progress is not None:
+                progress(num_done, total)
+
+    # Put the chunks back together in order, so that the results are deterministic
+    return [result for results in chunk_results for result in results]
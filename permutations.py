@@ -1,62 +1,134 @@
 # (c) 2022 Nikolaus Howe
-import itertools
 import numpy as np
 
-from scipy.optimize import minimize
-from typing import Callable
+from typing import Callable, Optional, Union
 
 from environment import MDPWithoutRewardEnv
-from policy import Policy
-import constraints
+from instrumentation import ProgressTracker, get_instrumentation
+from orderings import generate_weak_orderings
+from policy import Policy, make_policies_from_action_table
+from prefix_search import SEARCH_MODES, depth_first_ordering_search, replay_depth_first_search
+from result_store import open_result_store
+from sampling import sample_strict_orderings
+from solvers import OrderingSolver, solve_weak_orderings
 
 
 # Calculate which permutations are possible
-def calculate_achievable_permutations(allowed_policies: list[Policy],
+def calculate_achievable_permutations(allowed_policies: Union[list[Policy], np.ndarray],
                                       make_reward_fun: Callable,
                                       env: MDPWithoutRewardEnv,
                                       reward_size: int,
+                                      solver: str = "slsqp",  # "slsqp" or "lp", see solvers.OrderingSolver
+                                      workers: Optional[int] = None,  # > 1 to solve in a process pool
+                                      search: str = "flat",  # "flat" or "dfs", see prefix_search
+                                      num_samples: int = 0,  # reward vectors to sample first, flat search only
+                                      sample_seed: Optional[int] = 0,
+                                      store_dir: Optional[str] = None,  # where to save and resume results from
+                                      ordering_solver: Optional[OrderingSolver] = None,  # to reuse one
                                       ):
-    print("Considering all orderings of the following policies:")
-    print(allowed_policies, '\n--------------------------------\n')
-
-    all_permutations = list(itertools.permutations(allowed_policies))
-    all_relations = list(itertools.product(*([range(2)] * (len(allowed_policies) - 1))))
-
-    weak_orderings = []
-    for perm in all_permutations:
-        for relation in all_relations:
-            weak_orderings.append((perm, relation))
-
-    realized_permutations = []
-    realized_relations = []
-    realized_rewards = []
-    for i, (perm, relation) in enumerate(weak_orderings):
-        if i % 10 == 0:
-            print(f"Working on permutation {i+1} of {len(weak_orderings)}")
-        eq_constraints = constraints.make_eq_constraints(env=env,
-                                                   policy_permutation=perm,
-                                                   make_reward_fun=make_reward_fun,
-                                                   adjacent_policy_relations=list(relation))
-        ineq_constraints = constraints.make_ineq_constraints(adjacent_policy_relations=list(relation),
-                                                       policy_permutation=perm,
-                                                       make_reward_fun=make_reward_fun,
-                                                       env=env)
-        res = minimize(
-            fun=lambda x: 0,
-            x0=np.zeros(reward_size),
-            constraints=
-            [{"type": "eq",
-              "fun": eq_constraints},
-             {"type": "ineq",
-              "fun": ineq_constraints}]
-        )
-        if res.success:
-            realized_permutations.append(perm)
-            realized_relations.append(relation)
-            realized_rewards.append(res.x)
-
-    # for i, perm in enumerate(realized_permutations):
-        # utils.fancy_print_permutation(perm, realized_relations[i], realized_rewards[i])
-        # print(perm, realized_relations[i], realized_rewards[i])
+    if search not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode {search}, expected one of {SEARCH_MODES}")
+    if search == "dfs" and num_samples > 0:
+        # The depth first search decides prefixes rather than whole orderings, so sampled witnesses can't stand in
+        raise ValueError("Sampling reward vectors (num_samples > 0) is only supported with search=\"flat\"")
+
+    # An action table (see policy_space) goes to the solver as is, so that its feature values are computed at once
+    policy_table = allowed_policies
+    if isinstance(allowed_policies, np.ndarray):
+        allowed_policies = make_policies_from_action_table(allowed_policies)
+
+    instrumentation = get_instrumentation()
+    instrumentation.emit("search_start", search="calculate_achievable_permutations",
+                         policies=[repr(policy) for policy in allowed_policies],
+                         solver=solver, search_mode=search, workers=workers)
+
+    with instrumentation.timer("calculate_achievable_permutations"):
+        store = None
+        if store_dir is not None:
+            store = open_result_store(directory=store_dir,
+                                      env=env,
+                                      policies=allowed_policies,
+                                      make_reward_fun=make_reward_fun,
+                                      reward_size=reward_size,
+                                      solver=solver if ordering_solver is None else ordering_solver.solver)
+
+        # A resumed search that has everything it needs in the store doesn't set up a solver at all
+        realized = None if store is None else _replay_search(allowed_policies, store, search)
+        if realized is None:
+            if ordering_solver is None:
+                ordering_solver = OrderingSolver(policies=policy_table,
+                                                 make_reward_fun=make_reward_fun,
+                                                 reward_size=reward_size,
+                                                 env=env,
+                                                 solver=solver,
+                                                 x0=np.zeros(reward_size))
+            if search == "dfs":
+                realized = depth_first_ordering_search(allowed_policies, ordering_solver, workers=workers,
+                                                       store=store)
+            else:
+                realized = _flat_search(allowed_policies, make_reward_fun, env, reward_size, ordering_solver,
+                                        workers, num_samples, sample_seed, store)
+        if store is not None:
+            store.close()
+
+        realized_permutations = [perm for perm, _, _ in realized]
+        realized_relations = [relation for _, relation, _ in realized]
+        realized_rewards = [rewards for _, _, rewards in realized]
+
+        # for i, perm in enumerate(realized_permutations):
+            # utils.fancy_print_permutation(perm, realized_relations[i], realized_rewards[i])
+            # print(perm, realized_relations[i], realized_rewards[i])
+
+    instrumentation.emit("search_end", search="calculate_achievable_permutations", num_realized=len(realized),
+                         **instrumentation.summary())
 
     return realized_permutations, realized_relations, realized_rewards
+
+
+def _replay_search(allowed_policies, store, search):
+    # What the search would find, if the store has already decided everything it would solve
+    if search == "dfs":
+        return replay_depth_first_search(allowed_policies, store)
+    weak_orderings = list(generate_weak_orderings(allowed_policies))
+    results = store.get_all(weak_orderings)
+    if results is None:
+        return None
+    return [(*weak_ordering, rewards) for weak_ordering, (success, rewards) in zip(weak_orderings, results) if success]
+
+
+def _flat_search(allowed_policies, make_reward_fun, env, reward_size, ordering_solver, workers,
+                 num_samples, sample_seed, store):
+    # Each weak ordering only once, rather than every permutation with every relation
+    weak_orderings = list(generate_weak_orderings(allowed_policies))
+
+    # Strict orderings that show up when sampling rewards are realizable, so they don't need the solver
+    sampled = {}
+    if num_samples > 0:
+        policy_indices = {policy: i for i, policy in enumerate(allowed_policies)}
+        with get_instrumentation().timer("sampling"):
+            witnesses = sample_strict_orderings(policies=allowed_policies,
+                                                make_reward_fun=make_reward_fun,
+                                                reward_size=reward_size,
+                                                env=env,
+                                                num_samples=num_samples,
+                                                seed=sample_seed)
+        for perm, relation in weak_orderings:
+            order = tuple(policy_indices[policy] for policy in perm)
+            if all(relation) and order in witnesses:
+                sampled[(perm, relation)] = witnesses[order]
+                if store is not None and store.get(perm, relation) is None:
+                    store.put(perm, relation, True, witnesses[order])
+        get_instrumentation().emit("sampling_end", num_samples=num_samples, num_found=len(sampled),
+                                   num_candidates=len(weak_orderings))
+    to_solve = [weak_ordering for weak_ordering in weak_orderings if weak_ordering not in sampled]
+
+    solved = dict(zip(to_solve, solve_weak_orderings(ordering_solver, to_solve, workers=workers, store=store,
+                                                     progress=ProgressTracker("calculate_achievable_permutations",
+                                                                              len(to_solve)))))
+
+    realized = []
+    for weak_ordering in weak_orderings:
+        success, rewards = (True, sampled[weak_ordering]) if weak_ordering in sampled else solved[weak_ordering]
+        if success:
+            realized.append((*weak_ordering, rewards))
+    return realized
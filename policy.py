@@ -1,5 +1,6 @@
 # (c) 2022 Nikolaus Howe
 import dataclasses
+import hashlib
 import numpy as np
 
 from typing import Any, Callable, Union
@@ -35,9 +36,83 @@ class Policy(object):
         return self.name
 
 
-def make_two_state_policy(policy_tuple: tuple[int, int]) -> Policy:
-    return Policy(policy_tuple, lambda state: policy_tuple[state])
+class TabularPolicy(object):
+    """
+    A policy given by the action it takes in each state, as a small integer array of shape (num_states)
+    (or (num_states, action_size) when actions are vectors, like the cleaning robot's).
+
+    It compares equal to, sorts and hashes like a Policy with the same name, so policies are identified by their
+    names alone. The id is a digest of the name's string, which is the same in every process, and it and the
+    name's hash are computed only once, so that hashing and comparing two tabular policies is O(1).
+    There are no closures, so tabular policies can be pickled and sent to worker processes.
+    """
+    __slots__ = ("name", "actions", "id", "sort_key", "_hash", "_action_list")
+
+    def __init__(self, name: Any, actions):
+        self.name = name
+        self.actions = np.array(actions, dtype=np.int64)  # a copy, so that the caller's array isn't frozen
+        self.actions.flags.writeable = False
+        self.sort_key = str(name)
+        self.id = int.from_bytes(hashlib.blake2b(self.sort_key.encode(), digest_size=8).digest(), "little")
+        self._hash = hash(name)
+        # Plain Python actions for single lookups: ints, or tuples for vector actions
+        self._action_list = tuple(action.item() if action.ndim == 0 else tuple(action.tolist())
+                                  for action in self.actions)
+
+    def __call__(self, state: int) -> Union[int, tuple[int, ...]]:
+        return self._action_list[state]
+
+    def get_actions(self, states) -> np.ndarray:
+        """
+        The actions taken in a whole array of states at once
+        """
+        return self.actions[states]
+
+    def __reduce__(self):
+        return TabularPolicy, (self.name, self.actions)
+
+    def __repr__(self):
+        return f"Policy{str(self.name)}"
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if isinstance(other, TabularPolicy):
+            return self.id == other.id
+        return self.sort_key == str(other.name)
+
+    def __le__(self, other):
+        return self.sort_key <= _get_sort_key(other)
+
+    def __lt__(self, other):
+        return self.sort_key < _get_sort_key(other)
+
+    def get_name(self):
+        return self.name
+
+
+POLICY_TYPES = (Policy, TabularPolicy)
+
+
+def _get_sort_key(policy) -> str:
+    return policy.sort_key if isinstance(policy, TabularPolicy) else str(policy.name)
+
+
+def make_deterministic_policy(policy_tuple: tuple[int, ...]) -> TabularPolicy:
+    # policy_tuple[state] is the action taken in that state
+    return TabularPolicy(policy_tuple, policy_tuple)
+
+
+def make_policies_from_action_table(action_table: np.ndarray) -> list[TabularPolicy]:
+    # One policy per row of an action table (see policy_space), named by its tuple of actions like get_policy
+    return [make_deterministic_policy(tuple(row)) for row in np.asarray(action_table).tolist()]
+
+
+def make_two_state_policy(policy_tuple: tuple[int, int]) -> TabularPolicy:
+    return make_deterministic_policy(policy_tuple)
 
 
-def make_cleaning_policy(policy_tuple: tuple[int, int, int]) -> Policy:
-    return Policy(policy_tuple, lambda state: policy_tuple)  # note that we don't care about state in cleaning robot
+def make_cleaning_policy(policy_tuple: tuple[int, int, int]) -> TabularPolicy:
+    # note that we don't care about state in cleaning robot, which only has the one state
+    return TabularPolicy(policy_tuple, [policy_tuple])
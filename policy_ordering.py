@@ -2,63 +2,69 @@
 import itertools
 import numpy as np
 
-from scipy.optimize import minimize
-from typing import Callable
+from typing import Callable, Optional, Union
 
 from environment import MDPWithoutRewardEnv
-from policy import Policy
-import constraints
-
-
-def _policy_ordering_search_solver(eq_constraints: Callable,
-                                   ineq_constraints: Callable,
+from instrumentation import ProgressTracker, get_instrumentation
+from orderings import generate_weak_orderings
+from policy import Policy, make_policies_from_action_table
+from prefix_search import SEARCH_MODES, depth_first_ordering_search, replay_depth_first_search
+from result_store import open_result_store
+from solvers import OrderingSolver, solve_weak_orderings
+from utils import str_permutation
+
+
+def _report_search_result(success: bool,
+                          rewards: np.ndarray,
+                          reward_size: int,
+                          policy_permutation: tuple[Policy],
+                          adjacent_relations: tuple[int],
+                          feature_values: dict) -> None:
+    instrumentation = get_instrumentation()
+    if not instrumentation.enabled:
+        return
+
+    # The values only come from the solver's feature values, when it has them, rather than evaluating the policies
+    values = None
+    if success and feature_values:
+        values = [float(feature_values[policy] @ rewards) for policy in policy_permutation]
+    instrumentation.emit("ordering_result",
+                         ordering=str_permutation(policy_permutation, adjacent_relations),
+                         success=bool(success),
+                         values=values,
+                         rewards=[round(float(reward), 2) for reward in rewards[:reward_size]] if success else None)
+
+
+def _policy_ordering_search_solver(ordering_solver: OrderingSolver,
+                                   adjacent_relations: tuple[int],
                                    make_reward_fun: Callable,
                                    reward_size: int,
                                    policy_permutation: tuple[Policy],
                                    env: MDPWithoutRewardEnv) -> bool:
-    res = minimize(
-        fun=lambda x: 0,
-        x0=np.ones(reward_size),
-        constraints=
-        [{"type": "eq",
-          "fun": eq_constraints},
-         {"type": "ineq",
-          "fun": ineq_constraints}]
-    )
-    if res.success:
-        print("Success! The values of the policies are")
-        temp_rf = make_reward_fun(res.x)
-        all_ave_policy_vals = env.get_all_average_policy_values(policy_permutation=policy_permutation,
-                                                                reward_fun=temp_rf)
-        for i, policy in enumerate(policy_permutation):
-            print(f"{policy}: {round(all_ave_policy_vals[i], 2)}")
-        print()
-
-        print("Using rewards")
-        for i in range(reward_size):
-            print(f"{i}: {round(res.x[i], 2)}")
-        print()
-        print()
-    else:
-        print("Unable to find a reward function that achieves this ordering.")
-        print()
-
-    return res.success
+    success, rewards = ordering_solver(policy_permutation, adjacent_relations)
+    _report_search_result(success, rewards, reward_size, policy_permutation, adjacent_relations,
+                          ordering_solver.feature_values)
+    return success
+
+
+def _make_ordering_solver(policies, make_reward_fun, reward_size, env, solver) -> OrderingSolver:
+    return OrderingSolver(policies=policies if isinstance(policies, np.ndarray) else list(policies),
+                          make_reward_fun=make_reward_fun,
+                          reward_size=reward_size,
+                          env=env,
+                          solver=solver,
+                          x0=np.ones(reward_size))
 
 
 # Given a policy permutation and adjacent policy relations, try to find a reward
 # function which satisfies them.
-def run_policy_ordering_search(policy_permutation, adjacent_relations, make_reward_fun, reward_size, env) -> bool:
-    eq_constraints = constraints.make_eq_constraints(env=env,
-                                                     policy_permutation=policy_permutation,
-                                                     make_reward_fun=make_reward_fun,
-                                                     adjacent_policy_relations=adjacent_relations)
-    ineq_constraints = constraints.make_ineq_constraints(adjacent_policy_relations=adjacent_relations,
-                                                         policy_permutation=policy_permutation,
-                                                         make_reward_fun=make_reward_fun,
-                                                         env=env)
-    success = _policy_ordering_search_solver(eq_constraints=eq_constraints,
-                                             ineq_constraints=ineq_constraints,
+def run_policy_ordering_search(policy_permutation, adjacent_relations, make_reward_fun, reward_size, env,
+                               solver: str = "slsqp",
+                               ordering_solver: Optional[OrderingSolver] = None) -> bool:
+    if ordering_solver is None:
+        ordering_solver = _make_ordering_solver(policy_permutation, make_reward_fun, reward_size, env, solver)
+    success = _policy_ordering_search_solver(ordering_solver=ordering_solver,
+                                             adjacent_relations=adjacent_relations,
                                              make_reward_fun=make_reward_fun,
                                              reward_size=reward_size,
                                              policy_permutation=policy_permutation,
@@ -72,15 +78,17 @@ def run_policy_ordering_search(policy_permutation, adjacent_relations, make_rewa
 def run_adjacent_relation_search(policy_permutation: tuple[Policy],
                                  make_reward_fun: Callable,
                                  reward_size: int,
-                                 env: MDPWithoutRewardEnv) -> list[tuple[int]]:
+                                 env: MDPWithoutRewardEnv,
+                                 solver: str = "slsqp",
+                                 ordering_solver: Optional[OrderingSolver] = None) -> list[tuple[int]]:
     list_of_all_adjacent_relations = list(itertools.product(*([range(2)] * (len(policy_permutation) - 1))))
+    if ordering_solver is None:
+        ordering_solver = _make_ordering_solver(policy_permutation, make_reward_fun, reward_size, env, solver)
 
     successful_relations = []
     for adjacent_relations in list_of_all_adjacent_relations:
-        print(f"Permutation: {policy_permutation}")
-        print(f"Adjacent policy relations: {adjacent_relations}")
-
-        success = run_policy_ordering_search(policy_permutation, adjacent_relations, make_reward_fun, reward_size, env)
+        success = run_policy_ordering_search(policy_permutation, adjacent_relations, make_reward_fun, reward_size, env,
+                                             ordering_solver=ordering_solver)
         if success:
             successful_relations.append(adjacent_relations)
 
@@ -89,17 +97,73 @@ def run_adjacent_relation_search(policy_permutation: tuple[Policy],
 
 # Test all policy orderings and all adjacent policy relations to see if there is a
 # reward function which achieves them.
-def run_full_ordering_search(policies: list[Policy],
+def run_full_ordering_search(policies: Union[list[Policy], np.ndarray],
                              make_reward_fun: Callable,
                              reward_size: int,
-                             env: MDPWithoutRewardEnv) -> list[tuple[tuple[Policy], tuple[int]]]:
-    successful_orderings_with_relations = []
-    for policy_permutation in itertools.permutations(policies):
-        # print("Now considering policy permutation:", policy_permutation)
-        successful_relations = run_adjacent_relation_search(policy_permutation, make_reward_fun, reward_size, env)
-        for successful_relation in successful_relations:
-            successful_orderings_with_relations.append((policy_permutation, successful_relation))
-        # successful_orderings_with_relations.append((policy_permutation, successful_relations))
+                             env: MDPWithoutRewardEnv,
+                             solver: str = "slsqp",  # "slsqp" or "lp", see solvers.OrderingSolver
+                             workers: Optional[int] = None,  # > 1 to solve in a process pool
+                             search: str = "flat",  # "flat" or "dfs", see prefix_search
+                             store_dir: Optional[str] = None,  # where to save and resume results from
+                             ordering_solver: Optional[OrderingSolver] = None,  # to reuse one, eg. across runs
+                             ) -> list[tuple[tuple[Policy], tuple[int]]]:
+    if search not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode {search}, expected one of {SEARCH_MODES}")
+
+    # An action table (see policy_space) goes to the solver as is, so that its feature values are computed at once
+    policy_table = policies
+    if isinstance(policies, np.ndarray):
+        policies = make_policies_from_action_table(policies)
+
+    instrumentation = get_instrumentation()
+    instrumentation.emit("search_start", search="run_full_ordering_search",
+                         policies=[repr(policy) for policy in policies],
+                         solver=solver, search_mode=search, workers=workers)
+
+    with instrumentation.timer("run_full_ordering_search"):
+        store = None
+        if store_dir is not None:
+            store = open_result_store(directory=store_dir,
+                                      env=env,
+                                      policies=list(policies),
+                                      make_reward_fun=make_reward_fun,
+                                      reward_size=reward_size,
+                                      solver=solver if ordering_solver is None else ordering_solver.solver)
+
+        # A resumed search that has everything it needs in the store doesn't set up a solver at all
+        if search == "dfs":
+            realized = None if store is None else replay_depth_first_search(policies, store)
+            if realized is None:
+                if ordering_solver is None:
+                    ordering_solver = _make_ordering_solver(policy_table, make_reward_fun, reward_size, env, solver)
+                realized = depth_first_ordering_search(policies, ordering_solver, workers=workers, store=store)
+            # Only the realizable orderings come out of the depth first search
+            results = [((policy_permutation, adjacent_relations), (True, rewards))
+                       for policy_permutation, adjacent_relations, rewards in realized]
+        else:
+            # Each weak ordering only once, rather than every permutation with every relation
+            weak_orderings = list(generate_weak_orderings(policies))
+            solved = None if store is None else store.get_all(weak_orderings)
+            if solved is None:
+                if ordering_solver is None:
+                    ordering_solver = _make_ordering_solver(policy_table, make_reward_fun, reward_size, env, solver)
+                solved = solve_weak_orderings(ordering_solver, weak_orderings, workers=workers, store=store,
+                                              progress=ProgressTracker("run_full_ordering_search",
+                                                                       len(weak_orderings)))
+            results = zip(weak_orderings, solved)
+        if store is not None:
+            store.close()
+
+        feature_values = {} if ordering_solver is None else ordering_solver.feature_values
+        successful_orderings_with_relations = []
+        for (policy_permutation, adjacent_relations), (success, rewards) in results:
+            _report_search_result(success, rewards, reward_size, policy_permutation, adjacent_relations,
+                                  feature_values)
+            if success:
+                successful_orderings_with_relations.append((policy_permutation, adjacent_relations))
+
+    instrumentation.emit("search_end", search="run_full_ordering_search",
+                         num_realized=len(successful_orderings_with_relations), **instrumentation.summary())
 
     return successful_orderings_with_relations
 
@@ -0,0 +1,89 @@
+# (c) 2022 Nikolaus Howe
+import dataclasses
+import numpy as np
+
+from typing import Callable, Iterator, Optional
+
+from environment import MDPWithoutRewardEnv
+from policy import Policy, make_deterministic_policy
+
+POLICY_CHUNK_SIZE = 4096  # how many policies to put in each action table
+
+
+@dataclasses.dataclass(frozen=True)
+class DeterministicPolicySpace(object):
+    """
+    All num_actions ** num_states deterministic policies of an MDP, in the order of
+    itertools.product(range(num_actions), repeat=num_states), so the first state's action changes slowest.
+
+    Policies are handed out lazily as integer action tables of shape (num_policies, num_states), where
+    row k holds the action of policy start + k in every state. Any policy can be fetched by its index.
+    """
+    num_states: int
+    num_actions: int
+
+    @classmethod
+    def from_env(cls, env: MDPWithoutRewardEnv) -> "DeterministicPolicySpace":
+        return cls(num_states=env.num_states, num_actions=env.num_actions)
+
+    @property
+    def size(self) -> int:
+        # A Python int, since it quickly gets too big for len() or int64
+        return self.num_actions ** self.num_states
+
+    def unrank(self, index: int) -> np.ndarray:
+        if not 0 <= index < self.size:
+            raise IndexError(f"Policy index {index} is out of range for {self.size} policies")
+        actions = np.empty(self.num_states, dtype=np.int64)
+        for state in reversed(range(self.num_states)):
+            index, actions[state] = divmod(index, self.num_actions)
+        return actions
+
+    def rank(self, actions) -> int:
+        index = 0
+        for action in actions:
+            index = index * self.num_actions + int(action)
+        return index
+
+    def get_action_table(self, start: int, stop: int) -> np.ndarray:
+        """
+        The actions of policies start, ..., stop - 1, as an array of shape (stop - start, num_states)
+        """
+        stop = min(stop, self.size)
+        num_policies = max(0, stop - start)
+        table = np.tile(self.unrank(start) if num_policies > 0 else np.zeros(self.num_states, dtype=np.int64),
+                        (num_policies, 1))
+        # Add 0, 1, 2, ... to the first policy's actions as a number in base num_actions, carrying as we go
+        carry = np.arange(num_policies, dtype=np.int64)
+        for state in reversed(range(self.num_states)):
+            if not carry.any():
+                break
+            carry, table[:, state] = np.divmod(table[:, state] + carry, self.num_actions)
+        return table
+
+    def iter_action_tables(self, chunk_size: int = POLICY_CHUNK_SIZE, start: int = 0,
+                           stop: Optional[int] = None) -> Iterator[tuple[int, np.ndarray]]:
+        """
+        Yield (start, action table) for consecutive chunks of the policies from start up to stop
+        """
+        stop = self.size if stop is None else min(stop, self.size)
+        for chunk_start in range(start, stop, chunk_size):
+            yield chunk_start, self.get_action_table(chunk_start, min(chunk_start + chunk_size, stop))
+
+    def get_policy(self, index: int) -> Policy:
+        """
+        The policy with the given index as a Policy object, named by its tuple of actions like make_two_state_policy
+        """
+        return make_deterministic_policy(tuple(int(action) for action in self.unrank(index)))
+
+
+def iter_policy_values(space: DeterministicPolicySpace,
+                       env: MDPWithoutRewardEnv,
+                       reward_fun: Callable[[int, int], float],
+                       chunk_size: int = POLICY_CHUNK_SIZE) -> Iterator[tuple[int, np.ndarray]]:
+    """
+    Yield (start, values) with the average value of every policy in each chunk of the policy space
+    """
+    reward_vector = env.get_tabular_reward(reward_fun)
+    for start, action_table in space.iter_action_tables(chunk_size):
+        yield start, env.get_action_table_occupancy(action_table) @ reward_vector
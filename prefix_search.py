@@ -0,0 +1,109 @@
+# (c) 2022 Nikolaus Howe
+import functools
+import itertools
+import numpy as np
+
+from typing import Iterator, Optional
+
+from instrumentation import ProgressTracker
+from orderings import weak_ordering_from_blocks
+from parallel import parallel_map
+from policy import Policy
+from result_store import ResultStore
+from solvers import OrderingSolver
+
+SEARCH_MODES = ("flat", "dfs")
+
+
+class _UndecidedPrefix(Exception):
+    pass
+
+
+def _extend_prefix(ordering_solver: Optional[OrderingSolver],
+                   policies: list[Policy],
+                   blocks: list[tuple[int]],
+                   remaining: list[int],
+                   store: Optional[ResultStore] = None) -> Iterator[tuple[tuple[Policy], tuple[int], np.ndarray]]:
+    policy_permutation, adjacent_relations = weak_ordering_from_blocks(
+        [tuple(policies[i] for i in block) for block in blocks])
+
+    # However the remaining policies get placed, they end up strictly above the last block.
+    # The remaining policies are determined by the prefix, so the prefix alone is a good store key.
+    result = None if store is None else store.get(policy_permutation, adjacent_relations)
+    if result is None:
+        if ordering_solver is None:  # only replaying what the store has
+            raise _UndecidedPrefix
+        result = ordering_solver(policy_permutation, adjacent_relations,
+                                 policies_above=tuple(policies[i] for i in remaining))
+        if store is not None:
+            store.put(policy_permutation, adjacent_relations, *result)
+    success, rewards = result
+
+    # Every extension of an infeasible prefix adds constraints, so is infeasible too
+    if not success:
+        return
+    if not remaining:
+        yield policy_permutation, adjacent_relations, rewards
+        return
+
+    for block_size in range(1, len(remaining) + 1):
+        for block in itertools.combinations(remaining, block_size):
+            rest = [i for i in remaining if i not in block]
+            yield from _extend_prefix(ordering_solver, policies, blocks + [block], rest, store)
+
+
+def _search_from_first_block(ordering_solver: OrderingSolver,
+                             policies: list[Policy],
+                             store: Optional[ResultStore],
+                             first_block: tuple[int]) -> list[tuple[tuple[Policy], tuple[int], np.ndarray]]:
+    remaining = [i for i in range(len(policies)) if i not in first_block]
+    try:
+        return list(_extend_prefix(ordering_solver, policies, [first_block], remaining, store))
+    finally:
+        if store is not None:
+            store.close()
+
+
+def depth_first_ordering_search(policies: list[Policy],
+                                ordering_solver: OrderingSolver,
+                                workers: Optional[int] = None,
+                                store: Optional[ResultStore] = None,
+                                ) -> list[tuple[tuple[Policy], tuple[int], np.ndarray]]:
+    """
+    Find all realizable weak orderings of the policies by placing them one block of equal policies at a
+    time (worst first), and checking at every node that the policies placed so far can be ordered as they
+    are with all the remaining policies strictly above them. Infeasible prefixes cut off their whole subtree.
+
+    Returns (permutation, relations, rewards) for every realizable weak ordering, in the same order as
+    orderings.generate_weak_orderings. With workers > 1 the subtrees under each possible first block are
+    searched in a process pool. If a result store is given, every decided node is saved to it, and nodes
+    it has already decided are not solved again.
+    """
+    policies = list(policies)
+    first_blocks = _get_first_blocks(len(policies))
+    subtree_results = parallel_map(functools.partial(_search_from_first_block, ordering_solver, policies, store),
+                                   first_blocks, workers=workers,
+                                   progress=ProgressTracker("depth_first_ordering_search", len(first_blocks)))
+    return [result for results in subtree_results for result in results]
+
+
+def replay_depth_first_search(policies: list[Policy],
+                              store: ResultStore) -> Optional[list[tuple[tuple[Policy], tuple[int], np.ndarray]]]:
+    """
+    The result of depth_first_ordering_search taken from a store that has already decided every node it would
+    visit, without needing an ordering solver, or None if some of them haven't been decided yet
+    """
+    policies = list(policies)
+    try:
+        return [result
+                for first_block in _get_first_blocks(len(policies))
+                for result in _extend_prefix(None, policies, [first_block],
+                                             [i for i in range(len(policies)) if i not in first_block], store)]
+    except _UndecidedPrefix:
+        return None
+
+
+def _get_first_blocks(num_policies: int) -> list[tuple[int]]:
+    return [block
+            for block_size in range(1, num_policies + 1)
+            for block in itertools.combinations(range(num_policies), block_size)]
@@ -0,0 +1,168 @@
+# (c) 2022 Nikolaus Howe
+import hashlib
+import json
+import os
+import numpy as np
+
+from typing import Callable, Optional
+
+from environment import MDPWithoutRewardEnv
+from policy import Policy
+
+
+def hash_array(array: np.ndarray, chunk_rows: int = 4096) -> str:
+    """
+    Hash the dtype, shape and contents of an array, a chunk of rows at a time so that memory-mapped arrays
+    don't have to be read into memory all at once
+    """
+    digest = hashlib.sha256(f"{array.dtype.str}{array.shape}".encode())
+    for start in range(0, len(array), chunk_rows):
+        digest.update(np.ascontiguousarray(array[start:start + chunk_rows]).tobytes())
+    return digest.hexdigest()
+
+
+def fingerprint_search(env: MDPWithoutRewardEnv,
+                       policies: list[Policy],
+                       make_reward_fun: Callable,
+                       reward_size: int,
+                       solver: str) -> str:
+    """
+    Hash everything that decides the outcome of an ordering search: the tabulated dynamics, discount and
+    nonnegativity requirement of the env, what each policy does in every state, and what the reward
+    parameterization gives at the visited state-action pairs for a few fixed decision variables.
+    """
+    description = {
+        "discount": env.discount,
+        "num_states": env.num_states,
+        "num_actions": env.num_actions,
+        "require_nonnegative_reward": env.require_nonnegative_reward,
+        "policies": [],
+        "make_reward_fun": f"{getattr(make_reward_fun, '__module__', '')}."
+                           f"{getattr(make_reward_fun, '__qualname__', type(make_reward_fun).__qualname__)}",
+        "reward_size": reward_size,
+        "rewards": [],
+        "solver": solver,
+    }
+
+    # Transitions given as (possibly memory-mapped) arrays are hashed rather than written out in full
+    if env.is_sparse:
+        description["transitions"] = [list(env.transitions.shape)] + [
+            hash_array(array) for array in (env.transitions.data, env.transitions.indices, env.transitions.indptr)]
+    elif env.transitions is not None:
+        description["transitions"] = hash_array(env.transitions)
+    else:
+        description["next_states"] = env.get_next_state_table().tolist()
+    if env.initial_distribution is not None:
+        description["initial_distribution"] = env.initial_distribution.tolist()
+
+    visited = []
+    for policy in policies:
+        actions = [policy(state) for state in range(env.num_states)]
+        visited.extend(zip(range(env.num_states), actions))
+        description["policies"].append({
+            "name": repr(policy.get_name()),
+            "actions": [repr(action) for action in actions],
+            "next_states": None if env.is_stochastic else [env.get_next_state(state, action)
+                                                           for state, action in enumerate(actions)],
+        })
+
+    probes = list(np.eye(reward_size)) + [np.ones(reward_size), np.arange(1., reward_size + 1)]
+    for decision_vars in probes:
+        reward_fun = make_reward_fun(decision_vars)
+        description["rewards"].append([repr(float(reward_fun(state, action))) for state, action in visited])
+
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()[:32]
+
+
+class ResultStore(object):
+    """
+    Append-only on-disk record of decided (permutation, relation) results for one search configuration.
+
+    Results are keyed by the indices of the permutation's policies in the policy list, and are written
+    out one JSON line at a time as soon as they are decided, so a crashed or preempted run loses at most
+    the results that were in flight. Opening the store again loads everything that was already decided.
+    """
+
+    def __init__(self, directory: str, fingerprint: str, policies: list[Policy], reward_size: int):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{fingerprint}.jsonl")
+        self.policy_indices = {policy: i for i, policy in enumerate(policies)}
+        self.reward_size = reward_size
+        self.results = {}
+        self._file = None
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:  # a line cut off by a crash
+                        continue
+                    rewards = None if record["rewards"] is None else np.array(record["rewards"])
+                    self.results[(tuple(record["order"]), tuple(record["relation"]))] = (record["success"], rewards)
+
+    # Don't try to send the open file to worker processes
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_file"] = None
+        return state
+
+    def make_key(self, policy_permutation: tuple[Policy], adjacent_relations: tuple[int]):
+        return tuple(self.policy_indices[policy] for policy in policy_permutation), tuple(adjacent_relations)
+
+    def get(self, policy_permutation: tuple[Policy],
+            adjacent_relations: tuple[int]) -> Optional[tuple[bool, np.ndarray]]:
+        result = self.results.get(self.make_key(policy_permutation, adjacent_relations))
+        if result is not None and not result[0]:
+            return False, np.full(self.reward_size, np.nan)
+        return result
+
+    def get_all(self,
+                weak_orderings: list[tuple[tuple[Policy], tuple[int]]]) -> Optional[list[tuple[bool, np.ndarray]]]:
+        """
+        The results of all the (permutation, relation) pairs, or None if any of them hasn't been decided yet
+        """
+        results = [self.get(*weak_ordering) for weak_ordering in weak_orderings]
+        return None if any(result is None for result in results) else results
+
+    def put(self, policy_permutation: tuple[Policy], adjacent_relations: tuple[int],
+            success: bool, rewards: np.ndarray) -> None:
+        order, relation = self.make_key(policy_permutation, adjacent_relations)
+        self.results[(order, relation)] = (bool(success), np.asarray(rewards) if success else None)
+
+        record = {
+            "order": list(order),
+            "relation": [int(r) for r in relation],
+            "success": bool(success),
+            "rewards": [float(r) for r in rewards] if success else None,
+        }
+        if self._file is None:
+            self._file = open(self.path, "a")
+            # If a crash cut off the last line, start on a fresh one
+            if self._file.tell() > 0:
+                with open(self.path, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        self._file.write("\n")
+        # One write per line, so that lines from different worker processes don't interleave
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def open_result_store(directory: str,
+                      env: MDPWithoutRewardEnv,
+                      policies: list[Policy],
+                      make_reward_fun: Callable,
+                      reward_size: int,
+                      solver: str) -> ResultStore:
+    fingerprint = fingerprint_search(env=env,
+                                     policies=policies,
+                                     make_reward_fun=make_reward_fun,
+                                     reward_size=reward_size,
+                                     solver=solver)
+    return ResultStore(directory, fingerprint, policies, reward_size)
@@ -1,8 +1,9 @@
 # (c) 2022 Nikolaus Howe
-from experiments.cleaning_robot_experiments import run_cleaning_robot_experiment
-from experiments.two_state_mdp_experiments import run_two_state_mdp_experiment
+import sys
+
+from runner import main
 
 
 if __name__ == "__main__":
-    # run_cleaning_robot_experiment()
-    run_two_state_mdp_experiment()
+    # Without arguments, run the two-state MDP experiment as before; see runner.py for running batches of specs
+    main(sys.argv[1:] or ["--preset", "two_state_mdp"])
@@ -0,0 +1,293 @@
+# (c) 2022 Nikolaus Howe
+"""
+Runs a batch of experiments from a JSON file of specs in one long-lived process (or a pool of them), instead of
+editing run.py and the experiments for every configuration:
+
+    python runner.py specs.json --workers 4 --output results.jsonl
+    python runner.py --preset two_state_mdp --preset cleaning_robot
+
+The file holds a list of specs (or {"experiments": [...]}), each a dictionary with the fields of ExperimentSpec.
+A spec can start from one of the PRESETS and override some of its fields, eg.
+
+    [{"preset": "two_state_mdp", "name": "two_state_0.9", "discount": 0.9, "stages": ["orderings"]},
+     {"env": "two_state", "policies": [[0, 0], [1, 1]], "reward": "state", "solver": "lp"}]
+
+Specs with the same environment run in the same process, in the order given, so they share the environment's
+tabulated dynamics and occupancy cache, and (for the same policies, reward and solver) the ordering solver.
+The pool only spreads those groups across workers, so specs that are all on one environment run one after the
+other; to run their searches in parallel instead, leave out --workers and give the specs their own workers.
+"""
+import argparse
+import dataclasses
+import functools
+import json
+import os
+import sys
+import time
+import numpy as np
+
+from typing import Any, Callable, Optional
+
+from environment import MDPWithoutRewardEnv
+from experiments import cleaning_robot_experiments, two_state_mdp_experiments
+from parallel import parallel_map
+from policy import Policy, make_cleaning_policy, make_two_state_policy
+from solvers import OrderingSolver
+from utils import str_permutation
+
+STAGES = ("permutations", "orderings", "ungameability", "simplification")
+
+
+@dataclasses.dataclass(frozen=True)
+class Environment(object):
+    """
+    How to build one of the experiments' environments, its policies (from tuples of actions), and its reward
+    parameterizations, as {name: (make_reward_fun, reward_size)}
+    """
+    make_env: Callable[..., MDPWithoutRewardEnv]
+    make_policy: Callable[[tuple], Policy]
+    all_policies: tuple[tuple, ...]
+    rewards: dict[str, tuple[Callable, int]]
+
+
+def _make_two_state_env(discount: float, policy_evaluation: str) -> MDPWithoutRewardEnv:
+    return MDPWithoutRewardEnv(dynamics=two_state_mdp_experiments.dynamics, discount=discount,
+                               policy_evaluation=policy_evaluation)
+
+
+def _make_cleaning_env(discount: float, policy_evaluation: str) -> MDPWithoutRewardEnv:
+    return MDPWithoutRewardEnv(dynamics=cleaning_robot_experiments.cleaning_dynamics, discount=discount,
+                               num_states=1, num_actions=8, require_nonnegative_reward=True,
+                               policy_evaluation=policy_evaluation)
+
+
+ENVIRONMENTS = {
+    "two_state": Environment(
+        make_env=_make_two_state_env,
+        make_policy=make_two_state_policy,
+        all_policies=((0, 0), (0, 1), (1, 0), (1, 1)),
+        rewards={"state_action": (two_state_mdp_experiments.make_reward_fun_from_dec_vars,
+                                  two_state_mdp_experiments.REWARD_SIZE),
+                 "state": (two_state_mdp_experiments.make_state_reward_fun_from_dec_vars,
+                           two_state_mdp_experiments.STATE_REWARD_SIZE)}),
+    "cleaning_robot": Environment(
+        make_env=_make_cleaning_env,
+        make_policy=make_cleaning_policy,
+        all_policies=((0, 0, 0), (0, 0, 1), (0, 1, 0), (0, 1, 1), (1, 0, 0), (1, 0, 1), (1, 1, 0), (1, 1, 1)),
+        rewards={"rooms": (cleaning_robot_experiments.make_reward_fun, cleaning_robot_experiments.REWARD_SIZE)}),
+}
+
+
+@dataclasses.dataclass
+class ExperimentSpec(object):
+    """
+    One experiment: which environment (a key of ENVIRONMENTS), discount, policies (as tuples of actions, all of
+    them if None) and reward parameterization (the environment's first if None), and which of STAGES to run,
+    with the options for the searches and the graphs. The graph stages also run the ordering search if it isn't
+    one of the stages. Outputs go to output_dir/name.
+    """
+    name: str
+    env: str
+    discount: float = 0.5
+    policies: Optional[list[tuple]] = None
+    reward: Optional[str] = None
+    stages: tuple[str, ...] = STAGES
+    solver: str = "slsqp"
+    search: str = "flat"
+    workers: Optional[int] = None  # for the searches, which only applies when the specs themselves run serially
+    policy_evaluation: str = "recursive"
+    transitive_reduction: bool = False
+    plot_options: dict[str, Any] = dataclasses.field(default_factory=dict)  # for make_ungameability_graph etc.
+    output_dir: str = "results"
+
+    def __post_init__(self):
+        if self.env not in ENVIRONMENTS:
+            raise ValueError(f"Unknown environment {self.env}, expected one of {tuple(ENVIRONMENTS)}")
+        environment = ENVIRONMENTS[self.env]
+        self.policies = [tuple(policy) for policy in (self.policies or environment.all_policies)]
+        self.reward = self.reward or next(iter(environment.rewards))
+        if self.reward not in environment.rewards:
+            raise ValueError(f"Unknown reward {self.reward} for {self.env}, expected one of "
+                             f"{tuple(environment.rewards)}")
+        self.stages = tuple(self.stages)
+        for stage in self.stages:
+            if stage not in STAGES:
+                raise ValueError(f"Unknown stage {stage}, expected one of {STAGES}")
+
+    @property
+    def env_key(self) -> tuple:
+        return self.env, self.discount, self.policy_evaluation
+
+
+# The experiments from run_two_state_mdp_experiment and run_cleaning_robot_experiment
+PRESETS = {
+    "two_state_mdp": {"env": "two_state", "discount": 0.5, "reward": "state_action"},
+    "cleaning_robot": {"env": "cleaning_robot", "discount": 0., "reward": "rooms",
+                       "policies": [(0, 0, 1), (1, 1, 0), (1, 1, 1)]},
+}
+
+
+def make_spec(config: dict[str, Any]) -> ExperimentSpec:
+    config = dict(config)
+    preset = config.pop("preset", None)
+    if preset is not None:
+        if preset not in PRESETS:
+            raise ValueError(f"Unknown preset {preset}, expected one of {tuple(PRESETS)}")
+        config = {"name": preset, **PRESETS[preset], **config}
+    return ExperimentSpec(**config)
+
+
+def load_specs(path: str) -> list[ExperimentSpec]:
+    with open(path) as f:
+        configs = json.load(f)
+    if isinstance(configs, dict):
+        configs = configs["experiments"]
+    specs = [make_spec(config) for config in configs]
+    names = [spec.name for spec in specs]
+    if len(set(names)) < len(names):
+        raise ValueError("Experiment names have to be unique, since they name the output directories")
+    return specs
+
+
+# Shared by all the specs run in this process
+_envs: dict[tuple, MDPWithoutRewardEnv] = {}
+_ordering_solvers: dict[tuple, OrderingSolver] = {}
+
+
+def get_env(spec: ExperimentSpec) -> MDPWithoutRewardEnv:
+    if spec.env_key not in _envs:
+        _envs[spec.env_key] = ENVIRONMENTS[spec.env].make_env(spec.discount, spec.policy_evaluation)
+    return _envs[spec.env_key]
+
+
+def get_ordering_solver(spec: ExperimentSpec, policies: list[Policy], stage: str) -> OrderingSolver:
+    # The two searches start SLSQP from different points, so they each get their own solver
+    key = (spec.env_key, tuple(spec.policies), spec.reward, spec.solver, stage)
+    if key not in _ordering_solvers:
+        make_reward_fun, reward_size = ENVIRONMENTS[spec.env].rewards[spec.reward]
+        x0 = np.zeros(reward_size) if stage == "permutations" else np.ones(reward_size)
+        _ordering_solvers[key] = OrderingSolver(policies=list(policies), make_reward_fun=make_reward_fun,
+                                                reward_size=reward_size, env=get_env(spec), solver=spec.solver,
+                                                x0=x0)
+    return _ordering_solvers[key]
+
+
+def run_experiment(spec: ExperimentSpec, workers: Optional[int] = None) -> dict[str, Any]:
+    """
+    Run the stages of the spec, and return a record of what they found and how long they took
+    """
+    from gameability import get_ungameable_pairs, make_ungameability_graph
+    from permutations import calculate_achievable_permutations
+    from policy_ordering import run_full_ordering_search
+    from simplification import get_simplification_pairs, make_simplification_graph
+
+    environment = ENVIRONMENTS[spec.env]
+    env = get_env(spec)
+    policies = [environment.make_policy(policy) for policy in spec.policies]
+    make_reward_fun, reward_size = environment.rewards[spec.reward]
+    output_dir = os.path.join(spec.output_dir, spec.name)
+    os.makedirs(output_dir, exist_ok=True)
+    search_options = {"make_reward_fun": make_reward_fun, "reward_size": reward_size, "env": env,
+                      "solver": spec.solver, "workers": workers, "search": spec.search}
+
+    record = {"name": spec.name, "spec": dataclasses.asdict(spec), "seconds": {}}
+    start = time.perf_counter()
+    if "permutations" in spec.stages:
+        realized_permutations, _, _ = calculate_achievable_permutations(
+            allowed_policies=policies, ordering_solver=get_ordering_solver(spec, policies, "permutations"),
+            **search_options)
+        record["num_achievable_permutations"] = len(realized_permutations)
+        record["seconds"]["permutations"] = time.perf_counter() - start
+
+    orderings = None
+    if {"orderings", "ungameability", "simplification"} & set(spec.stages):
+        start = time.perf_counter()
+        orderings = run_full_ordering_search(policies=policies,
+                                             ordering_solver=get_ordering_solver(spec, policies, "orderings"),
+                                             **search_options)
+        record["num_realized_orderings"] = len(orderings)
+        record["realized_orderings"] = [str_permutation(*ordering) for ordering in orderings]
+        record["seconds"]["orderings"] = time.perf_counter() - start
+
+    if "ungameability" in spec.stages:
+        start = time.perf_counter()
+        title = os.path.join(output_dir, "Ungameability Graph")
+        _, summary = make_ungameability_graph(get_ungameable_pairs(orderings), title=title,
+                                              summary_path=f"{title} Summary.json", **spec.plot_options)
+        record["ungameability"] = {key: summary[key] for key in ("num_nodes", "num_edges", "num_components")}
+        record["seconds"]["ungameability"] = time.perf_counter() - start
+
+    if "simplification" in spec.stages:
+        start = time.perf_counter()
+        title = os.path.join(output_dir, "Simplification Graph")
+        pairs = get_simplification_pairs(orderings, transitive_reduction=spec.transitive_reduction)
+        _, summary = make_simplification_graph(pairs, title=title, summary_path=f"{title} Summary.json",
+                                               **spec.plot_options)
+        record["simplification"] = {key: summary[key] for key in ("num_nodes", "num_edges", "num_components")}
+        record["seconds"]["simplification"] = time.perf_counter() - start
+
+    return record
+
+
+def _run_group(specs: list[ExperimentSpec], workers: Optional[int] = None) -> list[dict[str, Any]]:
+    return [run_experiment(spec, workers=spec.workers if workers is None else workers) for spec in specs]
+
+
+def run_experiments(specs: list[ExperimentSpec],
+                    workers: Optional[int] = None,
+                    output: Optional[str] = None) -> list[dict[str, Any]]:
+    """
+    Run all the specs, spreading the groups of specs with the same environment across a process pool of the
+    given number of workers (in which case each spec's own searches run serially, and each group's specs one
+    after the other). Returns the records in the
+    order of the specs, and also appends them to the output JSON lines file if given.
+    """
+    groups = {}
+    for i, spec in enumerate(specs):
+        groups.setdefault(spec.env_key, []).append(i)
+
+    if workers is None or workers <= 1:
+        group_records = [_run_group([specs[i] for i in group]) for group in groups.values()]
+    else:
+        # One process pool at a time: the specs' own searches don't start pools inside the workers
+        group_records = parallel_map(functools.partial(_run_group, workers=1),
+                                     [[specs[i] for i in group] for group in groups.values()],
+                                     workers=workers, chunksize=1)
+
+    records = [None] * len(specs)
+    for group, group_record in zip(groups.values(), group_records):
+        for i, record in zip(group, group_record):
+            records[i] = record
+
+    if output is not None:
+        with open(output, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+    return records
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("specs", nargs="?", help="JSON file with the list of experiment specs")
+    parser.add_argument("--preset", action="append", default=[], choices=sorted(PRESETS),
+                        help="also run a built-in experiment (can be given several times)")
+    parser.add_argument("--workers", type=int, default=None, help="run the experiments in a process pool")
+    parser.add_argument("--output", default=None, help="JSON lines file to append the results to")
+    parser.add_argument("--output-dir", default=None, help="where to put the graphs, instead of each spec's")
+    args = parser.parse_args(argv)
+
+    specs = load_specs(args.specs) if args.specs is not None else []
+    specs += [make_spec({"preset": preset}) for preset in args.preset]
+    if not specs:
+        parser.error("nothing to run, give a specs file or a --preset")
+    if args.output_dir is not None:
+        specs = [dataclasses.replace(spec, output_dir=args.output_dir) for spec in specs]
+
+    for record in run_experiments(specs, workers=args.workers, output=args.output):
+        counts = {key: value for key, value in record.items() if key.startswith("num_")}
+        seconds = sum(record["seconds"].values())
+        print(f"{record['name']}: {counts} in {seconds:.2f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
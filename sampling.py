@@ -0,0 +1,71 @@
+# (c) 2022 Nikolaus Howe
+import numpy as np
+
+from typing import Callable, Optional
+
+from environment import MDPWithoutRewardEnv
+from policy import Policy
+import constraints
+
+SAMPLE_BATCH_SIZE = 100_000  # how many reward vectors to score at once
+TIE_TOLERANCE = 1e-9  # relative gap below which we don't trust that two policy values are different
+
+
+def sample_reward_vectors(rng: np.random.Generator, num_samples: int, reward_size: int,
+                          require_nonnegative_reward: bool = False) -> np.ndarray:
+    samples = rng.standard_normal((num_samples, reward_size))
+    if require_nonnegative_reward:
+        samples = np.abs(samples)
+    return samples
+
+
+def sample_strict_orderings(policies: list[Policy],
+                            make_reward_fun: Callable,
+                            reward_size: int,
+                            env: MDPWithoutRewardEnv,
+                            num_samples: int,
+                            batch_size: int = SAMPLE_BATCH_SIZE,
+                            seed: Optional[int] = 0,
+                            feature_values: Optional[np.ndarray] = None) -> dict[tuple[int], np.ndarray]:
+    """
+    Find strict orderings of the policies by sampling reward vectors and sorting the policy values.
+    make_reward_fun has to be linear in its decision variables, so that all the policies can be
+    scored under a whole batch of samples with one matrix product.
+
+    Returns a dict from each observed ordering (as a tuple of indices into policies, worst first)
+    to a witness reward vector, scaled so that adjacent policies are at least constraints.EPSILON apart.
+    """
+    if feature_values is None:
+        feature_values = constraints.get_policy_feature_values(policies=policies,
+                                                               make_reward_fun=make_reward_fun,
+                                                               reward_size=reward_size,
+                                                               env=env)
+        if not constraints.check_linear_reward_parameterization(policies=policies,
+                                                                make_reward_fun=make_reward_fun,
+                                                                reward_size=reward_size,
+                                                                env=env,
+                                                                feature_values=feature_values):
+            raise ValueError("Reward sampling needs make_reward_fun to be linear in its decision variables")
+
+    rng = np.random.default_rng(seed)
+    witnesses = {}
+    for start in range(0, num_samples, batch_size):
+        samples = sample_reward_vectors(rng, min(batch_size, num_samples - start), reward_size,
+                                        env.require_nonnegative_reward)
+        values = samples @ feature_values.T
+        orders = np.argsort(values, axis=1)
+        gaps = np.diff(np.take_along_axis(values, orders, axis=1), axis=1).min(axis=1, initial=np.inf)
+
+        # Ties have probability zero, but don't trust orderings that are tied up to floating point error
+        scale = np.abs(values).max(axis=1, initial=0.)
+        strict = gaps > TIE_TOLERANCE * np.maximum(scale, 1.)
+        unique_orders, first_indices = np.unique(orders[strict], axis=0, return_index=True)
+
+        strict_samples = samples[strict]
+        strict_gaps = gaps[strict]
+        for order, i in zip(unique_orders, first_indices):
+            order = tuple(int(j) for j in order)
+            if order not in witnesses:
+                witnesses[order] = strict_samples[i] * constraints.EPSILON / strict_gaps[i]
+
+    return witnesses
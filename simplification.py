@@ -1,14 +1,16 @@
 # 2022 (c) Nikolaus Howe
-import matplotlib
-import matplotlib.pyplot as plt
-import networkx as nx
+import numpy as np
 
-from typing import Any, Callable
+from typing import Any, Callable, Iterator, Optional, Sequence
 
 from environment import MDPWithoutRewardEnv
-from policy import Policy
+from bitsets import RELATION_ENCODINGS, PairBitsets, iter_bitset_simplification_chunks, iter_edges
+from orderings import get_policy_ranks, get_preference_indicators, make_rank_matrix
+from policy import POLICY_TYPES, Policy
 from utils import fancy_str_permutation
 
+SIMPLIFICATION_CHUNK_SIZE = 1024  # how many orderings to compare against all the others at once
+
 
 def get_set_representation(ordering, relation):
     list_of_sets = [{ordering[0]}]
@@ -29,10 +31,14 @@ def get_set_index(policy, list_of_sets):
     raise ValueError("Policy not in list of sets")
 
 
-# Check whether ordering_and_relation_1 is a simplification of ordering_and_relation_2
+# Check whether ordering_and_relation_2 is a simplification of ordering_and_relation_1, that is, whether it only
+# turns some of the strict preferences of ordering_and_relation_1 into ties
 def check_simplification(ordering_and_relation_1, ordering_and_relation_2):
-    list_of_sets_1 = get_set_representation(*ordering_and_relation_1)
-    list_of_sets_2 = get_set_representation(*ordering_and_relation_2)
+    ranks_1 = get_policy_ranks(*ordering_and_relation_1)
+    ranks_2 = get_policy_ranks(*ordering_and_relation_2)
+    if not ranks_1.keys() <= ranks_2.keys():
+        missing = [policy for policy in ranks_1 if policy not in ranks_2]
+        raise ValueError(f"The second ordering doesn't rank {missing}, which the first ordering does")
 
     policies = ordering_and_relation_1[0]
 
@@ -42,10 +48,8 @@ def check_simplification(ordering_and_relation_1, ordering_and_relation_2):
             if policy1 == policy2:
                 continue
             else:
-                idx1 = get_set_index(policy1, list_of_sets_1)
-                idx2 = get_set_index(policy2, list_of_sets_1)
-                iidx1 = get_set_index(policy1, list_of_sets_2)
-                iidx2 = get_set_index(policy2, list_of_sets_2)
+                idx1, idx2 = ranks_1[policy1], ranks_1[policy2]
+                iidx1, iidx2 = ranks_2[policy1], ranks_2[policy2]
                 if idx1 < idx2 and iidx1 > iidx2:
                     return False
                 elif idx1 == idx2 and iidx1 != iidx2:
@@ -56,6 +60,118 @@ def check_simplification(ordering_and_relation_1, ordering_and_relation_2):
     return found_different
 
 
+def iter_simplification_chunks(rank_matrix: np.ndarray,
+                               chunk_size: int = SIMPLIFICATION_CHUNK_SIZE) -> Iterator[tuple[int, np.ndarray]]:
+    """
+    Yield (start, block) for consecutive chunks of rows of the simplification relation between the orderings
+    in the rank matrix, where block[k, j] is check_simplification(ordering start + k, ordering j): ordering j
+    only turns some of the strict preferences of ordering start + k into ties, and at least one of them.
+    """
+    above, below, tied = get_preference_indicators(rank_matrix)
+    # A pair is fine as long as it is not strictly reversed, or tied in the first ordering but not in the second
+    not_kept = np.concatenate([above, tied], axis=1)
+    broken = np.concatenate([below, above + below], axis=1)
+    strict = above + below
+    for start in range(0, len(rank_matrix), chunk_size):
+        rows = slice(start, start + chunk_size)
+        block = (not_kept[rows] @ broken.T == 0) & (strict[rows] @ tied.T > 0)
+        yield start, block
+
+
+def get_transitive_reduction(relation: np.ndarray, chunk_size: int = SIMPLIFICATION_CHUNK_SIZE) -> np.ndarray:
+    """
+    Remove every edge (i, j) of a transitive and irreflexive boolean relation for which there is some k with
+    edges (i, k) and (k, j), leaving its Hasse diagram
+    """
+    as_float = relation.astype(np.float32)
+    reduction = relation.copy()
+    for start in range(0, len(relation), chunk_size):
+        rows = slice(start, start + chunk_size)
+        reduction[rows] &= as_float[rows] @ as_float == 0
+    return reduction
+
+
+def get_simplification_matrix(rank_matrix: np.ndarray,
+                              chunk_size: int = SIMPLIFICATION_CHUNK_SIZE,
+                              transitive_reduction: bool = False) -> np.ndarray:
+    """
+    The full (num_orderings, num_orderings) boolean simplification relation, see iter_simplification_chunks.
+    With transitive_reduction, only keep the simplifications which don't go through another of the orderings.
+    """
+    matrix = np.zeros((len(rank_matrix), len(rank_matrix)), dtype=bool)
+    for start, block in iter_simplification_chunks(rank_matrix, chunk_size):
+        matrix[start:start + len(block)] = block
+    if transitive_reduction:
+        matrix = get_transitive_reduction(matrix, chunk_size)
+    return matrix
+
+
+def get_sparse_transitive_reduction(edges: np.ndarray, num_nodes: int) -> np.ndarray:
+    """
+    get_transitive_reduction for a relation given as an array of (row, column) edges
+    """
+    import scipy.sparse
+
+    relation = scipy.sparse.csr_matrix((np.ones(len(edges), dtype=np.int64), (edges[:, 0], edges[:, 1])),
+                                       shape=(num_nodes, num_nodes))
+    two_step = (relation @ relation).astype(bool)
+    reduction = scipy.sparse.csr_matrix(relation - relation.multiply(two_step))
+    reduction.eliminate_zeros()
+    reduction.sort_indices()
+    rows = np.repeat(np.arange(num_nodes), np.diff(reduction.indptr))
+    return np.stack([rows, reduction.indices], axis=1)
+
+
+def get_simplification_edges(rank_matrix: np.ndarray,
+                             chunk_size: int = SIMPLIFICATION_CHUNK_SIZE,
+                             transitive_reduction: bool = False,
+                             encoding: str = "dense") -> np.ndarray:
+    """
+    The simplification relation as an array of (finer, simpler) indices into the rank matrix. With
+    encoding="bitset" the orderings are compared as packed bitsets (see bitsets.PairBitsets) without
+    building the full matrix, which takes far less memory, and chunk_size is chosen automatically.
+    """
+    if encoding not in RELATION_ENCODINGS:
+        raise ValueError(f"Unknown encoding {encoding}, expected one of {RELATION_ENCODINGS}")
+    if encoding == "dense":
+        return np.argwhere(get_simplification_matrix(rank_matrix, chunk_size, transitive_reduction))
+
+    edges = list(iter_edges(iter_bitset_simplification_chunks(PairBitsets.from_rank_matrix(rank_matrix))))
+    edges = np.concatenate(edges) if edges else np.zeros((0, 2), dtype=int)
+    if transitive_reduction:
+        edges = get_sparse_transitive_reduction(edges, len(rank_matrix))
+    return edges
+
+
+def get_simplification_pairs(orderings_and_relations: Sequence[tuple[tuple[Policy], tuple[int]]],
+                             chunk_size: int = SIMPLIFICATION_CHUNK_SIZE,
+                             transitive_reduction: bool = False,
+                             encoding: str = "dense") -> list[tuple[Any, Any]]:
+    """
+    All pairs of (permutation, relations) that check_simplification accepts, with the finer ordering first and
+    its simplification second, in the format that make_simplification_graph takes. The orderings all have to be
+    of the same policies. transitive_reduction keeps only the Hasse diagram, which is much smaller to draw.
+    """
+    orderings_and_relations = list(orderings_and_relations)
+    rank_matrix, _ = make_rank_matrix(orderings_and_relations)
+    edges = get_simplification_edges(rank_matrix, chunk_size, transitive_reduction, encoding)
+    return [(orderings_and_relations[i], orderings_and_relations[j]) for i, j in edges]
+
+
+def get_simplification_adjacency(rank_matrix: np.ndarray,
+                                 chunk_size: int = SIMPLIFICATION_CHUNK_SIZE,
+                                 transitive_reduction: bool = False,
+                                 encoding: str = "dense"):
+    """
+    The simplification relation as a boolean scipy.sparse adjacency matrix over the rows of the rank matrix,
+    for graph_analysis.summarize_graph, without going through tuples of policies
+    """
+    from graph_analysis import make_adjacency_matrix
+
+    edges = get_simplification_edges(rank_matrix, chunk_size, transitive_reduction, encoding)
+    return make_adjacency_matrix(edges, len(rank_matrix))
+
+
 def get_policy_values(policies: list[Policy], reward_fun: Callable, env: MDPWithoutRewardEnv):
     policies_and_values = []
     for policy in policies:
@@ -74,59 +190,42 @@ def get_simplifications_policies_and_values(policies: list[Policy], reward_fun:
     return simplified_policies
 
 
-def plot_graph(nodes, edges, labels, title="Graph"):
-    matplotlib.use("pgf")
-    matplotlib.rcParams.update({
-        "pgf.texsystem": "pdflatex",
-        'font.family': 'serif',
-        'text.usetex': True,
-        'pgf.rcfonts': False,
-    })
-
-    G = nx.DiGraph()
-    G.add_edges_from(edges)
-
-    options = {"edgecolors": "tab:blue", "node_size": 1000, "alpha": 1}
-
-    pos = nx.spring_layout(G, seed=3113794651)  # positions for all nodes
-
-    nx.draw_networkx_nodes(G, pos, nodelist=nodes, node_color="tab:blue", **options)
-    nx.draw_networkx_edges(
-        G,
-        pos,
-        edgelist=edges,
-        width=1,
-        alpha=1,
-        edge_color="tab:blue",
-        node_size=1000,
-    )
-    nx.draw_networkx_labels(G, pos, labels, font_size=4, font_color="black", font_weight="bold")
-
-    plt.tight_layout()
-    plt.axis("off")
-
-    plt.savefig(f'{title}.pdf')
-    plt.close()
-
-
 # TODO: make graph layout work better
-def make_simplification_graph(simplified_policy_pairs: list[tuple[Any, Any]]):
-    edges = set()
-    nodes = set()
+def make_simplification_graph(simplified_policy_pairs: list[tuple[Any, Any]], plot: bool = True,
+                              title: str = "Simplification Graph",
+                              summary_path: Optional[str] = "Simplification Graph Summary.json", **plot_options):
+    """
+    Build the simplification graph as a sparse adjacency matrix over integer ids of the orderings, numbered in the
+    order they first appear in the pairs, and write its summary (see graph_analysis.summarize_graph) to
+    summary_path. If plot, also draw it to {title}.pdf (or another file_format), see graphs.plot_graph for the
+    plot_options (renderer, file_format, layout and export_formats). Returns the adjacency matrix and the summary.
+    """
+    # The graph analysis and plotting layers are only imported here, so that importing this module for the order
+    # relations alone doesn't load scipy.sparse, matplotlib and networkx
+    from graph_analysis import get_edges, make_adjacency_matrix, summarize_graph, write_graph_summary
+    from graphs import plot_graph
+
+    node_ids = {}
+    edges = np.zeros((len(simplified_policy_pairs), 2), dtype=np.int64)
     print("The simplifications are")
-    for first, second in simplified_policy_pairs:
-        edges.add((first, second))
-        nodes.add(first)
-        nodes.add(second)
+    for k, (first, second) in enumerate(simplified_policy_pairs):
+        edges[k] = node_ids.setdefault(first, len(node_ids)), node_ids.setdefault(second, len(node_ids))
         print(first, "->", second)
 
-    nodes = list(nodes)
+    nodes = list(node_ids)
+    adjacency = make_adjacency_matrix(edges, len(nodes), symmetric=False)
 
-    labels = {}
+    labels = []
     for node in nodes:
-        if type(node[0][0]) == Policy:
-            labels[node] = fancy_str_permutation(*node)
+        if isinstance(node[0][0], POLICY_TYPES):
+            labels.append(fancy_str_permutation(*node))
         else:
-            labels[node] = node
-
-    plot_graph(nodes, edges, labels, title="Simplification Graph")
+            labels.append(str(node))
+
+    summary = summarize_graph(adjacency, directed=True)
+    if summary_path is not None:
+        write_graph_summary(summary, summary_path, labels)
+    if plot:
+        plot_graph(list(range(len(nodes))), [tuple(edge) for edge in get_edges(adjacency)],
+                   dict(enumerate(labels)), title=title, directed=True, **plot_options)
+    return adjacency, summary
@@ -0,0 +1,181 @@
+# (c) 2022 Nikolaus Howe
+import dataclasses
+import time
+import warnings
+import numpy as np
+
+from scipy.optimize import linprog, minimize
+from typing import Callable, Optional, Union
+
+from environment import MDPWithoutRewardEnv
+from instrumentation import get_instrumentation
+from parallel import parallel_map
+from policy import Policy, make_policies_from_action_table
+from result_store import ResultStore
+import constraints
+
+SOLVERS = ("slsqp", "lp")
+# With exact constraint Jacobians, SLSQP can run off towards infinity on an infeasible problem, until the constraints
+# can't be told apart from zero in floating point. Past this size, they are no longer accurate to a fraction of EPSILON.
+MAX_REWARD_MAGNITUDE = 1e9
+
+
+@dataclasses.dataclass
+class OrderingSolver(object):
+    """
+    Decides whether a weak ordering of (some of) the given policies can be realized by a reward function.
+
+    "slsqp" runs scipy's minimize with a zero objective on the constraint functions, and works for any
+    make_reward_fun. "lp" requires make_reward_fun to be linear in its decision variables: it tabulates
+    each policy's value under every unit decision variable once, and then decides feasibility exactly
+    with a linear program. If make_reward_fun turns out not to be linear, we fall back to "slsqp".
+
+    A make_reward_fun can declare its features (constraints.declare_reward_features), in which case both solvers
+    take the feature values from those once (after spot checking them, raising ValueError if they don't match),
+    and SLSQP gets exact, vectorized constraints. One that declares its Jacobian instead
+    (constraints.declare_reward_jacobian) gives SLSQP exact constraint Jacobians.
+
+    The policies can also be an action table (see policy_space), whose feature values are then computed all at
+    once. Its rows are turned into TabularPolicy objects, which is what the orderings are then made of.
+    """
+    policies: Union[list[Policy], np.ndarray]
+    make_reward_fun: Callable
+    reward_size: int
+    env: MDPWithoutRewardEnv
+    solver: str = "slsqp"
+    x0: Optional[np.ndarray] = None
+    feature_values: dict = dataclasses.field(default_factory=dict, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.solver not in SOLVERS:
+            raise ValueError(f"Unknown solver {self.solver}, expected one of {SOLVERS}")
+        if self.x0 is None:
+            self.x0 = np.zeros(self.reward_size)
+        policy_table = self.policies
+        if isinstance(self.policies, np.ndarray):
+            self.policies = make_policies_from_action_table(self.policies)
+
+        if constraints.get_reward_features(self.make_reward_fun) is not None:
+            if not constraints.check_reward_features(policies=policy_table,
+                                                     make_reward_fun=self.make_reward_fun,
+                                                     reward_size=self.reward_size,
+                                                     env=self.env):
+                raise ValueError("make_reward_fun doesn't match the reward features it declares")
+            with get_instrumentation().timer("feature_values"):
+                feature_values = constraints.get_policy_feature_values(policies=policy_table,
+                                                                       make_reward_fun=self.make_reward_fun,
+                                                                       reward_size=self.reward_size,
+                                                                       env=self.env)
+            self.feature_values = dict(zip(self.policies, feature_values))
+        elif self.solver == "lp":
+            with get_instrumentation().timer("feature_values"):
+                feature_values = constraints.get_policy_feature_values(policies=policy_table,
+                                                                       make_reward_fun=self.make_reward_fun,
+                                                                       reward_size=self.reward_size,
+                                                                       env=self.env)
+                is_linear = constraints.check_linear_reward_parameterization(policies=policy_table,
+                                                                             make_reward_fun=self.make_reward_fun,
+                                                                             reward_size=self.reward_size,
+                                                                             env=self.env,
+                                                                             feature_values=feature_values)
+            if is_linear:
+                self.feature_values = dict(zip(self.policies, feature_values))
+            else:
+                warnings.warn("make_reward_fun is not linear in its decision variables, falling back to SLSQP")
+                self.solver = "slsqp"
+
+    def __call__(self, policy_permutation: tuple[Policy],
+                 adjacent_policy_relations: tuple[int],
+                 policies_above: tuple[Policy] = ()) -> tuple[bool, np.ndarray]:
+        """
+        Optionally, policies_above all have to be strictly better than the best policy in the permutation.
+        """
+        instrumentation = get_instrumentation()
+        start = time.perf_counter()
+        with instrumentation.timer("solve"):
+            if self.solver == "lp":
+                success, rewards = self._solve_lp(policy_permutation, adjacent_policy_relations, policies_above)
+            else:
+                success, rewards = self._solve_slsqp(policy_permutation, adjacent_policy_relations, policies_above)
+        seconds = time.perf_counter() - start
+
+        instrumentation.count("solver_calls")
+        instrumentation.count("solver_successes" if success else "solver_failures")
+        instrumentation.emit("solve", solver=self.solver, num_policies=len(policy_permutation) + len(policies_above),
+                             success=bool(success), seconds=seconds)
+        return success, rewards
+
+    def _solve_slsqp(self, policy_permutation, adjacent_policy_relations, policies_above=()):
+        options = {"env": self.env,
+                   "policy_permutation": policy_permutation,
+                   "make_reward_fun": self.make_reward_fun,
+                   "adjacent_policy_relations": list(adjacent_policy_relations),
+                   "feature_values": self.feature_values or None}
+        eq_constraint = {"type": "eq", "fun": constraints.make_eq_constraints(**options)}
+        ineq_constraint = {"type": "ineq",
+                           "fun": constraints.make_ineq_constraints(policies_above=policies_above, **options)}
+        exact_jacobians = constraints.has_reward_gradients(self.make_reward_fun) or bool(self.feature_values)
+        if exact_jacobians:
+            eq_constraint["jac"] = constraints.make_eq_constraint_jacobian(**options)
+            ineq_constraint["jac"] = constraints.make_ineq_constraint_jacobian(policies_above=policies_above,
+                                                                               **options)
+        res = minimize(
+            fun=lambda x: 0,
+            x0=self.x0,
+            jac=lambda x: np.zeros_like(x),
+            constraints=[eq_constraint, ineq_constraint]
+        )
+        if exact_jacobians:
+            return res.success and np.abs(res.x).max(initial=0) <= MAX_REWARD_MAGNITUDE, res.x
+        return res.success, res.x
+
+    def _solve_lp(self, policy_permutation, adjacent_policy_relations, policies_above=()):
+        permutation_feature_values = np.array([self.feature_values[policy] for policy in policy_permutation])
+        above_feature_values = np.array([self.feature_values[policy] for policy in policies_above])
+        A_ub, b_ub, A_eq, b_eq = constraints.make_linear_constraint_matrices(permutation_feature_values,
+                                                                             adjacent_policy_relations,
+                                                                             above_feature_values)
+        bounds = (0, None) if self.env.require_nonnegative_reward else (None, None)
+        res = linprog(c=np.zeros(self.reward_size),
+                      A_ub=A_ub if len(A_ub) else None,
+                      b_ub=b_ub if len(b_ub) else None,
+                      A_eq=A_eq if len(A_eq) else None,
+                      b_eq=b_eq if len(b_eq) else None,
+                      bounds=bounds,
+                      method="highs")
+        if res.status != 0:
+            return False, np.full(self.reward_size, np.nan)
+        return True, res.x
+
+    def solve_weak_ordering(self, weak_ordering: tuple[tuple[Policy], tuple[int]]) -> tuple[bool, np.ndarray]:
+        policy_permutation, adjacent_policy_relations = weak_ordering
+        return self(policy_permutation, adjacent_policy_relations)
+
+
+def solve_weak_orderings(ordering_solver: OrderingSolver,
+                         weak_orderings: list[tuple[tuple[Policy], tuple[int]]],
+                         workers: Optional[int] = None,
+                         chunksize: Optional[int] = None,
+                         progress: Optional[Callable[[int, int], None]] = None,
+                         store: Optional[ResultStore] = None) -> list[tuple[bool, np.ndarray]]:
+    """
+    Solve each (permutation, relation) candidate, across a process pool of the given number of workers
+    if requested. Returns (success, rewards) for each candidate, in the order of weak_orderings.
+    If a result store is given, candidates it has already decided are skipped, and new results are
+    saved to it as they come in.
+    """
+    if store is None:
+        return parallel_map(ordering_solver.solve_weak_ordering, weak_orderings,
+                            workers=workers, chunksize=chunksize, progress=progress)
+
+    results = [store.get(*weak_ordering) for weak_ordering in weak_orderings]
+    to_solve = [i for i, result in enumerate(results) if result is None]
+
+    def save_result(j, result):
+        i = to_solve[j]
+        results[i] = result
+        store.put(*weak_orderings[i], *result)
+
+    parallel_map(ordering_solver.solve_weak_ordering, [weak_orderings[i] for i in to_solve],
+                 workers=workers, chunksize=chunksize, progress=progress, callback=save_result)
+    return results
@@ -1,10 +1,43 @@
 # (c) 2022 Nikolaus Howe
+import contextlib
+import dataclasses
+import io
+import itertools
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
 import unittest
+import unittest.mock
 
 import numpy as np
 
+import benchmarks
+import constraints
+import estimation
+from experiments import cleaning_robot_experiments
+import graph_analysis
+import graphs
+import mdp_files
+from bitsets import PairBitsets, _popcount_from_bytes, count_strict_disagreements, popcount
 from environment import MDPWithoutRewardEnv
-from policy import Policy, make_cleaning_policy, make_two_state_policy
+from estimation import estimate_gameability_probability
+from gameability import (check_gameable, check_gameable_batch, check_ungameable, count_discordant_pairs,
+                         get_ungameability_adjacency, get_ungameability_matrix, get_ungameable_pairs,
+                         remove_equivalent_orderings)
+from instrumentation import Instrumentation, JsonLinesSink, set_instrumentation
+from orderings import (WeakOrdering, count_weak_orderings, generate_weak_orderings, get_preference_indicators,
+                       make_rank_matrix)
+from permutations import calculate_achievable_permutations
+from policy import Policy, TabularPolicy, make_cleaning_policy, make_two_state_policy
+from policy_ordering import run_full_ordering_search
+from policy_space import DeterministicPolicySpace, iter_policy_values
+import runner
+from simplification import check_simplification, get_simplification_adjacency, get_simplification_pairs
+from solvers import OrderingSolver
+import utils
 
 
 def two_state_dynamics(state, action):
@@ -22,6 +55,15 @@ def make_two_state_policies():
     return policy_funs
 
 
+def make_two_state_reward_fun(reward_components):
+    rewards = reward_components.reshape((2, 2))
+
+    def reward_fun(state, action):
+        return rewards[state, action]
+
+    return reward_fun
+
+
 class TestEnvMethods(unittest.TestCase):
 
     def test_policy_fun_construction(self):
@@ -106,6 +148,747 @@ class TestEnvMethods(unittest.TestCase):
         all_ave_policy_vals = env.get_all_average_policy_values(policy_funs, reward_fun)
         np.testing.assert_array_equal(all_ave_policy_vals, np.array([1.0, 0.5, 1.5, 1.0]))
 
+    def test_closed_form_policy_eval(self):
+        policy_funs = make_two_state_policies()
+        rewards = np.array([[0, 1],  # state 0
+                            [2, 0.5]])  # state 1
+        reward_fun = lambda s, a: rewards[s, a]
+
+        for discount in [0, 0.5, 0.9, 1]:
+            recursive_env = MDPWithoutRewardEnv(dynamics=two_state_dynamics, discount=discount)
+            closed_form_env = MDPWithoutRewardEnv(dynamics=two_state_dynamics, discount=discount,
+                                                  policy_evaluation="closed_form")
+            np.testing.assert_allclose(closed_form_env.get_all_average_policy_values(policy_funs, reward_fun),
+                                       recursive_env.get_all_average_policy_values(policy_funs, reward_fun))
+            for policy_fun in policy_funs:
+                self.assertAlmostEqual(closed_form_env.get_policy_value(policy_fun, 1, reward_fun),
+                                       recursive_env.get_policy_value(policy_fun, 1, reward_fun))
+
+    def test_closed_form_many_states(self):
+        num_states = 500
+
+        def ring_dynamics(state, action):
+            return (state + action) % num_states
+
+        env = MDPWithoutRewardEnv(dynamics=ring_dynamics, discount=0.9, num_states=num_states,
+                                  policy_evaluation="closed_form")
+        policy_fun = Policy("always move", lambda s: 1)
+        reward_fun = lambda s, a: float(s == 0)
+
+        # Every state is visited once per lap of the ring, so the average value is the average over start times
+        horizon_discounts = 0.9 ** np.arange(200)
+        self.assertAlmostEqual(env.get_average_policy_value(policy_fun, reward_fun),
+                               horizon_discounts.sum() / num_states)
+
+    def test_occupancy_policy_eval(self):
+        policy_funs = make_two_state_policies()
+        recursive_env = MDPWithoutRewardEnv(dynamics=two_state_dynamics, discount=0.5)
+        occupancy_env = MDPWithoutRewardEnv(dynamics=two_state_dynamics, discount=0.5,
+                                            policy_evaluation="occupancy", occupancy_cache_size=2)
+
+        reward_batch = np.random.default_rng(0).normal(size=(10, 4))
+        batch_values = occupancy_env.get_all_average_policy_values_from_rewards(policy_funs, reward_batch)
+        self.assertEqual(batch_values.shape, (10, 4))
+        self.assertLessEqual(len(occupancy_env._occupancy_cache), 2)
+
+        for rewards, values in zip(reward_batch, batch_values):
+            reward_fun = lambda s, a: rewards.reshape(2, 2)[s, a]
+            expected = recursive_env.get_all_average_policy_values(policy_funs, reward_fun)
+            np.testing.assert_allclose(values, expected)
+            np.testing.assert_allclose(occupancy_env.get_all_average_policy_values(policy_funs, reward_fun), expected)
+
+    def test_mdp_files(self):
+        policy_funs = make_two_state_policies()
+        reward_fun = make_two_state_reward_fun(np.array([1., 2., 3., 4.]))
+        expected = MDPWithoutRewardEnv(dynamics=two_state_dynamics,
+                                       discount=0.5).get_all_average_policy_values(policy_funs, reward_fun)
+
+        rng = np.random.default_rng(0)
+        transitions = rng.random((6, 3, 6))
+        transitions /= transitions.sum(axis=2, keepdims=True)
+        initial_distribution = rng.dirichlet(np.ones(6))
+        policy = TabularPolicy("random", rng.integers(0, 3, size=6))
+        rewards = rng.normal(size=(6, 3))
+        with tempfile.TemporaryDirectory() as directory:
+            table_path = os.path.join(directory, "two_state.npy")
+            mdp_files.save_mdp(table_path, np.array([[0, 1], [0, 1]]))
+            table_env = mdp_files.load_mdp(table_path, discount=0.5, policy_evaluation="recursive")
+            self.assertIsInstance(table_env.transitions, np.memmap)
+            np.testing.assert_allclose(table_env.get_all_average_policy_values(policy_funs, reward_fun), expected)
+
+            stochastic_path = os.path.join(directory, "stochastic.npz")
+            mdp_files.save_mdp(stochastic_path, transitions, initial_distribution, discount=0.9)
+            env = mdp_files.load_mdp(stochastic_path)
+            self.assertIsInstance(env.transitions, np.memmap)
+            self.assertEqual((env.num_states, env.num_actions, env.discount), (6, 3, 0.9))
+
+            transition_matrix = transitions[np.arange(6), policy.actions]
+            values = np.linalg.solve(np.eye(6) - 0.9 * transition_matrix, rewards[np.arange(6), policy.actions])
+            value = env.get_average_policy_value(policy, lambda s, a: rewards[s, a])
+            self.assertAlmostEqual(value, values @ initial_distribution, places=6)
+
+            with self.assertRaises(ValueError):
+                mdp_files.load_mdp(stochastic_path, policy_evaluation="recursive")
+            # Pickling the env (eg. to send it to worker processes) refers to the file rather than copying it
+            large_path = os.path.join(directory, "large.npz")
+            mdp_files.save_mdp(large_path, np.arange(4000).reshape(2000, 2) % 2000, discount=0.5)
+            large_env = mdp_files.load_mdp(large_path)
+            pickled = pickle.dumps(large_env)
+            self.assertLess(len(pickled), large_env.transitions.nbytes // 10)
+            np.testing.assert_array_equal(pickle.loads(pickled).get_next_state_table(), large_env.transitions)
+
+            invalid_path = os.path.join(directory, "invalid.npy")
+            mdp_files.save_mdp(invalid_path, np.array([[0, 2], [0, 1]]))
+            with self.assertRaises(ValueError):
+                mdp_files.load_mdp(invalid_path, discount=0.5)
+
+    def test_sparse_transitions(self):
+        import scipy.sparse
+
+        rng = np.random.default_rng(1)
+        transitions = rng.random((8, 3, 8)) * (rng.random((8, 3, 8)) < 0.3)
+        transitions[:, :, 0] += 0.1
+        transitions /= transitions.sum(axis=2, keepdims=True)
+        sparse_transitions = scipy.sparse.csr_matrix(transitions.reshape(24, 8))
+        dense_env = MDPWithoutRewardEnv(dynamics=None, discount=0.9, transitions=transitions,
+                                        policy_evaluation="closed_form")
+        sparse_env = MDPWithoutRewardEnv(dynamics=None, discount=0.9, transitions=sparse_transitions,
+                                         policy_evaluation="occupancy")
+        self.assertEqual((sparse_env.num_states, sparse_env.num_actions), (8, 3))
+
+        action_table = rng.integers(0, 3, size=(5, 8))
+        policies = [TabularPolicy(i, actions) for i, actions in enumerate(action_table)]
+        rewards = rng.normal(size=(8, 3))
+        reward_fun = lambda s, a: rewards[s, a]
+        np.testing.assert_allclose(sparse_env.get_action_table_occupancy(action_table),
+                                   dense_env.get_action_table_occupancy(action_table))
+        np.testing.assert_allclose(sparse_env.get_all_average_policy_values(policies, reward_fun),
+                                   dense_env.get_all_average_policy_values(policies, reward_fun))
+        sparse_env.policy_evaluation = "closed_form"
+        np.testing.assert_allclose(sparse_env.get_closed_form_policy_values(policies[0], reward_fun),
+                                   dense_env.get_closed_form_policy_values(policies[0], reward_fun))
+
+        # A loose tolerance stops the sweeps early
+        loose_env = MDPWithoutRewardEnv(dynamics=None, discount=0.9, transitions=sparse_transitions,
+                                        policy_evaluation="closed_form", bellman_tolerance=1e-2)
+        loose_values = loose_env.get_closed_form_policy_values(policies[0], reward_fun)
+        exact_values = dense_env.get_closed_form_policy_values(policies[0], reward_fun)
+        self.assertFalse(np.allclose(loose_values, exact_values))
+        np.testing.assert_allclose(loose_values, exact_values, atol=0.1)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "sparse.npz")
+            mdp_files.save_mdp(path, sparse_transitions, discount=0.9)
+            loaded_env = mdp_files.load_mdp(path)
+            np.testing.assert_allclose(loaded_env.get_action_table_occupancy(action_table),
+                                       dense_env.get_action_table_occupancy(action_table))
+            pickled = pickle.dumps(loaded_env)
+            self.assertLess(len(pickled), loaded_env.transitions.data.nbytes)
+            np.testing.assert_allclose(pickle.loads(pickled).get_action_table_occupancy(action_table),
+                                       dense_env.get_action_table_occupancy(action_table))
+        with self.assertRaises(ValueError):
+            MDPWithoutRewardEnv(dynamics=None, discount=0.9, transitions=sparse_transitions)
+
+    def test_tabular_policy(self):
+        p01 = make_two_state_policy((0, 1))
+        self.assertIsInstance(p01, TabularPolicy)
+        self.assertEqual((p01(0), p01(1)), (0, 1))
+        self.assertTrue((p01.get_actions(np.array([1, 1, 0])) == [1, 1, 0]).all())
+        self.assertEqual(repr(p01), "Policy(0, 1)")
+
+        # Same name, same policy, whichever class it is
+        closure_p01 = Policy((0, 1), lambda state: state)
+        self.assertEqual(p01, make_two_state_policy((0, 1)))
+        self.assertEqual(p01, closure_p01)
+        self.assertEqual(closure_p01, p01)
+        self.assertEqual(len({p01, make_two_state_policy((0, 1)), closure_p01}), 1)
+        self.assertNotEqual(p01, make_two_state_policy((1, 0)))
+        self.assertEqual(sorted([make_two_state_policy((1, 1)), closure_p01, make_two_state_policy((0, 0))]),
+                         [make_two_state_policy((0, 0)), p01, make_two_state_policy((1, 1))])
+
+        unpickled = pickle.loads(pickle.dumps(p01))
+        self.assertEqual(unpickled, p01)
+        self.assertEqual(unpickled.id, p01.id)
+        self.assertEqual(hash(unpickled), hash(p01))
+
+        # The id only depends on the name, so it is the same in another process, and isn't kept anywhere
+        script = "from policy import make_two_state_policy; print(make_two_state_policy((0, 1)).id)"
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        self.assertEqual(int(output), p01.id)
+        # Like a Policy, only the name counts, so that equality stays transitive
+        same_name = TabularPolicy((0, 1), [1, 0])
+        self.assertEqual(same_name, closure_p01)
+        self.assertEqual(same_name, p01)
+        self.assertEqual(len({same_name, closure_p01, p01}), 1)
+
+        # The actions are copied before they're made read-only, rather than freezing the caller's array
+        actions = np.array([0, 1], dtype=np.int64)
+        self.assertFalse(TabularPolicy((0, 1), actions).actions.flags.writeable)
+        self.assertTrue(actions.flags.writeable)
+
+        cleaning_policy = make_cleaning_policy((1, 0, 1))
+        self.assertEqual(cleaning_policy(0), (1, 0, 1))
+        self.assertEqual(utils.fancy_str_permutation((cleaning_policy, p01), (1,)), "$101<01$")
+
+
+class TestPolicySpace(unittest.TestCase):
+
+    def test_enumeration(self):
+        space = DeterministicPolicySpace(num_states=4, num_actions=3)
+        action_tables = [action_table for _, action_table in space.iter_action_tables(chunk_size=7)]
+        self.assertEqual([tuple(actions) for actions in np.concatenate(action_tables).tolist()],
+                         list(itertools.product(range(3), repeat=4)))
+        for index in (0, 1, 40, space.size - 1):
+            self.assertEqual(space.rank(space.unrank(index)), index)
+        self.assertEqual(space.get_policy(1), make_two_state_policy((0, 0, 0, 1)))
+        with self.assertRaises(IndexError):
+            space.unrank(space.size)
+
+        # Far past what fits in an int64
+        huge_space = DeterministicPolicySpace(num_states=100, num_actions=3)
+        action_table = huge_space.get_action_table(huge_space.size - 10, huge_space.size + 10)
+        self.assertEqual([huge_space.rank(actions) for actions in action_table],
+                         list(range(huge_space.size - 10, huge_space.size)))
+
+    def test_action_table_evaluation(self):
+        env = MDPWithoutRewardEnv(dynamics=two_state_dynamics, discount=0.5, policy_evaluation="occupancy")
+        space = DeterministicPolicySpace.from_env(env)
+        action_table = space.get_action_table(0, space.size)
+        policies = make_two_state_policies()
+
+        self.assertTrue(np.allclose(env.get_action_table_occupancy(action_table), env.get_occupancy_matrix(policies)))
+        reward_fun = make_two_state_reward_fun(np.array([1., -2., 3., 0.5]))
+        self.assertTrue(np.allclose(env.get_all_average_policy_values(action_table, reward_fun),
+                                    env.get_all_average_policy_values(policies, reward_fun)))
+        values = np.concatenate([values for _, values in iter_policy_values(space, env, reward_fun, chunk_size=3)])
+        self.assertTrue(np.allclose(values, env.get_all_average_policy_values(policies, reward_fun)))
+
+        # The batched gameability check takes the action table in place of the policies
+        rng = np.random.default_rng(0)
+        proxy_reward, true_rewards = rng.standard_normal(4), rng.standard_normal((20, 4))
+        from_table = check_gameable_batch(action_table, proxy_reward, true_rewards, make_two_state_reward_fun, 4, env)
+        from_policies = check_gameable_batch(policies, proxy_reward, true_rewards, make_two_state_reward_fun, 4, env)
+        self.assertTrue((from_table.gameable == from_policies.gameable).all())
+        self.assertTrue((from_table.witnesses == from_policies.witnesses).all())
+
+    def test_action_table_search(self):
+        env = MDPWithoutRewardEnv(dynamics=two_state_dynamics, discount=0.5, policy_evaluation="occupancy")
+        space = DeterministicPolicySpace.from_env(env)
+        _, action_table = next(space.iter_action_tables(chunk_size=3))
+        policies = [space.get_policy(index) for index in range(3)]
+
+        for solver in ("lp", "slsqp"):
+            realized_permutations, realized_relations, _ = calculate_achievable_permutations(
+                action_table, make_reward_fun=make_two_state_reward_fun, env=env, reward_size=4, solver=solver)
+            expected_permutations, expected_relations, _ = calculate_achievable_permutations(
+                policies, make_reward_fun=make_two_state_reward_fun, env=env, reward_size=4, solver=solver)
+            self.assertEqual(realized_permutations, expected_permutations)
+            self.assertEqual(realized_relations, expected_relations)
+            self.assertEqual(run_full_ordering_search(action_table, make_two_state_reward_fun, 4, env, solver=solver),
+                             run_full_ordering_search(policies, make_two_state_reward_fun, 4, env, solver=solver))
+
+
+class TestOrderingSearch(unittest.TestCase):
+
+    def test_lp_certificates(self):
+        env = MDPWithoutRewardEnv(dynamics=two_state_dynamics, discount=0.5, policy_evaluation="occupancy")
+        policy_funs = make_two_state_policies()
+
+        realized_permutations, realized_relations, realized_rewards = calculate_achievable_permutations(
+            allowed_policies=policy_funs, make_reward_fun=make_two_state_reward_fun, env=env, reward_size=4,
+            solver="lp")
+        # 60 permutation and relation pairs, but only 25 distinct weak orderings
+        self.assertEqual(len(realized_permutations), 25)
+
+        for perm, relation, rewards in zip(realized_permutations, realized_relations, realized_rewards):
+            values = env.get_all_average_policy_values(perm, make_two_state_reward_fun(rewards))
+            differences = np.diff(values)
+            relation = np.array(relation)
+            self.assertTrue(np.all(differences[relation == 1] >= 1 - 1e-6))
+            np.testing.assert_allclose(differences[relation == 0], 0, atol=1e-6)
+
+    def test_constraint_jacobians(self):
+        env = MDPWithoutRewardEnv(dynamics=two_state_dynamics, discount=0.5, require_nonnegative_reward=True)
+        policy_funs = make_two_state_policies()
+        permutation, relations, above = tuple(policy_funs[:3]), [1, 0], (policy_funs[3],)
+
+        @constraints.declare_reward_features(lambda state, action: np.eye(4)[2 * state + action])
+        def make_linear_reward_fun(decision_vars):
+            return make_two_state_reward_fun(decision_vars)
+
+        @constraints.declare_reward_jacobian(lambda x: lambda state, action: np.eye(4)[2 * state + action] * 2 * x)
+        def make_squared_reward_fun(decision_vars):
+            return make_two_state_reward_fun(decision_vars ** 2)
+
+        feature_values = dict(zip(policy_funs, constraints.get_policy_feature_values(policy_funs,
+                                                                                     make_linear_reward_fun, 4, env)))
+        decision_vars = np.array([0.3, -1.2, 2., 0.7])
+        for make_reward_fun, features in ((make_linear_reward_fun, feature_values), (make_linear_reward_fun, None),
+                                          (make_squared_reward_fun, None)):
+            options = {"env": env, "policy_permutation": permutation, "make_reward_fun": make_reward_fun,
+                       "adjacent_policy_relations": relations, "feature_values": features}
+            ineq = constraints.make_ineq_constraints(policies_above=above, **options)
+            eq = constraints.make_eq_constraints(**options)
+            ineq_jacobian = constraints.make_ineq_constraint_jacobian(policies_above=above, **options)
+            eq_jacobian = constraints.make_eq_constraint_jacobian(**options)
+            np.testing.assert_allclose(ineq(decision_vars), constraints.ineq_constraints(
+                decision_vars, permutation, make_reward_fun, env, relations, above))
+            for fun, jacobian in ((ineq, ineq_jacobian), (eq, eq_jacobian)):
+                finite_differences = np.stack([(np.asarray(fun(decision_vars + 1e-6 * unit_vector)) -
+                                                np.asarray(fun(decision_vars - 1e-6 * unit_vector))) / 2e-6
+                                               for unit_vector in np.eye(4)], axis=1)
+                np.testing.assert_allclose(jacobian(decision_vars), finite_differences, atol=1e-6)
+
+        # With the exact constraints, SLSQP finds the same 25 weak orderings as the linear program
+        realized_permutations, _, _ = calculate_achievable_permutations(
+            allowed_policies=policy_funs, make_reward_fun=make_linear_reward_fun,
+            env=MDPWithoutRewardEnv(dynamics=two_state_dynamics, discount=0.5), reward_size=4)
+        self.assertEqual(len(realized_permutations), 25)
+
+        # An infeasible ordering that SLSQP with exact Jacobians used to "solve" by running off to ~1e16
+        p00, p01, p10, p11 = policy_funs
+        ordering_solver = OrderingSolver(policies=policy_funs, make_reward_fun=make_linear_reward_fun, reward_size=4,
+                                         env=MDPWithoutRewardEnv(dynamics=two_state_dynamics, discount=0.5),
+                                         x0=np.ones(4))
+        self.assertFalse(ordering_solver((p11, p00, p01, p10), (1, 0, 0))[0])
+
+        # Features that don't match make_reward_fun are caught when the solver is made
+        @constraints.declare_reward_features(lambda state, action: np.eye(4)[2 * state + 1 - action])
+        def make_mislabelled_reward_fun(decision_vars):
+            return make_two_state_reward_fun(decision_vars)
+
+        with self.assertRaises(ValueError):
+            OrderingSolver(policies=policy_funs, make_reward_fun=make_mislabelled_reward_fun, reward_size=4, env=env)
+
+        # They're checked at the actions the policies take, which for the cleaning robot are tuples of rooms
+        cleaning_env = MDPWithoutRewardEnv(dynamics=cleaning_robot_experiments.cleaning_dynamics, discount=0,
+                                           num_states=1, num_actions=8)
+        cleaning_policies = [make_cleaning_policy(rooms) for rooms in ((0, 0, 1), (1, 1, 0), (1, 1, 1))]
+        cleaning_solver = OrderingSolver(policies=cleaning_policies,
+                                         make_reward_fun=cleaning_robot_experiments.make_reward_fun,
+                                         reward_size=cleaning_robot_experiments.REWARD_SIZE, env=cleaning_env)
+        self.assertTrue(cleaning_solver(tuple(cleaning_policies), (1, 1))[0])
+
+    def test_parallel_search(self):
+        env = MDPWithoutRewardEnv(dynamics=two_state_dynamics, discount=0.5, policy_evaluation="occupancy")
+        policy_funs = make_two_state_policies()[:3]
+
+        serial = calculate_achievable_permutations(allowed_policies=policy_funs,
+                                                   make_reward_fun=make_two_state_reward_fun,
+                                                   env=env, reward_size=4, solver="lp")
+        parallel = calculate_achievable_permutations(allowed_policies=policy_funs,
+                                                     make_reward_fun=make_two_state_reward_fun,
+                                                     env=env, reward_size=4, solver="lp", workers=2)
+        self.assertEqual(serial[0], parallel[0])
+        self.assertEqual(serial[1], parallel[1])
+        np.testing.assert_allclose(serial[2], parallel[2])
+
+        self.assertEqual(run_full_ordering_search(policy_funs, make_two_state_reward_fun, 4, env, workers=2),
+                         run_full_ordering_search(policy_funs, make_two_state_reward_fun, 4, env))
+
+    def test_weak_orderings(self):
+        policy_funs = make_two_state_policies()
+        weak_orderings = list(generate_weak_orderings(policy_funs))
+        self.assertEqual(len(weak_orderings), count_weak_orderings(4))
+
+        all_pairs = set(itertools.product(itertools.permutations(policy_funs),
+                                          itertools.product(range(2), repeat=3)))
+        self.assertEqual(set(weak_orderings), remove_equivalent_orderings(all_pairs))
+
+    def test_depth_first_search(self):
+        env = MDPWithoutRewardEnv(dynamics=two_state_dynamics, discount=0.5, policy_evaluation="occupancy")
+        policy_funs = make_two_state_policies()
+
+        for solver in ["lp", "slsqp"]:
+            flat = calculate_achievable_permutations(allowed_policies=policy_funs,
+                                                     make_reward_fun=make_two_state_reward_fun,
+                                                     env=env, reward_size=4, solver=solver)
+            dfs = calculate_achievable_permutations(allowed_policies=policy_funs,
+                                                    make_reward_fun=make_two_state_reward_fun,
+                                                    env=env, reward_size=4, solver=solver, search="dfs")
+            self.assertEqual(flat[0], dfs[0])
+            self.assertEqual(flat[1], dfs[1])
+
+    def test_sampling_prepass(self):
+        env = MDPWithoutRewardEnv(dynamics=two_state_dynamics, discount=0.5, policy_evaluation="occupancy")
+        policy_funs = make_two_state_policies()
+
+        exact = calculate_achievable_permutations(allowed_policies=policy_funs,
+                                                  make_reward_fun=make_two_state_reward_fun,
+                                                  env=env, reward_size=4, solver="lp")
+        sampled = calculate_achievable_permutations(allowed_policies=policy_funs,
+                                                    make_reward_fun=make_two_state_reward_fun,
+                                                    env=env, reward_size=4, solver="lp", num_samples=10000)
+        self.assertEqual(exact[0], sampled[0])
+        self.assertEqual(exact[1], sampled[1])
+        with self.assertRaises(ValueError):
+            calculate_achievable_permutations(allowed_policies=policy_funs, make_reward_fun=make_two_state_reward_fun,
+                                              env=env, reward_size=4, solver="lp", search="dfs", num_samples=10)
+        for perm, relation, rewards in zip(*sampled):
+            differences = np.diff(env.get_all_average_policy_values(perm, make_two_state_reward_fun(rewards)))
+            self.assertTrue(np.all(differences[np.array(relation) == 1] >= 1 - 1e-6))
+
+    def test_result_store(self):
+        env = MDPWithoutRewardEnv(dynamics=two_state_dynamics, discount=0.5, policy_evaluation="occupancy")
+        policy_funs = make_two_state_policies()
+
+        def search(store_dir, **kwargs):
+            return calculate_achievable_permutations(allowed_policies=policy_funs,
+                                                     make_reward_fun=make_two_state_reward_fun,
+                                                     env=env, reward_size=4, solver="lp", store_dir=store_dir,
+                                                     **kwargs)
+
+        with tempfile.TemporaryDirectory() as store_dir:
+            first = search(store_dir)
+            [store_file] = os.listdir(store_dir)
+            store_path = os.path.join(store_dir, store_file)
+            with open(store_path) as f:
+                lines = f.readlines()
+            self.assertEqual(len(lines), count_weak_orderings(4))
+
+            # Pretend we crashed halfway through writing a line, then resume
+            with open(store_path, "w") as f:
+                f.writelines(lines[:30])
+                f.write(lines[30][:10])
+            resumed = search(store_dir)
+            self.assertEqual(first[:2], resumed[:2])
+
+            # Once everything is decided, running again doesn't write anything new, or even set up a solver
+            no_solver = AssertionError("Made an ordering solver")
+            for search_mode in ["flat", "dfs"]:
+                self.assertEqual(first[:2], search(store_dir, search=search_mode)[:2])
+                full_search = run_full_ordering_search(policy_funs, make_two_state_reward_fun, 4, env, solver="lp",
+                                                       search=search_mode, store_dir=store_dir)
+                size = os.path.getsize(store_path)
+                with unittest.mock.patch("permutations.OrderingSolver", side_effect=no_solver), \
+                        unittest.mock.patch("policy_ordering.OrderingSolver", side_effect=no_solver):
+                    self.assertEqual(first[:2], search(store_dir, search=search_mode)[:2])
+                    self.assertEqual(run_full_ordering_search(policy_funs, make_two_state_reward_fun, 4, env,
+                                                              solver="lp", search=search_mode, store_dir=store_dir),
+                                     full_search)
+                self.assertEqual(os.path.getsize(store_path), size)
+
+    def test_experiment_runner(self):
+        with tempfile.TemporaryDirectory() as directory:
+            specs_path = os.path.join(directory, "specs.json")
+            with open(specs_path, "w") as f:
+                json.dump([{"preset": "two_state_mdp", "name": "all", "solver": "lp", "transitive_reduction": True,
+                            "plot_options": {"plot": False}},
+                           {"preset": "two_state_mdp", "name": "two", "solver": "lp", "stages": ["orderings"],
+                            "policies": [[0, 0], [1, 1]]}], f)
+            specs = runner.load_specs(specs_path)
+            specs = [dataclasses.replace(spec, output_dir=directory) for spec in specs]
+            with contextlib.redirect_stdout(io.StringIO()):
+                records = runner.run_experiments(specs, output=os.path.join(directory, "results.jsonl"))
+            self.assertTrue(os.path.exists(os.path.join(directory, "all", "Simplification Graph Summary.json")))
+            with open(os.path.join(directory, "results.jsonl")) as f:
+                self.assertEqual([json.loads(line)["name"] for line in f], ["all", "two"])
+
+        # The two-state MDP realizes 25 of the 75 weak orderings of its policies, and any ordering of two policies
+        self.assertEqual(records[0]["num_achievable_permutations"], 25)
+        self.assertEqual(records[0]["num_realized_orderings"], 25)
+        self.assertEqual(records[0]["simplification"]["num_nodes"], 25)
+        self.assertEqual(records[1]["num_realized_orderings"], 3)
+        self.assertNotIn("num_achievable_permutations", records[1])
+        # Both specs ran on the same environment object
+        self.assertIs(runner.get_env(specs[0]), runner.get_env(specs[1]))
+
+        with self.assertRaises(ValueError):
+            runner.make_spec({"preset": "two_state_mdp", "reward": "rooms"})
+
+        # In a pool, the groups of specs on each environment go to the workers, whose searches don't start pools
+        with tempfile.TemporaryDirectory() as directory:
+            specs = [runner.make_spec({"preset": preset, "solver": "lp", "stages": ["orderings"], "workers": 2,
+                                       "output_dir": directory}) for preset in ("two_state_mdp", "cleaning_robot")]
+            with unittest.mock.patch("runner.parallel_map", wraps=runner.parallel_map) as pool_map, \
+                    contextlib.redirect_stdout(io.StringIO()):
+                pooled = runner.run_experiments(specs, workers=2)
+        self.assertEqual(pool_map.call_args.args[0].keywords, {"workers": 1})
+        self.assertEqual([record["num_realized_orderings"] for record in pooled], [25, 6])
+
+    def test_instrumentation(self):
+        env = MDPWithoutRewardEnv(dynamics=two_state_dynamics, discount=0.5, policy_evaluation="occupancy")
+        policy_funs = make_two_state_policies()[:3]
+
+        events = io.StringIO()
+        instrumentation = Instrumentation(sinks=[JsonLinesSink(events)])
+        previous = set_instrumentation(instrumentation)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                run_full_ordering_search(policy_funs, make_two_state_reward_fun, 4, env, solver="lp", workers=2)
+        finally:
+            set_instrumentation(previous)
+
+        self.assertEqual(stdout.getvalue(), "")
+        self.assertEqual(instrumentation.counters["solver_calls"], count_weak_orderings(3))
+        self.assertEqual(instrumentation.counters["solver_calls"],
+                         instrumentation.counters["solver_successes"] + instrumentation.counters["solver_failures"])
+        self.assertGreater(instrumentation.counters["policy_evaluations"], 0)
+
+        records = [json.loads(line) for line in events.getvalue().splitlines()]
+        self.assertEqual(records[0]["event"], "search_start")
+        self.assertEqual(records[-1]["event"], "search_end")
+        self.assertEqual(sum(record["event"] == "ordering_result" for record in records), count_weak_orderings(3))
+        self.assertEqual(records[-1]["counters"]["solver_calls"], count_weak_orderings(3))
+        self.assertGreater(records[-1]["timers"]["run_full_ordering_search"], 0)
+
+        # The reported values come from the LP's feature values, rather than evaluating the policies again
+        for record in records:
+            if record["event"] == "ordering_result" and record["success"]:
+                self.assertTrue(np.all(np.diff(record["values"]) >= -1e-6))
+        quiet = Instrumentation()
+        previous = set_instrumentation(quiet)
+        try:
+            run_full_ordering_search(policy_funs, make_two_state_reward_fun, 4, env, solver="lp", workers=2)
+        finally:
+            set_instrumentation(previous)
+        self.assertEqual(quiet.counters["policy_evaluations"], instrumentation.counters["policy_evaluations"])
+
+
+class TestOrderingRelations(unittest.TestCase):
+
+    def test_rank_vectors(self):
+        policies = make_two_state_policies()
+        orderings = list(generate_weak_orderings(policies))
+        rank_matrix, columns = make_rank_matrix(orderings, policies)
+        self.assertEqual(columns, policies)
+        self.assertEqual(len({tuple(ranks) for ranks in rank_matrix.tolist()}), len(orderings))
+        for ranks, ordering in zip(rank_matrix.tolist(), orderings):
+            self.assertEqual(WeakOrdering(tuple(ranks)).to_permutation(policies), ordering)
+
+        # Equivalent ways of writing an ordering have the same ranks
+        p00, p01, p10, p11 = policies
+        policy_indices = {policy: i for i, policy in enumerate(policies)}
+        self.assertEqual(WeakOrdering.from_permutation((p00, p01, p10, p11), (0, 1, 0), policy_indices),
+                         WeakOrdering.from_permutation((p01, p00, p11, p10), (0, 1, 0), policy_indices))
+        with self.assertRaises(ValueError):
+            WeakOrdering.from_permutation((p00, p01), (1,), policy_indices)
+
+    def test_ungameability_matrix(self):
+        orderings = list(generate_weak_orderings(make_two_state_policies()))
+        expected = {(first, second) for first, second in itertools.permutations(orderings, 2)
+                    if check_ungameable(first, second)}
+        pairs = get_ungameable_pairs(orderings, chunk_size=10)
+        self.assertEqual(len(pairs), len(expected))
+        self.assertEqual(set(pairs), expected)
+
+        matrix = get_ungameability_matrix(make_rank_matrix(orderings)[0])
+        self.assertTrue((matrix == matrix.T).all())
+        self.assertFalse(matrix.diagonal().any())
+        self.assertEqual(matrix.sum(), len(expected))
+
+        # Both orderings have to rank the same policies
+        p00, p01, p10, _ = make_two_state_policies()
+        for check in (check_ungameable, check_simplification):
+            with self.assertRaisesRegex(ValueError, r"doesn't rank \[Policy\(1, 0\)\]"):
+                check(((p00, p01, p10), (1, 1)), ((p00, p01), (1,)))
+
+    def test_simplification_matrix(self):
+        orderings = list(generate_weak_orderings(make_two_state_policies()))
+        expected = {(first, second) for first, second in itertools.permutations(orderings, 2)
+                    if check_simplification(first, second)}
+        pairs = get_simplification_pairs(orderings, chunk_size=10)
+        self.assertEqual(len(pairs), len(expected))
+        self.assertEqual(set(pairs), expected)
+
+        # Among all the weak orderings, the Hasse diagram is exactly the merges of two adjacent blocks
+        hasse = get_simplification_pairs(orderings, transitive_reduction=True)
+        self.assertLess(len(hasse), len(pairs))
+        self.assertTrue(set(hasse) <= expected)
+        for finer, simpler in hasse:
+            self.assertEqual(sum(finer[1]) - sum(simpler[1]), 1)
+
+    def test_bitset_relations(self):
+        orderings = list(generate_weak_orderings(make_two_state_policies()))
+        self.assertEqual(get_ungameable_pairs(orderings, encoding="bitset"), get_ungameable_pairs(orderings))
+        self.assertEqual(get_simplification_pairs(orderings, encoding="bitset"), get_simplification_pairs(orderings))
+        self.assertEqual(get_simplification_pairs(orderings, transitive_reduction=True, encoding="bitset"),
+                         get_simplification_pairs(orderings, transitive_reduction=True))
+
+        rank_matrix, _ = make_rank_matrix(list(generate_weak_orderings(range(6))))
+        bitsets = PairBitsets.from_rank_matrix(rank_matrix)
+        dense_nbytes = sum(indicators.nbytes for indicators in get_preference_indicators(rank_matrix))
+        self.assertLess(10 * bitsets.nbytes, dense_nbytes)
+        self.assertTrue((popcount(bitsets.less) == _popcount_from_bytes(bitsets.less)).all())
+        self.assertEqual(_popcount_from_bytes(np.array([[2 ** 64 - 1, 5]], dtype=np.uint64))[0], 66)
+
+        # Orderings are ungameable exactly when they strictly disagree on no pair
+        first, second = np.divmod(np.arange(len(bitsets) ** 2), len(bitsets))
+        disagreements = count_strict_disagreements(bitsets, first, second).reshape(len(bitsets), len(bitsets))
+        expected = disagreements == 0
+        np.fill_diagonal(expected, False)
+        self.assertTrue((get_ungameability_matrix(rank_matrix) == expected).all())
+
+    def test_graph_export(self):
+        orderings = list(generate_weak_orderings(make_two_state_policies()))
+        pairs = get_simplification_pairs(orderings, transitive_reduction=True)
+        nodes = sorted({node for pair in pairs for node in pair}, key=str)
+        labels = {node: utils.fancy_str_permutation(*node) for node in nodes}
+
+        with tempfile.TemporaryDirectory() as directory:
+            title = os.path.join(directory, "Simplification Graph")
+            graphs.plot_graph(nodes, pairs, labels, title=title, directed=True, renderer="plain",
+                              file_format="png", export_formats=graphs.EXPORT_FORMATS)
+            self.assertGreater(os.path.getsize(f"{title}.png"), 0)
+
+            with open(f"{title}.json") as f:
+                exported = json.load(f)
+            self.assertEqual(len(exported["nodes"]), len(nodes))
+            self.assertEqual(exported["nodes"][0]["label"], labels[nodes[0]].strip("$"))
+            self.assertEqual({(nodes[i], nodes[j]) for i, j in exported["edges"]}, set(pairs))
+            with open(f"{title}.dot") as f:
+                self.assertEqual(f.read().count("->"), len(pairs))
+            with open(f"{title}.graphml") as f:
+                self.assertEqual(f.read().count("<edge "), len(pairs))
+
+        for layout in graphs.GRAPH_LAYOUTS:
+            pos = graphs.get_layout(graphs.make_graph(nodes, pairs, directed=True), layout)
+            self.assertEqual(set(pos), set(nodes))
+
+    def test_graph_analysis(self):
+        rank_matrix, _ = make_rank_matrix(list(generate_weak_orderings(range(4))))
+        ungameability = get_ungameability_adjacency(rank_matrix, encoding="bitset")
+        self.assertTrue((ungameability.toarray() == get_ungameability_matrix(rank_matrix)).all())
+
+        summary = graph_analysis.summarize_graph(ungameability, directed=False)
+        self.assertEqual(summary["num_edges"], ungameability.nnz // 2)
+        dense = get_ungameability_matrix(rank_matrix)
+        for clique in graph_analysis.find_maximal_cliques(ungameability):
+            within = dense[np.ix_(clique, clique)]
+            self.assertEqual(within.sum(), len(clique) * (len(clique) - 1))
+            # Maximal: nothing outside the clique is ungameable with all of it
+            self.assertFalse(dense[clique].all(axis=0).any())
+
+        # The longest chain of simplifications goes from a strict ordering down to all ties, one merge at a time
+        hasse = get_simplification_adjacency(rank_matrix, transitive_reduction=True)
+        summary = graph_analysis.summarize_graph(hasse, directed=True)
+        chain = summary["longest_chain"]
+        self.assertEqual(len(chain), 4)
+        self.assertTrue(all(hasse[first, second] for first, second in zip(chain, chain[1:])))
+        self.assertEqual(len(np.unique(rank_matrix[chain[0]])), 4)
+        self.assertEqual(len(np.unique(rank_matrix[chain[-1]])), 1)
+        self.assertEqual((summary["num_sources"], summary["num_sinks"], summary["num_components"]), (24, 1, 1))
+
+    def test_gameability_check(self):
+        def check_gameable_all_pairs(values_1, values_2):
+            return [(i, j) for i, j in itertools.combinations(range(len(values_1)), 2)
+                    if (values_1[i] - values_1[j]) * (values_2[i] - values_2[j]) < 0]
+
+        rng = np.random.default_rng(0)
+        for _ in range(200):
+            num_policies = rng.integers(10)
+            # Few distinct values, so that there are lots of ties
+            values_1 = rng.integers(3, size=num_policies).astype(float)
+            values_2 = rng.integers(3, size=num_policies)
+            discordant = check_gameable_all_pairs(values_1, values_2)
+            self.assertEqual(check_gameable(list(values_1), list(values_2)), len(discordant) > 0)
+            self.assertEqual(count_discordant_pairs(values_1, values_2), len(discordant))
+
+        self.assertFalse(check_gameable([1, 1, 2], [3, 4, 4]))
+        self.assertTrue(check_gameable([1, 2, 3], [1, 3, 2]))
+
+    def test_gameability_batch(self):
+        env = MDPWithoutRewardEnv(dynamics=two_state_dynamics, discount=0.5, policy_evaluation="occupancy")
+        policies = make_two_state_policies()
+        rng = np.random.default_rng(0)
+        # Small integer rewards, so that some policies are tied
+        proxy_rewards = rng.integers(-2, 3, size=(3, 4)).astype(float)
+        true_rewards = rng.integers(-2, 3, size=(50, 4)).astype(float)
+
+        result = check_gameable_batch(policies, proxy_rewards, true_rewards, make_two_state_reward_fun, 4, env,
+                                      chunk_size=16)
+        self.assertEqual(result.gameable.shape, (3, 50))
+        self.assertTrue(result.gameable.any() and not result.gameable.all())
+        for k, proxy_reward in enumerate(proxy_rewards):
+            proxy_values = env.get_all_average_policy_values(policies, make_two_state_reward_fun(proxy_reward))
+            for t, true_reward in enumerate(true_rewards):
+                true_values = env.get_all_average_policy_values(policies, make_two_state_reward_fun(true_reward))
+                self.assertEqual(result.gameable[k, t], check_gameable(proxy_values, true_values))
+                if result.gameable[k, t]:
+                    worse, better = result.witnesses[k, t]
+                    self.assertLess(proxy_values[worse], proxy_values[better])
+                    self.assertGreater(true_values[worse], true_values[better])
+
+        single = check_gameable_batch(policies, proxy_rewards[0], true_rewards, make_two_state_reward_fun, 4, env)
+        self.assertTrue((single.gameable == result.gameable[0]).all())
+        self.assertEqual(single.witnesses.shape, (50, 2))
+
+    def test_gameability_estimate(self):
+        env = MDPWithoutRewardEnv(dynamics=two_state_dynamics, discount=0.5, policy_evaluation="occupancy")
+        policies = make_two_state_policies()
+        proxy_reward = np.array([1., 0., 0., 2.])
+
+        estimate = estimate_gameability_probability(policies, proxy_reward, make_two_state_reward_fun, 4, env,
+                                                    max_samples=4000, batch_size=1000, seed=1)
+        self.assertEqual(estimate.num_samples, 4000)
+        true_rewards = np.concatenate([np.random.default_rng(seed_sequence).standard_normal((1000, 4))
+                                       for seed_sequence in np.random.SeedSequence(1).spawn(4)])
+        expected = check_gameable_batch(policies, proxy_reward, true_rewards, make_two_state_reward_fun, 4, env)
+        self.assertEqual(estimate.num_gameable, expected.gameable.sum())
+        low, high = estimate.interval
+        self.assertTrue(low < estimate.probability < high)
+
+        # Stopping early, and the same result with workers
+        stopped = estimate_gameability_probability(policies, proxy_reward, make_two_state_reward_fun, 4, env,
+                                                   max_samples=100_000, batch_size=500, target_half_width=0.02)
+        self.assertLess(stopped.num_samples, 100_000)
+        self.assertLessEqual(stopped.half_width, 0.02)
+        parallel = estimate_gameability_probability(policies, proxy_reward, make_two_state_reward_fun, 4, env,
+                                                    max_samples=100_000, batch_size=500, target_half_width=0.02,
+                                                    workers=2)
+        self.assertEqual(parallel, stopped)
+
+        # The rounds all go to one process pool, rather than parallel_map starting one for each
+        with unittest.mock.patch("estimation.ProcessPoolExecutor", wraps=estimation.ProcessPoolExecutor) as pool, \
+                unittest.mock.patch("parallel.ProcessPoolExecutor", side_effect=AssertionError("New pool")):
+            rounds = estimate_gameability_probability(policies, proxy_reward, make_two_state_reward_fun, 4, env,
+                                                      max_samples=4000, batch_size=250, workers=2)
+        self.assertEqual(pool.call_count, 1)
+        self.assertEqual(rounds.num_samples, 4000)
+
+        # A constant proxy ties every policy, so it can never be gamed
+        constant = estimate_gameability_probability(policies, np.zeros(4), make_two_state_reward_fun, 4, env,
+                                                    max_samples=1000)
+        self.assertEqual(constant.num_gameable, 0)
+        self.assertLess(constant.interval[1], 0.01)
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_benchmark_records(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "bench.jsonl")
+            with contextlib.redirect_stderr(io.StringIO()):
+                results = benchmarks.run_benchmarks("small", path, repeats=1, name_filter="remove_equivalent")
+            loaded = benchmarks.load_results(path)
+
+        self.assertEqual(len(results), len(benchmarks.SCALES["small"]["num_graph_policies"]))
+        self.assertEqual(len(loaded), len(results))
+        for record in results:
+            self.assertGreater(record["min_seconds"], 0)
+            self.assertIn("git_revision", record)
+        comparison = benchmarks.compare_results(loaded, loaded)
+
+        # The largest MDPs are only evaluated without dense matrices
+        evaluations = {(benchmark.params["num_states"], benchmark.params["policy_evaluation"])
+                       for benchmark in benchmarks.make_benchmarks("large")
+                       if benchmark.name == "get_all_average_policy_values"}
+        self.assertIn((10000, "action_table"), evaluations)
+        self.assertNotIn((10000, "closed_form"), evaluations)
+        self.assertNotIn((10000, "recursive"), evaluations)
+        self.assertEqual([speedup for _, _, _, speedup in comparison], [1.] * len(results))
+
+    def test_import_time(self):
+        result = benchmarks.measure_import_time()
+        self.assertEqual(result["loaded"], [])
+
+        # How long it took depends on the machine, so it is only checked against the budget in the benchmark results
+        with contextlib.redirect_stderr(io.StringIO()):
+            [record] = benchmarks.run_benchmarks("small", repeats=1, name_filter="import_core_modules")
+        self.assertEqual(record["budget_seconds"], benchmarks.IMPORT_TIME_BUDGET)
+        self.assertIn("over_budget", record)
+
 
 if __name__ == '__main__':
     unittest.main()
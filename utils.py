@@ -1,4 +1,13 @@
 # (c) 2022 Nikolaus Howe
+def str_permutation(policy_permutation, adjacent_policy_relations):
+    the_string = []
+    for i, policy in enumerate(policy_permutation[:-1]):
+        relation = '=' if adjacent_policy_relations[i] == 0 else '<' if adjacent_policy_relations[i] == 1 else '?'
+        the_string.append(f"{policy} {relation} ")
+    the_string.append(str(policy_permutation[-1]))
+    return ''.join(the_string)
+
+
 def fancy_print_permutation(policy_permutation, adjacent_policy_relations, realized_rewards=None):
     for i, policy in enumerate(policy_permutation[:-1]):
         relation = '=' if adjacent_policy_relations[i] == 0 else '<' if adjacent_policy_relations[i] == 1 else '?'